@@ -1,17 +1,19 @@
 import sys
 import os
+from array import array
 from datetime import datetime, timedelta
 
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel,
-                               QLineEdit, QPushButton, QTableWidget, QTableWidgetItem, QHeaderView,
+                               QLineEdit, QPushButton, QTableView, QHeaderView,
                                QGroupBox, QMessageBox, QAbstractItemView, QFrame,
                                QFileDialog, QProgressBar, QSizePolicy, QMenu,
                                QStackedWidget, QDialog)
-from PySide6.QtCore import Qt, QSettings, QDate, QTimer, QTranslator, QLocale, QObject, QThread
+from PySide6.QtCore import Qt, QSettings, QDate, QTimer, QTranslator, QLocale, QObject, QThread, QAbstractTableModel, QModelIndex, QRunnable, QThreadPool
 from PySide6.QtGui import QColor, QPalette, QIcon, QKeyEvent, QAction
 
 from config import WERSJA, PRODUCENT, setup_crash_handlers, _, MONTH_NAME, CASH_SAVINGS_NAME, APPNAME, APP_ID, AppMenuConfig, create_private_temp_file, cleanup_temp_files
 from database import DatabaseManager
+from budget_stats import compute_transactions_snapshot, SnapshotCancelled, month_bounds
 from dialogs import AppGuide
 from config import save_table_widths, load_table_widths
 
@@ -39,38 +41,227 @@ class ClickableDebtLabel(QLabel):
             self.clicked.emit(self.debt_id, self.debt_type)
 
 
+class TransactionTableModel(QAbstractTableModel):
+    """
+    Model głównej tabeli transakcji. Dane trzymane kolumnami (id, daty, kwoty
+    w tablicach), a teksty i kolory liczone dopiero przy rysowaniu wiersza,
+    więc koszt odświeżenia zależy od widocznej części tabeli, nie od liczby wyników.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._headers = [_("ID"), _("Data"), _("Kto/Kategoria"), _("Opis"), _("Kwota"), _("Szczegóły")]
+        self._ids = array('q')
+        self._dates = []
+        self._types = []
+        self._cats = []
+        self._subs = []
+        self._amounts = array('d')
+        self._details = []
+        self._has_file = bytearray()
+        self._accounts = []
+        self._account_names = {}
+        self._account_colors = {}
+        self._goal_variants = set()
+        self._colors = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._ids)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self._headers[section] if 0 <= section < len(self._headers) else None
+        return str(len(self._ids) - section)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+        if row >= len(self._ids):
+            return None
+        if role == Qt.DisplayRole:
+            return self.cell_text(row, col)
+        if role == Qt.ForegroundRole:
+            clr = self.cell_color(row, col)
+            return self._color(clr) if clr else None
+        return None
+
+    def set_rows(self, rows, account_names, account_colors, goal_variants):
+        """Podmienia zawartość; zmiana liczby wierszy jest zgłaszana jako insert/remove, żeby nie gubić zaznaczenia."""
+        old_count = len(self._ids)
+        new_count = len(rows)
+        if new_count < old_count:
+            self.beginRemoveRows(QModelIndex(), new_count, old_count - 1)
+            self._store(rows, account_names, account_colors, goal_variants)
+            self.endRemoveRows()
+        elif new_count > old_count:
+            self.beginInsertRows(QModelIndex(), old_count, new_count - 1)
+            self._store(rows, account_names, account_colors, goal_variants)
+            self.endInsertRows()
+        else:
+            self._store(rows, account_names, account_colors, goal_variants)
+        if new_count:
+            self.dataChanged.emit(self.index(0, 0), self.index(new_count - 1, len(self._headers) - 1))
+            self.headerDataChanged.emit(Qt.Vertical, 0, new_count - 1)
+
+    def _store(self, rows, account_names, account_colors, goal_variants):
+        self._ids = array('q', (int(r[0]) for r in rows))
+        self._dates = [r[1] for r in rows]
+        self._types = [r[2] for r in rows]
+        self._cats = [r[3] for r in rows]
+        self._subs = [r[4] for r in rows]
+        self._amounts = array('d', (float(r[5] or 0.0) for r in rows))
+        self._details = [r[6] for r in rows]
+        self._has_file = bytearray(1 if r[7] else 0 for r in rows)
+        self._accounts = [r[8] for r in rows]
+        self._account_names = dict(account_names)
+        self._account_colors = dict(account_colors)
+        self._goal_variants = set(goal_variants or ())
+
+    def transaction_id(self, row):
+        return int(self._ids[row])
+
+    def transaction_date(self, row):
+        return str(self._dates[row] or "")
+
+    def has_attachment(self, row):
+        return bool(self._has_file[row])
+
+    def _is_goal(self, ttype, tsub):
+        return ttype == 'goal_deposit' or (ttype in ['savings', 'savings_migration'] and tsub in self._goal_variants)
+
+    def _is_regular_savings(self, ttype, tsub):
+        return ttype in ['savings', 'savings_migration'] and tsub not in self._goal_variants
+
+    def cell_text(self, row, col):
+        """Tekst komórki dokładnie taki, jak pokazuje tabela."""
+        ttype = self._types[row]
+        tsub = self._subs[row]
+        if col == 0:
+            return str(self._ids[row])
+        if col == 1:
+            return str(self._dates[row])
+        if col == 2:
+            base_cat = _("Oszczędności") if self._is_regular_savings(ttype, tsub) else \
+                       (_("Cele") if self._is_goal(ttype, tsub) else \
+                       (_("Spłata Długu") if ttype == 'liability_repayment' else \
+                       (_("Zwrot od Dłużnika") if ttype == 'debtor_repayment' else self._cats[row])))
+            acc_name = self._account_names.get(self._accounts[row], _("Nieznane"))
+            return f"{base_cat} [{acc_name}]"
+        if col == 3:
+            return str(_("Migracja oszczędności") if ttype == 'savings_migration' else tsub)
+        if col == 4:
+            return f"{self._amounts[row]:.2f}"
+        if col == 5:
+            tdetails = self._details[row]
+            clean_details = tdetails.strip().replace("\n", ", ") if tdetails else ""
+            return f"📎  {clean_details}" if self._has_file[row] else clean_details
+        return ""
+
+    def cell_color(self, row, col):
+        """Kolor tekstu komórki (hex) taki, jak w tabeli; None - domyślny."""
+        if col == 2:
+            return self._account_colors.get(self._accounts[row], "#7f8c8d")
+        if col == 4:
+            ttype = self._types[row]
+            tamt = self._amounts[row]
+            if self._is_goal(ttype, self._subs[row]):
+                return "#c0392b" if tamt >= 0 else "#27ae60"
+            return "#27ae60" if ttype == "income" else ("#c0392b" if ttype == "expense" else ("#d35400" if ttype == "debtor_repayment" else "#2980b9"))
+        return None
+
+    def _color(self, clr):
+        color = self._colors.get(clr)
+        if color is None:
+            color = self._colors[clr] = QColor(clr)
+        return color
+
+
 class SyncWorker(QObject):
     finished = Signal(dict)
     failed = Signal(str)
 
-    def __init__(self, peer_url, payload, db):
+    def __init__(self, peer_url, device_urls, db):
         super().__init__()
         self.peer_url = peer_url
-        self.payload = payload
+        self.device_urls = device_urls
         self.db = db
 
     def run(self):
         try:
-            from budget_sync import download_missing_sync_attachments, normalize_sync_url, post_sync_payload
-            incoming = post_sync_payload(self.peer_url, self.payload)
-            local = self.db.import_sync_payload(incoming)
-            attachments = download_missing_sync_attachments(
-                self.db,
-                normalize_sync_url(self.peer_url),
-                incoming,
-            )
+            from budget_sync import sync_with_peer
+            result = sync_with_peer(self.db, self.peer_url, device_urls=self.device_urls)
             self.finished.emit({
-                "incoming": incoming,
-                "local": local,
-                "attachments": attachments,
+                "incoming": {"imported": result.get("imported_remote", {})},
+                "local": result.get("imported_local", {}),
+                "attachments": result.get("attachments", {}),
             })
         except Exception as error:
             self.failed.emit(str(error))
         except BaseException as error:
             self.failed.emit(str(error) or error.__class__.__name__)
 
+class TransactionsLoader(QRunnable):
+    """Liczy TransactionsSnapshot w puli wątków; wynik wraca sygnałem okna."""
+
+    def __init__(self, db, request, generation, cancel_event, on_done, on_error):
+        super().__init__()
+        self.db = db
+        self.request = request
+        self.generation = generation
+        self.cancel_event = cancel_event
+        self.on_done = on_done
+        self.on_error = on_error
+
+    def run(self):
+        try:
+            snapshot = compute_transactions_snapshot(self.db, self.request, self.cancel_event.is_set)
+        except SnapshotCancelled:
+            return
+        except Exception as error:
+            self.on_error.emit(self.generation, str(error))
+            return
+        if not self.cancel_event.is_set():
+            self.on_done.emit(self.generation, snapshot)
+
+class ReportJob(QRunnable):
+    """Generuje jeden plik PDF w puli wątków; postęp i wynik wracają sygnałami okna."""
+
+    def __init__(self, job_id, render, cancel_event, on_progress, on_finished):
+        super().__init__()
+        self.job_id = job_id
+        self.render = render
+        self.cancel_event = cancel_event
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+
+    def run(self):
+        from reports import ReportCancelled
+        try:
+            if self.cancel_event.is_set():
+                raise ReportCancelled()
+            self.render(self._progress, self.cancel_event.is_set)
+        except ReportCancelled:
+            self.on_finished.emit(self.job_id, "cancelled", "")
+        except Exception as error:
+            self.on_finished.emit(self.job_id, "error", str(error))
+        else:
+            self.on_finished.emit(self.job_id, "ok", "")
+
+    def _progress(self, percent, text):
+        self.on_progress.emit(self.job_id, percent, text)
+
 class BudgetApp(QMainWindow):
     remote_sync_received = Signal(dict)
+    transactions_computed = Signal(int, object)
+    transactions_failed = Signal(int, str)
+    report_progress = Signal(int, int, str)
+    report_finished = Signal(int, str, str)
 
     def __init__(self):
         super().__init__()
@@ -89,11 +280,26 @@ class BudgetApp(QMainWindow):
         self.week_offset = 0
         self.guide = None
         self.current_account_history_dialog = None
-        self._loading_transactions = False
-        self._pending_refresh = False
+        # Odświeżanie listy: liczenie w tle, nowsze żądanie unieważnia starsze
+        self.loader_pool = QThreadPool(self)
+        self.loader_pool.setMaxThreadCount(1)
+        self._load_generation = 0
+        self._load_cancel = None
+        # Generowanie PDF: kolejka w jednym wątku w tle. reportlab trzyma GIL,
+        # więc kilka wątków nie rozkłada pracy na rdzenie, tylko ją spowalnia
+        self.report_pool = QThreadPool(self)
+        self.report_pool.setMaxThreadCount(1)
+        self.report_jobs = {}
+        self.report_results = []
+        self.report_dialog = None
+        self._report_seq = 0
         self._footer_notice_token = 0
         self._footer_notice_restore_widget = None
         self.remote_sync_received.connect(self._remote_sync_received)
+        self.transactions_computed.connect(self._apply_transactions_snapshot)
+        self.transactions_failed.connect(self._transactions_load_failed)
+        self.report_progress.connect(self._report_progress)
+        self.report_finished.connect(self._report_finished)
 
         now = datetime.now()
         self.current_month = now.month
@@ -200,16 +406,17 @@ class BudgetApp(QMainWindow):
         self.btn_liabilities.setVisible(show_lia_mod)
         self.btn_debtors.setVisible(show_deb_mod)
 
+        # Jeden odczyt stanu długów na panel - ten sam służy do listy i widoczności
+        status_lia = self.db.get_liabilities_status()
+        status_deb = self.db.get_debtors_status()
         if show_lia_mod:
-            self.update_liabilities_display()
+            self.update_liabilities_display(status_lia)
         if show_deb_mod:
-            self.update_debtors_display()
+            self.update_debtors_display(status_deb)
 
-        status_lia = self.db.get_liabilities_status()
         has_active_lia = any((d['total'] - d['paid']) > 0.01 for d in status_lia)
         self.lia_box.setVisible(show_lia_mod and has_active_lia)
 
-        status_deb = self.db.get_debtors_status()
         has_active_deb = any((d['total'] - d['paid']) > 0.01 for d in status_deb)
         self.deb_box.setVisible(show_deb_mod and has_active_deb)
 
@@ -481,8 +688,7 @@ class BudgetApp(QMainWindow):
 
         try:
             server = self.ensure_sync_server()
-            payload = self.db.export_sync_payload()
-            payload["device_urls"] = server.urls()
+            device_urls = server.urls()
         except Exception as error:
             QMessageBox.warning(self, _("Synchronizacja"), _("Nie udało się przygotować danych:\n{}").format(error))
             return
@@ -492,7 +698,7 @@ class BudgetApp(QMainWindow):
             QApplication.setOverrideCursor(Qt.WaitCursor)
             self.sync_cursor_active = True
             self.sync_thread = QThread(self)
-            self.sync_worker = SyncWorker(peer_url, payload, self.db)
+            self.sync_worker = SyncWorker(peer_url, device_urls, self.db)
             self.sync_worker.moveToThread(self.sync_thread)
             self.sync_thread.started.connect(self.sync_worker.run)
             self.sync_worker.finished.connect(self.sync_worker.deleteLater)
@@ -1128,10 +1334,6 @@ class BudgetApp(QMainWindow):
             if self.active_filter_cat == category: self.active_filter_cat = None
             else: self.active_filter_cat = category
 
-        if self._loading_transactions:
-            self._pending_refresh = True
-            return
-
         self.update_timer.start(50)
 
     def _clear_layout_safely(self, layout):
@@ -1189,11 +1391,9 @@ class BudgetApp(QMainWindow):
         self.main_layout.addLayout(l)
 
     def setup_table(self):
-        self.table = QTableWidget()
-        self.table.setColumnCount(6)
-        self.table.setHorizontalHeaderLabels([
-            _("ID"), _("Data"), _("Kto/Kategoria"), _("Opis"), _("Kwota"), _("Szczegóły")
-        ])
+        self.table = QTableView()
+        self.table_model = TransactionTableModel(self.table)
+        self.table.setModel(self.table_model)
 
         header = self.table.horizontalHeader()
 
@@ -1211,6 +1411,8 @@ class BudgetApp(QMainWindow):
         self.table.setFocusPolicy(Qt.ClickFocus)
         self.table.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setWordWrap(False)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
 
         for i in [1, 2, 3, 4]:
             header.setSectionResizeMode(i, QHeaderView.Interactive)
@@ -1245,7 +1447,7 @@ class BudgetApp(QMainWindow):
             return
 
         idx = selected_rows[0].row()
-        tid = int(self.table.item(idx, 0).text())
+        tid = self.table_model.transaction_id(idx)
 
         menu = QMenu()
         menu.setStyleSheet(self.get_menu_style())
@@ -1766,7 +1968,7 @@ class BudgetApp(QMainWindow):
     def open_attachment_by_filename(self, filename):
         import os, subprocess
 
-        file_path = os.path.join(self.db.attachments_dir, filename)
+        file_path = self.db.attachment_path(filename) or ""
 
         if not os.path.exists(file_path):
             from PySide6.QtWidgets import QMessageBox
@@ -1795,78 +1997,64 @@ class BudgetApp(QMainWindow):
             print(f"Błąd otwierania załącznika: {e}")
 
     def load_transactions(self, refresh_panel=True):
-        import re
-        from datetime import datetime, timedelta
-        from PySide6.QtGui import QPalette
+        """
+        Zleca odświeżenie listy i panelu. Obliczenia (SQL, sumy, oszczędności)
+        idą w tle przez TransactionsLoader, widżety ustawia _apply_transactions_snapshot.
+        Wcześniejsze, jeszcze liczone żądanie zostaje anulowane.
+        """
+        import threading
+
+        if hasattr(self, 'update_timer'): self.update_timer.stop()
+        if self._load_cancel:
+            self._load_cancel.set()
+        self.loader_pool.clear()
+
+        self._load_generation += 1
+        self._load_cancel = threading.Event()
+        request = {
+            "month": self.get_current_month_str(),
+            "search": self.search_bar.text().lower().strip(),
+            "today": datetime.now().date(),
+            "week_offset": self.week_offset,
+            "active_filter_cat": self.active_filter_cat,
+            "weekly_filter_cat": self.weekly_filter_cat,
+            "refresh_panel": refresh_panel,
+        }
+        self.loader_pool.start(TransactionsLoader(
+            self.db, request, self._load_generation, self._load_cancel,
+            self.transactions_computed, self.transactions_failed
+        ))
 
-        if self._loading_transactions:
-            self._pending_refresh = True
+    def _transactions_load_failed(self, generation, message):
+        if generation != self._load_generation:
             return
+        print(f"Błąd odświeżania transakcji: {message}")
+        if not self.isVisible():
+            self.show()
 
-        self._loading_transactions = True
-        self.table.setUpdatesEnabled(False)
-        if hasattr(self, 'update_timer'): self.update_timer.stop()
-        try:
-            weekly_system_on = self.db.is_weekly_system_enabled()
+    def _apply_transactions_snapshot(self, generation, snap):
+        if generation != self._load_generation:
+            # Wynik starszego żądania - w drodze jest już nowszy
+            return
 
-            if weekly_system_on:
-                self.view_stack.setCurrentWidget(self.weekly_widget)
-                weekly_view_active = True
-            else:
-                self.view_stack.setCurrentWidget(self.monthly_widget)
-                weekly_view_active = False
+        request = snap.request
+        refresh_panel = request["refresh_panel"]
+        is_searching = bool(request["search"])
+        weekly_view_active = snap.weekly_view_active
 
+        self.table.setUpdatesEnabled(False)
+        try:
             if weekly_view_active:
+                self.view_stack.setCurrentWidget(self.weekly_widget)
                 self.active_filter_cat = None
             else:
+                self.view_stack.setCurrentWidget(self.monthly_widget)
                 self.weekly_filter_cat = None
 
-            m_str = self.get_current_month_str()
-            search = self.search_bar.text().lower().strip()
-            is_searching = bool(search)
-
-            today_real = datetime.now().date()
-            target_date = today_real + timedelta(weeks=self.week_offset)
-            start_of_displayed_week = target_date - timedelta(days=target_date.weekday())
-            end_of_displayed_week = start_of_displayed_week + timedelta(days=6)
-            s_date_str = start_of_displayed_week.strftime("%Y-%m-%d")
-            e_date_str = end_of_displayed_week.strftime("%Y-%m-%d")
-
-            reserved_for_week = 0.0
-            if weekly_system_on and weekly_view_active:
-                found, amt, cats = self.db.get_weekly_limit_for_week(s_date_str)
-                if found:
-                    if refresh_panel:
-                        self.update_weekly_stats(True, amt, cats)
-                    real_start = today_real - timedelta(days=today_real.weekday())
-                    if s_date_str == real_start.strftime("%Y-%m-%d"):
-                        real_expenses = self.db.get_expenses_in_range(s_date_str, e_date_str, cats)
-                        real_spent = sum(a for c, a in real_expenses)
-                        rem_real = amt - real_spent
-                        if rem_real > 0:
-                            reserved_for_week = rem_real
-                elif refresh_panel:
-                    self.update_weekly_stats(weekly_system_on, 0.0, None)
-            elif refresh_panel:
-                self.update_weekly_stats(False, 0, None)
-
-            search_amount = None
-            if is_searching:
-                for i, n in enumerate(MONTH_NAME):
-                    if n.lower() in search:
-                        search = search.replace(n.lower(), f"{i+1:02d}")
-                if "." in search:
-                    dm = re.match(r"(\d{1,2})\.(\d{1,2})\.(\d{4})", search)
-                    if dm:
-                        search = f"{dm.group(3)}-{int(dm.group(2)):02d}-{int(dm.group(1)):02d}"
-
-                clean_num_str = search.replace("zł", "").replace(" ", "").replace(",", ".").strip()
-                try:
-                    search_amount = float(clean_num_str)
-                except ValueError:
-                    search_amount = None
+            if refresh_panel:
+                self.update_weekly_stats(*snap.weekly_stats)
 
-            locked = self.db.is_month_locked(m_str)
+            locked = snap.locked
             for b in self.btns:
                 b.setEnabled(not locked)
 
@@ -1879,99 +2067,11 @@ class BudgetApp(QMainWindow):
                 self.btn_close_month.setStyleSheet(common_lock_style + "QPushButton { color: #ba4a00; border-color: #e67e22; } QPushButton:hover { background: #ba4a00; color: white; }")
 
             self.table.blockSignals(True)
-            rows = self.db.get_all_transactions()
-            accounts_data = self.db.get_accounts()
-            account_names = {acc[0]: acc[1] for acc in accounts_data}
-            account_colors = {a[0]: a[3] for a in accounts_data}
-            goal_variants = self.db.get_all_goal_subcategory_variants()
-
-            def is_legacy_goal_transaction(ttype, tsub):
-                return ttype in ['savings', 'savings_migration'] and tsub in goal_variants
-
-            def is_goal_transaction(ttype, tsub):
-                return ttype == 'goal_deposit' or is_legacy_goal_transaction(ttype, tsub)
-
-            def is_regular_savings_transaction(ttype, tsub):
-                return ttype in ['savings', 'savings_migration'] and not is_legacy_goal_transaction(ttype, tsub)
-
-            def calculate_monthly_savings_bucket(records):
-                bucket = 0.0
-                for record in sorted(records, key=lambda x: (x[1], x[0])):
-                    amount = record[5]
-                    if amount >= 0:
-                        bucket += amount
-                    else:
-                        bucket = max(0.0, bucket + amount)
-                return bucket
-
-            def extract_savings_account_name(record):
-                details = (record[6] or "").strip()
-                fallback_name = account_names.get(record[8], _("Nieznane"))
-
-                deposit_marker = _("Odłożono na:")
-                withdrawal_marker = _("Pobrano z oszczędności na")
-
-                if deposit_marker in details:
-                    tail = details.split(deposit_marker, 1)[1].strip()
-                elif withdrawal_marker in details:
-                    tail = details.split(withdrawal_marker, 1)[1].strip()
-                else:
-                    return fallback_name
-
-                extracted_name = tail.split(".", 1)[0].strip()
-                return extracted_name if extracted_name else fallback_name
-
-            def calculate_monthly_savings_distribution(records):
-                lots = []
-                activity_names = set()
-
-                for record in sorted(records, key=lambda x: (x[1], x[0])):
-                    amount = record[5]
-                    savings_account_name = extract_savings_account_name(record)
-                    activity_names.add(savings_account_name)
 
-                    if amount >= 0:
-                        lots.append({"account": savings_account_name, "remaining": amount})
-                        continue
-
-                    remaining = abs(amount)
-
-                    for lot in lots:
-                        if remaining <= 0:
-                            break
-                        if lot["remaining"] <= 0 or lot["account"] != savings_account_name:
-                            continue
-
-                        taken = min(remaining, lot["remaining"])
-                        lot["remaining"] -= taken
-                        remaining -= taken
-
-                    if remaining > 0:
-                        for lot in lots:
-                            if remaining <= 0:
-                                break
-                            if lot["remaining"] <= 0:
-                                continue
-
-                            taken = min(remaining, lot["remaining"])
-                            lot["remaining"] -= taken
-                            remaining -= taken
-
-                distribution = {}
-                for lot in lots:
-                    if lot["remaining"] <= 0:
-                        continue
-                    distribution[lot["account"]] = distribution.get(lot["account"], 0.0) + lot["remaining"]
-
-                return distribution, activity_names
-
-            stats_inc = stats_exp = stats_sav = stats_lia = stats_deb = 0.0
-            inc_map = {}
-            exp_map = {}
-            deb_map = {}
-            filtered_data = []
-            monthly_cash_savings_net = 0.0
-            total_monthly_savings_all = 0.0
+            stats_inc, stats_exp, stats_deb = snap.stats_inc, snap.stats_exp, snap.stats_deb
+            inc_map, exp_map, deb_map = snap.inc_map, snap.exp_map, snap.deb_map
+            prev_inc, prev_exp, prev_exp_map = snap.prev_inc, snap.prev_exp, snap.prev_exp_map
+            filtered_data = snap.rows
 
             current_filter = self.active_filter_cat or self.weekly_filter_cat
             if current_filter:
@@ -1979,141 +2079,14 @@ class BudgetApp(QMainWindow):
             else:
                 self.btn_filter.setText(_("🔍 Filtruj"))
 
-            for r in rows:
-                tid, tdate, ttype, tcat, tsub, tamt, tdetails, has_file, t_acc_id = r
-
-                if abs(tamt) < 0.001:
-                    continue
-
-                if tdate.startswith(m_str):
-                    if ttype == "income":
-                        stats_inc += tamt
-                        inc_map[tcat] = inc_map.get(tcat, 0) + tamt
-                    elif ttype == "expense":
-                        stats_exp += tamt
-                        exp_map[tcat] = exp_map.get(tcat, 0) + tamt
-                    elif is_regular_savings_transaction(ttype, tsub):
-                        total_monthly_savings_all += tamt
-                        monthly_cash_savings_net += tamt
-                    elif ttype == "liability_repayment":
-                        stats_lia += tamt
-                        stats_exp += tamt
-                        nazwa_dlugu = _("Spłata: {}").format(tsub)
-                        exp_map[nazwa_dlugu] = exp_map.get(nazwa_dlugu, 0) + tamt
-                    elif ttype == "debtor_repayment":
-                        stats_deb += tamt
-                        deb_map[tsub] = deb_map.get(tsub, 0) + tamt
-
-                show = False
-                if is_searching:
-                    txt_match = any(search in str(field).lower() for field in [tdate, tcat, tsub, tamt, tdetails])
-                    show = txt_match
-                elif weekly_view_active:
-                    if (not self.weekly_filter_cat or tcat == self.weekly_filter_cat) and s_date_str <= tdate <= e_date_str and ttype == 'expense':
-                        show = True
-                elif tdate.startswith(m_str):
-                    if not self.active_filter_cat:
-                        show = True
-                    else:
-                        if tcat == self.active_filter_cat:
-                            show = True
-                        elif ttype == 'liability_repayment' and _("Spłata: {}").format(tsub) == self.active_filter_cat:
-                            show = True
-                        elif is_regular_savings_transaction(ttype, tsub) and _("Oszczędności") == self.active_filter_cat:
-                            show = True
-                        elif is_goal_transaction(ttype, tsub) and _("Cele") == self.active_filter_cat:
-                            show = True
-
-                if show:
-                    if ttype in ("savings_migration", "account_transfer"):
-                        continue
-                    filtered_data.append(r)
-
-            palette_text = self.palette().color(QPalette.Text)
-            needed = len(filtered_data)
-            if self.table.rowCount() < needed:
-                self.table.setRowCount(needed)
-
-            for idx, r in enumerate(filtered_data):
-                tid, tdate, ttype, tcat, tsub, tamt, tdetails, has_file, t_acc_id = r
-                reverse_index = str(len(filtered_data) - idx)
-                self.table.setVerticalHeaderItem(idx, QTableWidgetItem(reverse_index))
-
-                def set_c(col, txt, clr=None):
-                    it = self.table.item(idx, col) or QTableWidgetItem()
-                    if not self.table.item(idx, col):
-                        self.table.setItem(idx, col, it)
-                    it.setText(str(txt))
-                    if clr:
-                        it.setForeground(QColor(clr))
-                    else:
-                        it.setForeground(palette_text)
-
-                set_c(0, tid)
-                set_c(1, tdate)
-
-                base_cat = _("Oszczędności") if is_regular_savings_transaction(ttype, tsub) else \
-                           (_("Cele") if is_goal_transaction(ttype, tsub) else \
-                           (_("Spłata Długu") if ttype == 'liability_repayment' else \
-                           (_("Zwrot od Dłużnika") if ttype == 'debtor_repayment' else tcat)))
-
-                acc_name = account_names.get(t_acc_id, _("Nieznane"))
-                acc_color = account_colors.get(t_acc_id, "#7f8c8d")
-                display_cat_with_acc = f"{base_cat} [{acc_name}]"
-
-                set_c(2, display_cat_with_acc, acc_color)
-                display_sub = _("Migracja oszczędności") if ttype == 'savings_migration' else tsub
-                set_c(3, display_sub)
-
-                if is_goal_transaction(ttype, tsub):
-                    t_clr = "#c0392b" if tamt >= 0 else "#27ae60"
-                else:
-                    t_clr = "#27ae60" if ttype == "income" else ("#c0392b" if ttype == "expense" else ("#d35400" if ttype == "debtor_repayment" else "#2980b9"))
-                set_c(4, f"{tamt:.2f}", t_clr)
-
-                clean_details = tdetails.strip().replace("\n", ", ") if tdetails else ""
-                display_text = f"📎  {clean_details}" if has_file else clean_details
-                set_c(5, display_text)
-                self.table.setRowHidden(idx, False)
-
-            for i in range(needed, self.table.rowCount()):
-                self.table.setRowHidden(i, True)
-
-            prev = self.db.get_net_balance_pln_before_date(f"{m_str}-01")
-            real_balance = prev + stats_inc + stats_deb - stats_exp - total_monthly_savings_all
-            display_balance = real_balance - reserved_for_week
-            final_bal = display_balance if abs(display_balance) > 0.001 else 0.0
-
-            final_sav_month = monthly_cash_savings_net if monthly_cash_savings_net > 0 else 0.0
-            final_sav_month = final_sav_month if abs(final_sav_month) > 0.001 else 0.0
+            self.table_model.set_rows(filtered_data, snap.account_names, snap.account_colors, snap.goal_variants)
 
             self._clear_layout_safely(self.accounts_balances_layout)
             self._clear_layout_safely(self.savings_month_details_layout)
             self._clear_layout_safely(self.savings_total_details_layout)
             self._clear_layout_safely(self.prev_balance_details_layout)
 
-            first_day_of_month = f"{m_str}-01"
-            total_prev_bal = 0.0
-            current_total_bal = 0.0
-
-            for acc_id, acc_name, initial_bal, acc_color in accounts_data:
-                acc_history = [r for r in rows if r[8] == acc_id]
-
-                acc_inc = sum(r[5] for r in acc_history if r[2] in ['income', 'debtor_repayment'])
-                acc_exp = sum(r[5] for r in acc_history if r[2] in ['expense', 'liability_repayment', 'savings', 'goal_deposit'])
-                acc_transfer = sum(r[5] for r in acc_history if r[2] == 'account_transfer')
-
-                acc_bal = initial_bal + acc_inc - acc_exp + acc_transfer
-                current_total_bal += acc_bal
-
-                hist_before = [r for r in acc_history if r[1] < first_day_of_month]
-                p_inc = sum(r[5] for r in hist_before if r[2] in ['income', 'debtor_repayment'])
-                p_exp = sum(r[5] for r in hist_before if r[2] in ['expense', 'liability_repayment', 'savings', 'goal_deposit'])
-                p_transfer = sum(r[5] for r in hist_before if r[2] == 'account_transfer')
-
-                acc_prev_bal = initial_bal + p_inc - p_exp + p_transfer
-                total_prev_bal += acc_prev_bal
-
+            for acc_id, acc_name, acc_bal, acc_prev_bal, acc_sav_total in snap.accounts:
                 if abs(acc_prev_bal) > 0.001:
                     p_lbl = QLabel(f"   • {acc_name}: {acc_prev_bal:.2f} zł")
                     p_lbl.setStyleSheet("font-size: 11px; color: gray; font-style: italic;")
@@ -2137,37 +2110,17 @@ class BudgetApp(QMainWindow):
                 acc_btn.clicked.connect(self._open_account_history_from_sender)
                 self.accounts_balances_layout.addWidget(acc_btn)
 
-                acc_sav_total = sum(r[5] for r in acc_history if is_regular_savings_transaction(r[2], r[4]))
                 if abs(acc_sav_total) > 0.001:
                     st_lbl = QLabel(f"   • {acc_name}: <b>{acc_sav_total:.2f} zł</b>")
                     st_lbl.setStyleSheet("font-size: 12px; color: #21618C;")
                     self.savings_total_details_layout.addWidget(st_lbl)
 
-            final_bal_display = current_total_bal - reserved_for_week
+            final_bal_display = snap.current_total_bal - snap.reserved_for_week
             final_bal_display = final_bal_display if abs(final_bal_display) > 0.001 else 0.0
             self.lbl_balance.setText(_("SALDO ŁĄCZNE: {:.2f} zł").format(final_bal_display))
-            self.lbl_prev_balance.setText(_("z poprzedniego miesiąca: {:.2f} zł").format(total_prev_bal))
+            self.lbl_prev_balance.setText(_("z poprzedniego miesiąca: {:.2f} zł").format(snap.total_prev_bal))
 
-            final_sav_total = self.db.get_total_savings_cash_pln()
-            final_sav_total = final_sav_total if abs(final_sav_total) > 0.001 else 0.0
-
-            month_records = [
-                r for r in rows
-                if r[1].startswith(m_str) and r[2] == 'savings' and not is_legacy_goal_transaction(r[2], r[4])
-            ]
-            deposits = sum(r[5] for r in month_records if r[5] > 0)
-            withdrawals = abs(sum(r[5] for r in month_records if r[5] < 0))
-            month_distribution, month_activity_names = calculate_monthly_savings_distribution(month_records)
-            net_savings = sum(month_distribution.values())
-
-            ordered_month_names = [acc[1] for acc in accounts_data]
-            extra_month_names = sorted(n for n in month_activity_names if n not in ordered_month_names)
-
-            for acc_name in ordered_month_names + extra_month_names:
-                if acc_name not in month_activity_names:
-                    continue
-
-                acc_sav_month = month_distribution.get(acc_name, 0.0)
+            for acc_name, acc_sav_month in snap.savings_month:
                 sm_lbl = QLabel(f"{acc_name}: {acc_sav_month:.2f} zł")
                 sm_lbl.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
                 sm_lbl.setContentsMargins(0, 0, 0, 0)
@@ -2176,30 +2129,10 @@ class BudgetApp(QMainWindow):
 
             self.lbl_savings_month.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
             self.lbl_savings_month.setText(
-                _("Oszczędności (ten msc): {:.2f} zł<br><span style='font-size: 9pt; font-weight: normal;'>Wpłaty {:.2f} zł - Wypłaty {:.2f} zł</span>").format(net_savings, deposits, withdrawals)
+                _("Oszczędności (ten msc): {:.2f} zł<br><span style='font-size: 9pt; font-weight: normal;'>Wpłaty {:.2f} zł - Wypłaty {:.2f} zł</span>").format(snap.net_savings, snap.deposits, snap.withdrawals)
             )
 
-            self.lbl_savings_total.setText(_("OSZCZĘDNOŚCI ŁĄCZNIE: {:.2f} zł").format(final_sav_total))
-
-            y, m_idx = map(int, m_str.split('-'))
-            prev_m_str = f"{y-1}-12" if m_idx == 1 else f"{y}-{m_idx-1:02d}"
-
-            prev_inc = 0.0
-            prev_exp = 0.0
-            prev_exp_map = {}
-
-            for r in rows:
-                r_date, r_type, r_cat, r_sub, r_amt = r[1], r[2], r[3], r[4], r[5]
-                if r_date.startswith(prev_m_str):
-                    if r_type in ['income', 'debtor_repayment']:
-                        prev_inc += r_amt
-                    elif r_type == 'expense':
-                        prev_exp += r_amt
-                        prev_exp_map[r_cat] = prev_exp_map.get(r_cat, 0.0) + r_amt
-                    elif r_type == 'liability_repayment':
-                        prev_exp += r_amt
-                        nazwa_d = _("Spłata: {}").format(r_sub)
-                        prev_exp_map[nazwa_d] = prev_exp_map.get(nazwa_d, 0.0) + r_amt
+            self.lbl_savings_total.setText(_("OSZCZĘDNOŚCI ŁĄCZNIE: {:.2f} zł").format(snap.savings_total))
 
             def get_arrow(curr, old, inv=False):
                 if old <= 0:
@@ -2244,7 +2177,7 @@ class BudgetApp(QMainWindow):
                 m_data = sorted([(c, a) for c, a in exp_map.items() if a > 0], key=lambda x: x[1], reverse=True)
                 for r_dict in self.monthly_rows:
                     r_dict['row'].hide()
-                total_p = stats_exp + stats_sav
+                total_p = stats_exp
                 for idx, (cat, amt) in enumerate(m_data):
                     if idx >= len(self.monthly_rows):
                         break
@@ -2309,9 +2242,7 @@ class BudgetApp(QMainWindow):
             self.check_bills_notifications()
 
             if is_searching or self.active_filter_cat or self.weekly_filter_cat:
-                f_inc = sum(r[5] for r in filtered_data if r[2] in ['income', 'debtor_repayment'])
-                f_exp = sum(r[5] for r in filtered_data if r[2] in ['expense', 'liability_repayment'])
-                f_sav = sum(r[5] for r in filtered_data if is_regular_savings_transaction(r[2], r[4]))
+                f_inc, f_exp, f_sav = snap.filtered_totals
 
                 f_diff = f_inc - (f_exp + f_sav)
                 count = len(filtered_data)
@@ -2341,10 +2272,6 @@ class BudgetApp(QMainWindow):
         finally:
             self.table.blockSignals(False)
             self.table.setUpdatesEnabled(True)
-            self._loading_transactions = False
-            if self._pending_refresh:
-                self._pending_refresh = False
-                self.update_timer.start(0)
 
             if not self.isVisible():
                 self.show()
@@ -2357,7 +2284,7 @@ class BudgetApp(QMainWindow):
         msg = _("Czy na pewno chcesz usunąć {} wpisów?").format(len(sel)) if len(sel) > 1 else _("Czy na pewno chcesz usunąć ten wpis?")
         if QMessageBox.Yes == QMessageBox.question(self, _("Usuń"), msg):
             for idx in sorted(sel, reverse=True):
-                self.db.delete_transaction(int(self.table.item(idx.row(), 0).text()))
+                self.db.delete_transaction(self.table_model.transaction_id(idx.row()))
             self.schedule_update()
 
     def toggle_accounts_visibility(self):
@@ -2484,10 +2411,11 @@ class BudgetApp(QMainWindow):
                 )
             self.schedule_update()
 
-    def update_debtors_display(self):
+    def update_debtors_display(self, debts=None):
         self._clear_layout_safely(self.debtors_layout)
 
-        debts = self.db.get_debtors_status()
+        if debts is None:
+            debts = self.db.get_debtors_status()
 
         active_count = 0
         today = datetime.now().date()
@@ -2621,7 +2549,7 @@ class BudgetApp(QMainWindow):
         if not selected: return
 
         idx = selected[0].row()
-        tid = int(self.table.item(idx, 0).text())
+        tid = self.table_model.transaction_id(idx)
         row_data = None
 
         for r in self.db.get_all_transactions():
@@ -2751,14 +2679,19 @@ class BudgetApp(QMainWindow):
     def open_report_dialog(self):
         from reports import PDFReportGenerator
         from dialogs import ReportSelectionDialog
-        from PySide6.QtWidgets import QMessageBox, QFileDialog
+        from PySide6.QtWidgets import QFileDialog
         import os
 
         if not self.pdf_gen: self.pdf_gen = PDFReportGenerator()
+        # Czcionki rejestrujemy tutaj, zanim generator trafi do kilku wątków naraz
+        self.pdf_gen.register_system_font()
         d = ReportSelectionDialog(self)
 
         if d.exec():
             last_dir = self.settings.value("last_report_dir", os.path.expanduser("~"))
+            if d.selected_type == "months":
+                self.gen_rep_batch(d.selected_year_str, last_dir)
+                return
             fn = f"budzet_{d.selected_month_str.replace('-','_')}.pdf" if d.selected_type=="month" else f"bilans_{d.selected_year_str}.pdf"
 
             dialog = QFileDialog(self, _("Zapisz"), os.path.join(last_dir, fn), "PDF (*.pdf)")
@@ -2769,26 +2702,54 @@ class BudgetApp(QMainWindow):
                 path = dialog.selectedFiles()[0]
 
                 if path:
-                    if os.path.exists(path):
-                        msg = QMessageBox(self)
-                        msg.setIcon(QMessageBox.Question)
-                        msg.setWindowTitle(_("Potwierdzenie"))
-                        msg.setText(_("Plik już istnieje. Czy chcesz go zastąpić?"))
-                        msg.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
-
-                        msg.button(QMessageBox.Yes).setText(_("Tak"))
-                        msg.button(QMessageBox.No).setText(_("Nie"))
-
-                        if msg.exec() == QMessageBox.No:
-                            return
+                    if os.path.exists(path) and not self._confirm_overwrite(_("Plik już istnieje. Czy chcesz go zastąpić?")):
+                        return
 
                     self.settings.setValue("last_report_dir", os.path.dirname(path))
                     self.gen_rep(path, d.selected_month_str if d.selected_type=="month" else d.selected_year_str, d.selected_month_name, d.selected_type=="year")
 
-    def gen_rep(self, path, d_str, m_name, ann):
+    def _confirm_overwrite(self, text):
         from PySide6.QtWidgets import QMessageBox
 
-        tr = self.db.get_year_transactions(d_str) if ann else [t for t in self.db.get_all_transactions() if t[1].startswith(d_str)]
+        msg = QMessageBox(self)
+        msg.setIcon(QMessageBox.Question)
+        msg.setWindowTitle(_("Potwierdzenie"))
+        msg.setText(text)
+        msg.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+
+        msg.button(QMessageBox.Yes).setText(_("Tak"))
+        msg.button(QMessageBox.No).setText(_("Nie"))
+
+        return msg.exec() != QMessageBox.No
+
+    def gen_rep_batch(self, year_str, last_dir):
+        """Raporty wszystkich miesięcy roku jako osobne pliki - kolejka report_pool generuje je po kolei w tle."""
+        from PySide6.QtWidgets import QFileDialog
+        import os
+
+        folder = QFileDialog.getExistingDirectory(self, _("Wybierz folder na raporty"), last_dir)
+        if not folder:
+            return
+
+        months = [(f"{year_str}-{m:02d}", MONTH_NAME[m - 1]) for m in range(1, 13)]
+        paths = [os.path.join(folder, f"budzet_{m_str.replace('-', '_')}.pdf") for m_str, m_name in months]
+        existing = [p for p in paths if os.path.exists(p)]
+        if existing and not self._confirm_overwrite(_("Część plików już istnieje ({}). Czy chcesz je zastąpić?").format(len(existing))):
+            return
+
+        self.settings.setValue("last_report_dir", folder)
+        for (m_str, m_name), path in zip(months, paths):
+            self.gen_rep(path, m_str, m_name, False)
+
+    def gen_rep(self, path, d_str, m_name, ann):
+        """Zbiera dane nagłówka raportu i dodaje plik do kolejki; PDF powstaje w tle."""
+        if ann:
+            year = int(d_str[:4])
+            date_from, date_to = f"{year:04d}", f"{year + 1:04d}"
+        else:
+            date_from, date_to = month_bounds(d_str)
+        # Generator czyta wiersze kursorem przy każdym przebiegu (podsumowanie, rejestr)
+        tr = lambda: self.db.iter_report_transactions(date_from, date_to)
 
         t_txt = _("Raport Roczny {}").format(d_str) if ann else _("Raport Miesięczny: {} {}").format(m_name, d_str.split('-')[0])
 
@@ -2799,55 +2760,85 @@ class BudgetApp(QMainWindow):
             first_day_of_year = f"{d_str}-01-01"
             prev_balance = self.db.get_net_balance_pln_before_date(first_day_of_year)
 
-        goal_variants = self.db.get_all_goal_subcategory_variants()
-        exp, sav, lia, deb, inc = {}, 0, 0, 0, 0
-        for r in tr:
-            v = r[5]
-            ttype, tcat, tsub = r[2], r[3], r[4]
-            if ttype == 'income': inc += v
-            elif ttype == 'expense': exp[tcat] = exp.get(tcat, 0) + v
-            elif ttype == 'goal_deposit':
-                if v >= 0:
-                    exp[_("Cele")] = exp.get(_("Cele"), 0) + v
-                else:
-                    inc += abs(v)
-            elif ttype == 'savings' and tsub not in goal_variants:
-                sav += v
-            elif ttype == 'savings_migration':
-                if v > 0 and tsub not in goal_variants:
-                    sav += v
-            elif ttype == 'liability_repayment': lia += v
-            elif ttype == 'debtor_repayment': deb += v
-
-        raw_accounts = self.db.get_accounts()
-        acc_data = []
-
-
-        for acc_id, acc_name, initial_bal, unused_clr in raw_accounts:
-            cursor = self.db.conn.execute(
-                "SELECT type, amount FROM transactions WHERE account_id=?", (acc_id,)
+        acc_data = [(b['id'], b['name'], b['balance']) for b in self.db.get_balances()]
+        liabilities_status = self.db.get_liabilities_status()
+        pdf_gen = self.pdf_gen
+
+        def render(progress, is_cancelled):
+            pdf_gen.generate(
+                filename=path,
+                title=t_txt,
+                transactions=tr,
+                prev_balance=prev_balance,
+                liabilities_status=liabilities_status,
+                accounts_data=acc_data,
+                progress=progress,
+                is_cancelled=is_cancelled
             )
-            acc_history = cursor.fetchall()
-
-            acc_inc = sum(r[1] for r in acc_history if r[0] in ['income', 'debtor_repayment'])
-            acc_exp = sum(r[1] for r in acc_history if r[0] in ['expense', 'liability_repayment', 'savings', 'goal_deposit'])
-            acc_transfer = sum(r[1] for r in acc_history if r[0] == 'account_transfer')
 
-            acc_bal = initial_bal + acc_inc - acc_exp + acc_transfer
+        self._enqueue_report(t_txt, path, render, _("Zapisano: {}").format(path))
 
-            acc_data.append((acc_id, acc_name, acc_bal))
+    def _enqueue_report(self, title, path, render, success_text):
+        """
+        Dodaje plik do kolejki PDF. render(progress, is_cancelled) wykonuje się
+        w puli report_pool - nie może dotykać widżetów ani modelu tabeli.
+        """
+        from dialogs import ReportProgressDialog
+        import threading
+
+        if self.report_dialog is None:
+            self.report_dialog = ReportProgressDialog(self, on_cancel=self.cancel_reports)
+        self._report_seq += 1
+        job_id = self._report_seq
+        cancel_event = threading.Event()
+        self.report_jobs[job_id] = {"path": path, "cancel": cancel_event, "success_text": success_text}
+        self.report_dialog.add_job(job_id, title)
+        self.report_dialog.show()
+        self.report_pool.start(ReportJob(job_id, render, cancel_event, self.report_progress, self.report_finished))
+
+    def cancel_reports(self):
+        # Zadania czekające w kolejce też dostają sygnał - kończą się od razu jako anulowane
+        for job in self.report_jobs.values():
+            job["cancel"].set()
+
+    def _report_progress(self, job_id, percent, text):
+        if self.report_dialog and job_id in self.report_jobs:
+            self.report_dialog.update_job(job_id, percent, text)
+
+    def _report_finished(self, job_id, status, message):
+        from PySide6.QtWidgets import QMessageBox
+        import os
 
-        success = self.pdf_gen.generate(
-            filename=path,
-            title=t_txt,
-            transactions=tr,
-            prev_balance=prev_balance,
-            liabilities_status=self.db.get_liabilities_status(),
-            accounts_data=acc_data
-        )
+        job = self.report_jobs.pop(job_id, None)
+        if job is None:
+            return
+        job["status"] = status
+        job["error"] = message
+        self.report_results.append(job)
+        if status == "error":
+            print(f"Błąd generowania PDF ({job['path']}): {message}")
+        if self.report_dialog:
+            self.report_dialog.finish_job(job_id, status)
+        if self.report_jobs:
+            return
 
-        if success:
-            QMessageBox.information(self, _("Sukces"), _("Zapisano: {}").format(path))
+        # Kolejka pusta - jedno podsumowanie dla całej partii
+        results, self.report_results = self.report_results, []
+        if self.report_dialog:
+            self.report_dialog.hide()
+            self.report_dialog.deleteLater()
+            self.report_dialog = None
+
+        failed = [r for r in results if r["status"] == "error"]
+        saved = [r for r in results if r["status"] == "ok"]
+        if failed:
+            details = "\n".join(f"{os.path.basename(r['path'])}: {r['error']}" for r in failed)
+            QMessageBox.warning(self, _("Błąd"), f"{_('Błąd generowania PDF')}: {details}")
+        if len(saved) == 1:
+            QMessageBox.information(self, _("Sukces"), saved[0]["success_text"])
+        elif saved:
+            folders = sorted({os.path.dirname(r["path"]) for r in saved})
+            QMessageBox.information(self, _("Sukces"), _("Zapisano plików PDF: {} ({})").format(len(saved), ", ".join(folders)))
 
     def update_goals_display(self):
         self._clear_layout_safely(self.goals_list_layout)
@@ -2917,10 +2908,11 @@ class BudgetApp(QMainWindow):
         msg.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
         if msg.exec() == QMessageBox.Yes: self.db.delete_goal(goal_id); self.schedule_update()
 
-    def update_liabilities_display(self):
+    def update_liabilities_display(self, debts=None):
         self._clear_layout_safely(self.liabilities_layout)
 
-        debts = self.db.get_liabilities_status()
+        if debts is None:
+            debts = self.db.get_liabilities_status()
 
         active_count = 0
         today = datetime.now().date()
@@ -2987,32 +2979,16 @@ class BudgetApp(QMainWindow):
     def export_selected_to_pdf(self):
         from config import _
         from PySide6.QtWidgets import QFileDialog, QMessageBox, QDialog, QVBoxLayout, QHBoxLayout, QLabel, QPushButton
-        from PySide6.QtGui import QColor
-        from reportlab.lib.pagesizes import A4
-        from reportlab.lib import colors
-        from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-        from reportlab.lib.styles import ParagraphStyle
-        from reportlab.pdfbase import pdfmetrics
-        from reportlab.pdfbase.ttfonts import TTFont
-        from reportlab.pdfgen import canvas
+        from reports import SelectionPDFGenerator
         import os
-        import io
+        from importlib.util import find_spec
 
-        try:
-            try:
-                from pypdf import PdfWriter as PdfMerger, PdfReader
-            except ImportError:
-                from pypdf import PdfMerger, PdfReader
-        except ImportError:
-            try:
-                from PyPDF2 import PdfMerger, PdfReader
-            except ImportError:
-                QMessageBox.critical(self, _("Błąd"), _("Brak biblioteki pypdf. Zainstaluj ją: sudo pacman -S python-pypdf"))
-                return
+        # Biblioteki używa SelectionPDFGenerator w tle - tu tylko sprawdzamy, czy są
+        if not (find_spec("pypdf") or find_spec("PyPDF2")):
+            QMessageBox.critical(self, _("Błąd"), _("Brak biblioteki pypdf. Zainstaluj ją: sudo pacman -S python-pypdf"))
+            return
 
-        try:
-            from PIL import Image
-        except ImportError:
+        if not find_spec("PIL"):
             QMessageBox.critical(self, _("Błąd"), _("Brak biblioteki Pillow. Zainstaluj ją: sudo pacman -S python-pillow"))
             return
 
@@ -3070,215 +3046,60 @@ class BudgetApp(QMainWindow):
             if diag.exec() == QDialog.Rejected:
                 return
 
-        try:
-            font_name = 'Helvetica'
-            bold_font_name = 'Helvetica-Bold'
-            paths = ["/usr/share/fonts/TTF/DejaVuSans.ttf", "/usr/share/fonts/dejavu/DejaVuSans.ttf", "DejaVuSans.ttf"]
-            b_paths = ["/usr/share/fonts/TTF/DejaVuSans-Bold.ttf", "/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf", "DejaVuSans-Bold.ttf"]
-
-            for p in paths:
-                if os.path.exists(p):
-                    pdfmetrics.registerFont(TTFont('DejaVuSans', p))
-                    font_name = 'DejaVuSans'
-                    break
-            for p in b_paths:
-                if os.path.exists(p):
-                    pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', p))
-                    bold_font_name = 'DejaVuSans-Bold'
-                    break
-                else:
-                    bold_font_name = font_name
-
-            main_pdf_buffer = io.BytesIO()
-            doc = SimpleDocTemplate(main_pdf_buffer, pagesize=A4)
-
-            elements = []
-            polish_style = ParagraphStyle('PolishStyle', fontName=font_name, fontSize=10, leading=12)
-            title_style = ParagraphStyle('TitleStyle', fontName=font_name, fontSize=16, alignment=1)
-
-            elements.append(Paragraph(_("Zestawienie wybranych transakcji"), title_style))
-            elements.append(Spacer(1, 20))
-
-            data = [[_("Nr"), _("Data"), _("Typ"), _("Kategoria / Cel"), _("Szczegóły"), _("Kwota")]]
-
-            total_inc = 0.0
-            total_exp = 0.0
-
-            selected_rows = sorted([idx.row() for idx in selected_indexes])
-
-            files_to_attach = []
-
-            for row in selected_rows:
-                tid = int(self.table.item(row, 0).text())
-                date = self.table.item(row, 1).text()
-                t_display_type = self.table.item(row, 2).text()
-                cat = self.table.item(row, 3).text()
-
-                rok_miesiac = date[:7]
-                all_rows_in_month = []
-                for r in range(self.table.rowCount()):
-                    row_date = self.table.item(r, 1).text()
-                    if row_date.startswith(rok_miesiac):
-                        all_rows_in_month.append(int(self.table.item(r, 0).text()))
-
-                all_rows_in_month.reverse()
-                try:
-                    num_in_month = all_rows_in_month.index(tid) + 1
-                except ValueError:
-                    num_in_month = "???"
-
-                details_item = self.table.item(row, 5)
-                details_text = details_item.text().replace("📎", "").strip() if details_item else ""
-
-                if details_item and "📎" in details_item.text():
-                    files_to_attach.append({'id': tid, 'date': date, 'cat': cat})
-
-                amt_item = self.table.item(row, 4)
-                if not amt_item: continue
-                amt_str = amt_item.text().replace(" zł", "").replace(" ", "").replace(",", ".")
-                try:
-                    val = abs(float(amt_str))
-                except:
-                    val = 0.0
-
-                is_income = False
-                cell_color = amt_item.foreground().color()
-
-                if cell_color.name().lower() in ["#27ae60", "#2ecc71"]:
-                    is_income = True
-                elif any(x in t_display_type.lower() for x in ["wpływ", "przychód", "zwrot", "repayment", "income"]):
-                    is_income = True
-                if is_income:
-                    total_inc += val
-                    display_val = f"{val:.2f}"
-                else:
-                    total_exp += val
-                    display_val = f"-{val:.2f}"
-
-                data.append([str(num_in_month), date, t_display_type, cat, Paragraph(details_text, polish_style), display_val])
-
-            data.append(["", "", "", "", ""])
-
-            if total_inc > 0:
-                data.append(["", "", "", _("SUMA WPŁYWÓW:"), f"{total_inc:.2f} zł"])
-            if total_exp > 0:
-                data.append(["", "", "", _("SUMA WYDATKÓW:"), f"-{total_exp:.2f} zł"])
-            if total_inc > 0 and total_exp > 0:
-                balance = total_inc - total_exp
-                data.append(["", "", "", _("BILANS:"), f"{balance:.2f} zł"])
-
-            t = Table(data, colWidths=[30, 65, 75, 90, 180, 80])
-
-            footer_rows = 0
-            if total_inc > 0: footer_rows += 1
-            if total_exp > 0: footer_rows += 1
-            if total_inc > 0 and total_exp > 0: footer_rows += 1
-
-            ts = TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, -1), font_name),
-                ('FONTSIZE', (0, 0), (-1, -1), 10),
-                ('GRID', (0, 0), (-1, -(footer_rows + 1)), 0.5, colors.grey),
-                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ('ALIGN', (4, 1), (4, -1), 'LEFT'),
-                ('ALIGN', (5, 1), (5, -1), 'RIGHT'),
-            ])
-
-            if footer_rows > 0:
-                ts.add('FONTNAME', (4, -footer_rows), (-1, -1), bold_font_name)
-
-            t.setStyle(ts)
-            elements.append(t)
-            doc.build(elements)
-
-            merger = PdfMerger()
-            main_pdf_buffer.seek(0)
-            merger.append(main_pdf_buffer)
-
-            miesiace = {
-                '01': 'stycznia', '02': 'lutego', '03': 'marca', '04': 'kwietnia',
-                '05': 'maja', '06': 'czerwca', '07': 'lipca', '08': 'sierpnia',
-                '09': 'września', '10': 'października', '11': 'listopada', '12': 'grudnia'
-            }
-
-            for f_info in files_to_attach:
-                raw_bytes = self.db.get_attachment(f_info['id'])
-                if not raw_bytes: continue
-
-                try:
-                    rok_miesiac = f_info['date'][:7]
-                    all_rows_in_month = []
-                    for r in range(self.table.rowCount()):
-                        row_date = self.table.item(r, 1).text()
-                        if row_date.startswith(rok_miesiac):
-                            all_rows_in_month.append(int(self.table.item(r, 0).text()))
-
-                    all_rows_in_month.reverse()
-                    try:
-                        num = all_rows_in_month.index(f_info['id']) + 1
-                    except ValueError:
-                        num = "???"
-
-                    d = f_info['date'][8:10].lstrip('0')
-                    m_idx = f_info['date'][5:7]
-                    y = f_info['date'][:4]
-                    data_str = f"{d} {miesiace.get(m_idx, '')} {y}"
-                    tekst_naglowka = f"ZAŁĄCZNIK DO TRANSAKCJI nr {num} | z dnia {data_str}"
-
-                    if raw_bytes.startswith(b"%PDF"):
-                        input_pdf = PdfReader(io.BytesIO(raw_bytes))
-                        page = input_pdf.pages[0]
-                    else:
-                        img = Image.open(io.BytesIO(raw_bytes))
-                        if img.mode != 'RGB': img = img.convert('RGB')
-                        img_pdf_buf = io.BytesIO()
-                        img.save(img_pdf_buf, format="PDF")
-                        img_pdf_buf.seek(0)
-                        img_reader = PdfReader(img_pdf_buf)
-                        page = img_reader.pages[0]
-
-                    p_width = float(page.mediabox.width)
-                    p_height = float(page.mediabox.height)
-
-                    dynamic_font_size = p_width * 0.018
-
-                    margin_x = p_width * 0.03
-                    margin_y = p_height * 0.03
-
-                    overlay_buffer = io.BytesIO()
-                    c = canvas.Canvas(overlay_buffer, pagesize=(p_width, p_height))
-
-                    c.setFont(bold_font_name, dynamic_font_size)
-                    c.setFillColorRGB(0.3, 0.3, 0.3)
-
-                    c.drawRightString(p_width - margin_x, p_height - (margin_y + dynamic_font_size), tekst_naglowka)
-                    c.save()
-
-                    overlay_buffer.seek(0)
-                    overlay_reader = PdfReader(overlay_buffer)
-
-                    page.merge_page(overlay_reader.pages[0])
-
-                    merger.add_page(page)
-
-                except Exception as e:
-                    print(f"Błąd stemplowania ID {f_info['id']}: {e}")
-
-            with open(path, "wb") as f_final:
-                merger.write(f_final)
-            merger.close()
-
-            QMessageBox.information(self, _("Sukces"), _("PDF został wygenerowany pomyślnie (wraz z załącznikami)."))
+        # Wiersze zbieramy tutaj (wątek GUI) - generator w tle nie dotyka modelu tabeli
+        model = self.table_model
+        # Numer transakcji w jej miesiącu (od najstarszej), liczony raz dla całej tabeli
+        month_numbers = {}
+        month_counts = {}
+        for r in range(model.rowCount() - 1, -1, -1):
+            rok_miesiac = model.transaction_date(r)[:7]
+            month_counts[rok_miesiac] = month_counts.get(rok_miesiac, 0) + 1
+            month_numbers[model.transaction_id(r)] = month_counts[rok_miesiac]
+
+        rows = []
+        for row in sorted(idx.row() for idx in selected_indexes):
+            tid = model.transaction_id(row)
+            t_display_type = model.cell_text(row, 2)
+
+            amt_str = model.cell_text(row, 4).replace(" zł", "").replace(" ", "").replace(",", ".")
+            try:
+                val = abs(float(amt_str))
+            except:
+                val = 0.0
+
+            is_income = False
+            if (model.cell_color(row, 4) or "").lower() in ["#27ae60", "#2ecc71"]:
+                is_income = True
+            elif any(x in t_display_type.lower() for x in ["wpływ", "przychód", "zwrot", "repayment", "income"]):
+                is_income = True
+
+            rows.append({
+                'num': month_numbers.get(tid, "???"),
+                'id': tid,
+                'date': model.transaction_date(row),
+                'type': t_display_type,
+                'cat': model.cell_text(row, 3),
+                'details': model.cell_text(row, 5).replace("📎", "").strip(),
+                'value': val,
+                'is_income': is_income,
+                'has_attachment': model.has_attachment(row),
+            })
 
+        try:
+            generator = SelectionPDFGenerator()
         except Exception as e:
             QMessageBox.warning(self, _("Błąd"), f"{_('Błąd generowania PDF')}: {str(e)}")
+            return
+
+        def render(progress, is_cancelled):
+            generator.generate(path, rows, self.db.get_attachment, progress=progress, is_cancelled=is_cancelled)
+
+        self._enqueue_report(_("Zestawienie wybranych transakcji"), path, render,
+                             _("PDF został wygenerowany pomyślnie (wraz z załącznikami)."))
 
 
     def closeEvent(self, e):
-        import time
-        from dialogs import ProcessingDialog
+        from dialogs import run_backup_with_progress
         from config import save_table_widths
 
         if self.guide:
@@ -3292,6 +3113,12 @@ class BudgetApp(QMainWindow):
         self.update_timer.stop()
         if hasattr(self, "search_timer"):
             self.search_timer.stop()
+        if self._load_cancel:
+            self._load_cancel.set()
+        self.loader_pool.clear()
+        self.loader_pool.waitForDone(3000)
+        self.cancel_reports()
+        self.report_pool.waitForDone(5000)
 
         if self.sync_thread and self.sync_thread.isRunning():
             self.sync_thread.quit()
@@ -3319,12 +3146,7 @@ class BudgetApp(QMainWindow):
 
         cfg = self.db.get_config("backup_config")
         if cfg and cfg.get("auto_backup"):
-            pd = ProcessingDialog(self, _("Zamykanie"), _("Backup..."))
-            pd.show()
-            QApplication.processEvents()
-            time.sleep(0.5)
-            self.db.perform_backup()
-            pd.close()
+            run_backup_with_progress(self, self.db, _("Zamykanie"), _("Backup..."))
 
         cleanup_temp_files()
 
@@ -0,0 +1,446 @@
+import threading
+from datetime import timedelta
+
+from config import _
+
+
+def month_bounds(month_str):
+    """Zwraca (początek, początek następnego miesiąca) dla 'YYYY-MM' jako zakres dat SQL."""
+    year, month = map(int, str(month_str).split("-")[:2])
+    if month == 12:
+        return f"{year:04d}-{month:02d}", f"{year + 1:04d}-01"
+    return f"{year:04d}-{month:02d}", f"{year:04d}-{month + 1:02d}"
+
+
+class DashboardAggregates:
+    """
+    Sumy transakcji trzymane w pamięci: miesiąc x konto x typ x kategoria x opis.
+    Po pierwszym pełnym odczycie bazy aktualizowane są tylko zmienione wiersze,
+    więc odświeżenie pulpitu nie przechodzi już przez całą historię.
+
+    Każda zmiana dostaje kolejny numer (_seq). Odczyt z migawki (pinned = numer
+    z chwili jej przypięcia) nie widzi zmian nowszych, więc zostawia je brudne
+    do następnej synchronizacji zamiast utrwalić stare wartości.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._loaded = False
+        self._seq = 0
+        self._reset_seq = 0
+        self._dirty_ids = {}
+        self._rows = {}
+        self._months = {}
+        self._totals = {}
+
+    def invalidate(self):
+        """Wymusza pełne przeliczenie przy następnym odczycie (zmiany masowe)."""
+        with self.lock:
+            self._seq += 1
+            self._reset_seq = self._seq
+            self._loaded = False
+            self._dirty_ids.clear()
+
+    def touch(self, *row_ids):
+        """Oznacza wiersze transactions do ponownego odczytu (insert/update/delete)."""
+        with self.lock:
+            self._seq += 1
+            # Także przed pierwszym odczytem - pełny odczyt z migawki może jeszcze trwać
+            for row_id in row_ids:
+                if row_id is not None:
+                    self._dirty_ids[int(row_id)] = self._seq
+
+    def mark(self):
+        """Numer ostatniej zmiany - wołany pod write_lock przy przypinaniu migawki."""
+        with self.lock:
+            return self._seq
+
+    def sync(self, conn, pinned=None):
+        """
+        Doprowadza sumy do stanu bazy: pełny odczyt albo tylko brudne wiersze.
+        pinned=None - conn widzi wszystkie zmiany (połączenie zapisujące).
+        """
+        with self.lock:
+            if not self._loaded:
+                self._rebuild(conn, pinned)
+                return
+            if not self._dirty_ids:
+                return
+            ids = list(self._dirty_ids)
+            self._forget_dirty(pinned)
+            for row_id in ids:
+                self._remove(row_id)
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ",".join("?" for _unused in chunk)
+                for row in conn.execute(f"""
+                    SELECT id, date, type, category, subcategory, amount, account_id
+                    FROM transactions
+                    WHERE id IN ({placeholders})
+                """, chunk).fetchall():
+                    self._add(row)
+
+    def _forget_dirty(self, pinned):
+        """Czyści wiersze, których zmiana jest już w odczytanej migawce."""
+        if pinned is None:
+            self._dirty_ids.clear()
+        else:
+            self._dirty_ids = {row_id: seq for row_id, seq in self._dirty_ids.items() if seq > pinned}
+
+    def _rebuild(self, conn, pinned=None):
+        self._rows = {}
+        self._months = {}
+        self._totals = {}
+        self._forget_dirty(pinned)
+        for row in conn.execute("""
+            SELECT id, date, type, category, subcategory, amount, account_id
+            FROM transactions
+        """):
+            self._add(row)
+        # Migawka sprzed invalidate() nie jest już pełnym stanem bazy
+        self._loaded = pinned is None or pinned >= self._reset_seq
+
+    def _add(self, row):
+        row_id, date, t_type, category, subcategory, amount, account_id = row
+        amount = amount or 0.0
+        if abs(amount) < 0.001:
+            return
+        month = str(date or "")[:7]
+        key = (account_id, t_type, category, subcategory)
+        self._rows[row_id] = (month, key, amount)
+        cells = self._months.setdefault(month, {})
+        self._bump(cells, key, amount, 1)
+        self._bump(self._totals, key, amount, 1)
+
+    def _remove(self, row_id):
+        entry = self._rows.pop(row_id, None)
+        if not entry:
+            return
+        month, key, amount = entry
+        cells = self._months.get(month)
+        if cells is not None:
+            self._bump(cells, key, -amount, -1)
+            if not cells:
+                del self._months[month]
+        self._bump(self._totals, key, -amount, -1)
+
+    @staticmethod
+    def _bump(target, key, amount, count):
+        cell = target.get(key)
+        if cell is None:
+            cell = target[key] = [0.0, 0]
+        cell[0] += amount
+        cell[1] += count
+        if cell[1] <= 0:
+            del target[key]
+
+    def month_cells(self, month_str):
+        """Lista ((account_id, type, category, subcategory), suma) dla miesiąca 'YYYY-MM'."""
+        with self.lock:
+            return [(key, cell[0]) for key, cell in self._months.get(month_str, {}).items()]
+
+    def total_cells(self, from_month=None):
+        """
+        Sumy z całej historii albo (z from_month) tylko z miesięcy >= from_month.
+        Saldo "przed miesiącem" to całość minus ten ogon - zwykle kilka miesięcy.
+        """
+        with self.lock:
+            if from_month is None:
+                return [(key, cell[0]) for key, cell in self._totals.items()]
+            merged = {}
+            for month, cells in self._months.items():
+                if month < from_month:
+                    continue
+                for key, cell in cells.items():
+                    merged[key] = merged.get(key, 0.0) + cell[0]
+            return list(merged.items())
+
+
+def _savings_account_name(record, account_names):
+    details = (record[6] or "").strip()
+    fallback_name = account_names.get(record[8], _("Nieznane"))
+
+    deposit_marker = _("Odłożono na:")
+    withdrawal_marker = _("Pobrano z oszczędności na")
+
+    if deposit_marker in details:
+        tail = details.split(deposit_marker, 1)[1].strip()
+    elif withdrawal_marker in details:
+        tail = details.split(withdrawal_marker, 1)[1].strip()
+    else:
+        return fallback_name
+
+    extracted_name = tail.split(".", 1)[0].strip()
+    return extracted_name if extracted_name else fallback_name
+
+
+def monthly_savings_distribution(records, account_names):
+    """
+    Rozkład oszczędności miesiąca na konta: wypłata zdejmuje najpierw wpłaty
+    z tego samego konta, potem z pozostałych. Zwraca (rozkład, nazwy z ruchem).
+    """
+    lots = []
+    activity_names = set()
+
+    for record in sorted(records, key=lambda x: (x[1], x[0])):
+        amount = record[5]
+        savings_account_name = _savings_account_name(record, account_names)
+        activity_names.add(savings_account_name)
+
+        if amount >= 0:
+            lots.append({"account": savings_account_name, "remaining": amount})
+            continue
+
+        remaining = abs(amount)
+
+        for lot in lots:
+            if remaining <= 0:
+                break
+            if lot["remaining"] <= 0 or lot["account"] != savings_account_name:
+                continue
+
+            taken = min(remaining, lot["remaining"])
+            lot["remaining"] -= taken
+            remaining -= taken
+
+        if remaining > 0:
+            for lot in lots:
+                if remaining <= 0:
+                    break
+                if lot["remaining"] <= 0:
+                    continue
+
+                taken = min(remaining, lot["remaining"])
+                lot["remaining"] -= taken
+                remaining -= taken
+
+    distribution = {}
+    for lot in lots:
+        if lot["remaining"] <= 0:
+            continue
+        distribution[lot["account"]] = distribution.get(lot["account"], 0.0) + lot["remaining"]
+
+    return distribution, activity_names
+
+
+class TransactionsSnapshot:
+    """
+    Wszystko, co okno główne pokazuje po odświeżeniu listy transakcji:
+    wiersze tabeli, salda kont, oszczędności i porównanie z poprzednim miesiącem.
+    Liczone poza wątkiem GUI przez compute_transactions_snapshot.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.weekly_view_active = False
+        self.active_filter_cat = None
+        self.weekly_filter_cat = None
+        self.weekly_stats = (False, 0, None)
+        self.reserved_for_week = 0.0
+        self.locked = False
+        self.rows = []
+        self.account_names = {}
+        self.account_colors = {}
+        self.goal_variants = set()
+        self.stats_inc = self.stats_exp = self.stats_lia = self.stats_deb = 0.0
+        self.inc_map = {}
+        self.exp_map = {}
+        self.deb_map = {}
+        self.accounts = []
+        self.current_total_bal = 0.0
+        self.total_prev_bal = 0.0
+        self.savings_total = 0.0
+        self.savings_month = []
+        self.net_savings = self.deposits = self.withdrawals = 0.0
+        self.prev_inc = self.prev_exp = 0.0
+        self.prev_exp_map = {}
+        self.filtered_totals = (0.0, 0.0, 0.0)
+
+
+class SnapshotCancelled(Exception):
+    """Nowsze odświeżenie zastąpiło to liczenie."""
+
+
+def compute_transactions_snapshot(db, request, is_cancelled=None):
+    """
+    Część obliczeniowa odświeżenia okna głównego (bez widżetów).
+    request: month ('YYYY-MM'), search, today (date), week_offset,
+    active_filter_cat, weekly_filter_cat. is_cancelled() sprawdzane między
+    etapami - nowsze żądanie przerywa liczenie wyjątkiem SnapshotCancelled.
+    Wszystkie odczyty idą przez jedną migawkę z puli db.read_snapshot(),
+    więc liczenie nie blokuje zapisu i nie widzi niezatwierdzonych zmian.
+    """
+    with db.read_snapshot() as (conn, pinned):
+        return _compute_transactions_snapshot(db, conn, pinned, request, is_cancelled)
+
+
+def _compute_transactions_snapshot(db, conn, pinned, request, is_cancelled):
+    def checkpoint():
+        if is_cancelled and is_cancelled():
+            raise SnapshotCancelled()
+
+    snap = TransactionsSnapshot(request)
+    m_str = request["month"]
+    search = request["search"]
+    is_searching = bool(search)
+
+    weekly_system_on = db.is_weekly_system_enabled(conn)
+    weekly_view_active = weekly_system_on
+    snap.weekly_view_active = weekly_view_active
+    snap.active_filter_cat = None if weekly_view_active else request.get("active_filter_cat")
+    snap.weekly_filter_cat = request.get("weekly_filter_cat") if weekly_view_active else None
+
+    today_real = request["today"]
+    target_date = today_real + timedelta(weeks=request.get("week_offset", 0))
+    start_of_displayed_week = target_date - timedelta(days=target_date.weekday())
+    end_of_displayed_week = start_of_displayed_week + timedelta(days=6)
+    s_date_str = start_of_displayed_week.strftime("%Y-%m-%d")
+    e_date_str = end_of_displayed_week.strftime("%Y-%m-%d")
+
+    if weekly_system_on and weekly_view_active:
+        found, amt, cats = db.get_weekly_limit_for_week(s_date_str, conn=conn)
+        if found:
+            snap.weekly_stats = (True, amt, cats)
+            real_start = today_real - timedelta(days=today_real.weekday())
+            if s_date_str == real_start.strftime("%Y-%m-%d"):
+                real_expenses = db.get_expenses_in_range(s_date_str, e_date_str, cats, conn=conn)
+                real_spent = sum(a for c, a in real_expenses)
+                rem_real = amt - real_spent
+                if rem_real > 0:
+                    snap.reserved_for_week = rem_real
+        else:
+            snap.weekly_stats = (weekly_system_on, 0.0, None)
+
+    snap.locked = db.is_month_locked(m_str, conn=conn)
+    checkpoint()
+
+    month_start, month_end = month_bounds(m_str)
+    month_rows = db.get_transactions_in_range(month_start, month_end, conn=conn)
+    if is_searching:
+        # Daty, miesiące i kwoty są filtrami SQL, słowa idą przez indeks FTS
+        rows = db.search_transactions(search, conn=conn)
+    elif weekly_view_active:
+        week_end_excl = (end_of_displayed_week + timedelta(days=1)).strftime("%Y-%m-%d")
+        rows = db.get_transactions_in_range(s_date_str, week_end_excl, conn=conn)
+    else:
+        rows = month_rows
+    accounts_data = db.get_accounts(conn)
+    account_names = {acc[0]: acc[1] for acc in accounts_data}
+    snap.account_names = account_names
+    snap.account_colors = {a[0]: a[3] for a in accounts_data}
+    goal_variants = db.get_all_goal_subcategory_variants(conn)
+    snap.goal_variants = goal_variants
+    checkpoint()
+
+    def is_legacy_goal_transaction(ttype, tsub):
+        return ttype in ['savings', 'savings_migration'] and tsub in goal_variants
+
+    def is_goal_transaction(ttype, tsub):
+        return ttype == 'goal_deposit' or is_legacy_goal_transaction(ttype, tsub)
+
+    def is_regular_savings_transaction(ttype, tsub):
+        return ttype in ['savings', 'savings_migration'] and not is_legacy_goal_transaction(ttype, tsub)
+
+    for (c_acc_id, ttype, tcat, tsub), tamt in db.get_month_aggregates(m_str, conn=conn, pinned=pinned):
+        if ttype == "income":
+            snap.stats_inc += tamt
+            snap.inc_map[tcat] = snap.inc_map.get(tcat, 0) + tamt
+        elif ttype == "expense":
+            snap.stats_exp += tamt
+            snap.exp_map[tcat] = snap.exp_map.get(tcat, 0) + tamt
+        elif ttype == "liability_repayment":
+            snap.stats_lia += tamt
+            snap.stats_exp += tamt
+            nazwa_dlugu = _("Spłata: {}").format(tsub)
+            snap.exp_map[nazwa_dlugu] = snap.exp_map.get(nazwa_dlugu, 0) + tamt
+        elif ttype == "debtor_repayment":
+            snap.stats_deb += tamt
+            snap.deb_map[tsub] = snap.deb_map.get(tsub, 0) + tamt
+
+    active_filter_cat = snap.active_filter_cat
+    weekly_filter_cat = snap.weekly_filter_cat
+    filtered_data = []
+    for r in rows:
+        tid, tdate, ttype, tcat, tsub, tamt, tdetails, has_file, t_acc_id = r
+
+        if abs(tamt) < 0.001:
+            continue
+
+        show = False
+        if is_searching:
+            show = True
+        elif weekly_view_active:
+            if (not weekly_filter_cat or tcat == weekly_filter_cat) and s_date_str <= tdate <= e_date_str and ttype == 'expense':
+                show = True
+        elif tdate.startswith(m_str):
+            if not active_filter_cat:
+                show = True
+            else:
+                if tcat == active_filter_cat:
+                    show = True
+                elif ttype == 'liability_repayment' and _("Spłata: {}").format(tsub) == active_filter_cat:
+                    show = True
+                elif is_regular_savings_transaction(ttype, tsub) and _("Oszczędności") == active_filter_cat:
+                    show = True
+                elif is_goal_transaction(ttype, tsub) and _("Cele") == active_filter_cat:
+                    show = True
+
+        if show:
+            if ttype in ("savings_migration", "account_transfer"):
+                continue
+            filtered_data.append(r)
+    snap.rows = filtered_data
+    checkpoint()
+
+    acc_savings = {}
+    final_sav_total = 0.0
+    for (c_acc_id, ttype, tcat, tsub), tamt in db.get_history_aggregates(conn=conn, pinned=pinned):
+        if is_regular_savings_transaction(ttype, tsub):
+            acc_savings[c_acc_id] = acc_savings.get(c_acc_id, 0.0) + tamt
+            final_sav_total += tamt
+
+    # Stan obecny i stan na początek wybranego miesiąca
+    for b in db.get_balances(as_of=f"{m_str}-01", conn=conn):
+        snap.current_total_bal += b['balance']
+        snap.total_prev_bal += b['as_of_balance']
+        snap.accounts.append((b['id'], b['name'], b['balance'], b['as_of_balance'], acc_savings.get(b['id'], 0.0)))
+    snap.savings_total = final_sav_total if abs(final_sav_total) > 0.001 else 0.0
+    checkpoint()
+
+    month_records = [
+        r for r in month_rows
+        if r[2] == 'savings' and not is_legacy_goal_transaction(r[2], r[4])
+    ]
+    snap.deposits = sum(r[5] for r in month_records if r[5] > 0)
+    snap.withdrawals = abs(sum(r[5] for r in month_records if r[5] < 0))
+    month_distribution, month_activity_names = monthly_savings_distribution(month_records, account_names)
+    snap.net_savings = sum(month_distribution.values())
+
+    ordered_month_names = [acc[1] for acc in accounts_data]
+    extra_month_names = sorted(n for n in month_activity_names if n not in ordered_month_names)
+    snap.savings_month = [
+        (acc_name, month_distribution.get(acc_name, 0.0))
+        for acc_name in ordered_month_names + extra_month_names
+        if acc_name in month_activity_names
+    ]
+
+    y, m_idx = map(int, m_str.split('-'))
+    prev_m_str = f"{y-1}-12" if m_idx == 1 else f"{y}-{m_idx-1:02d}"
+    for (c_acc_id, r_type, r_cat, r_sub), r_amt in db.get_month_aggregates(prev_m_str, conn=conn, pinned=pinned):
+        if r_type in ['income', 'debtor_repayment']:
+            snap.prev_inc += r_amt
+        elif r_type == 'expense':
+            snap.prev_exp += r_amt
+            snap.prev_exp_map[r_cat] = snap.prev_exp_map.get(r_cat, 0.0) + r_amt
+        elif r_type == 'liability_repayment':
+            snap.prev_exp += r_amt
+            nazwa_d = _("Spłata: {}").format(r_sub)
+            snap.prev_exp_map[nazwa_d] = snap.prev_exp_map.get(nazwa_d, 0.0) + r_amt
+
+    if is_searching or active_filter_cat or weekly_filter_cat:
+        snap.filtered_totals = (
+            sum(r[5] for r in filtered_data if r[2] in ['income', 'debtor_repayment']),
+            sum(r[5] for r in filtered_data if r[2] in ['expense', 'liability_repayment']),
+            sum(r[5] for r in filtered_data if is_regular_savings_transaction(r[2], r[4])),
+        )
+    return snap
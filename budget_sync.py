@@ -1,16 +1,25 @@
 import json
 import hashlib
+import http.client
 import os
 import socket
 import tempfile
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import urllib.error
 import urllib.request
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from urllib.parse import quote, unquote, urlparse, urlunparse
+from urllib.parse import parse_qs, quote, unquote, urlparse, urlunparse
 
 MAX_SYNC_BODY_BYTES = 32 * 1024 * 1024
 MAX_SYNC_ATTACHMENT_BYTES = 512 * 1024 * 1024
+# Strumień NDJSON: jedna linia = jeden rekord, limit dotyczy pojedynczej linii, nie całości
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+MAX_SYNC_LINE_BYTES = 4 * 1024 * 1024
+SYNC_IMPORT_BATCH = 500
+SYNC_FEATURES = ["delta", "ndjson"]
+# Równoległe pobieranie załączników (każdy wątek trzyma własne połączenie keep-alive)
+SYNC_DOWNLOAD_WORKERS = 4
 
 
 class BudgetSyncServer:
@@ -21,7 +30,8 @@ class BudgetSyncServer:
         self.on_sync = on_sync
         self.httpd = None
         self.thread = None
-        self.lock = threading.RLock()
+        # Wspólny z bazą zamek zapisu; odczyty idą przez pulę połączeń bez niego
+        self.lock = getattr(db, "write_lock", None) or threading.RLock()
 
     def start(self):
         if self.httpd:
@@ -30,6 +40,9 @@ class BudgetSyncServer:
         outer = self
 
         class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 pozwala pobierać wiele załączników jednym połączeniem
+            protocol_version = "HTTP/1.1"
+
             def log_message(self, fmt, *args):
                 return
 
@@ -45,6 +58,26 @@ class BudgetSyncServer:
                 self.end_headers()
                 self.wfile.write(body)
 
+            def _wants_stream(self):
+                accept = str(self.headers.get("Accept") or "")
+                query = parse_qs(urlparse(self.path).query)
+                return NDJSON_CONTENT_TYPE in accept or (query.get("format") or [""])[0] == "ndjson"
+
+            def _send_stream(self, since=None, extra=None, peer=""):
+                self.send_response(200)
+                self.send_header("Content-Type", NDJSON_CONTENT_TYPE + "; charset=utf-8")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                write_sync_stream(outer.db, self.wfile, since=since, extra=extra, peer=peer)
+
+            def _peer_base(self, payload):
+                """Adres drugiego urządzenia: z jego device_urls, a bez nich z adresu klienta."""
+                peer_base = peer_base_url_from_payload(payload)
+                if not peer_base and self.client_address:
+                    peer_base = f"http://{self.client_address[0]}:8765"
+                return peer_base
+
             def _send_file(self, path):
                 if not path or not os.path.isfile(path):
                     self._send_json(404, {"ok": False, "error": "Nie znaleziono załącznika"})
@@ -65,28 +98,36 @@ class BudgetSyncServer:
                 path = self.path.split("?", 1)[0].rstrip("/") or "/"
                 if path.startswith("/attachment/"):
                     sync_id = unquote(path[len("/attachment/"):])
-                    with outer.lock:
-                        file_path = outer.db.sync_attachment_file(sync_id)
-                    self._send_file(file_path)
+                    self._send_file(outer.db.sync_attachment_file(sync_id))
                     return
                 if path == "/status":
                     self._send_json(200, {
                         "ok": True,
                         "service": "BudgetApp Sync LAN",
                         "urls": outer.urls(),
+                        "features": SYNC_FEATURES,
                     })
                     return
                 if path == "/transactions":
-                    with outer.lock:
-                        payload = outer.db.export_sync_payload()
-                    self._send_json(200, payload)
+                    query = parse_qs(urlparse(self.path).query)
+                    since = parse_sync_cursor((query.get("since") or [None])[0])
+                    if self._wants_stream():
+                        self._send_stream(since=since)
+                        return
+                    self._send_json(200, outer.db.export_sync_payload(since=since))
                     return
                 self._send_json(404, {"ok": False, "error": "Nieznany endpoint"})
 
             def do_POST(self):
+                # Ciało żądania mogło nie zostać przeczytane - nie używamy połączenia ponownie
+                self.close_connection = True
                 if self.path.split("?", 1)[0].rstrip("/") != "/sync":
                     self._send_json(404, {"ok": False, "error": "Nieznany endpoint"})
                     return
+                content_type = str(self.headers.get("Content-Type") or "")
+                if content_type.startswith(NDJSON_CONTENT_TYPE):
+                    self._handle_stream_sync()
+                    return
                 try:
                     length = int(self.headers.get("Content-Length", "0"))
                     if length > MAX_SYNC_BODY_BYTES:
@@ -94,16 +135,18 @@ class BudgetSyncServer:
                         return
                     raw = self.rfile.read(length).decode("utf-8")
                     incoming = json.loads(raw) if raw else {}
+                    peer_base = self._peer_base(incoming)
                     with outer.lock:
-                        imported = outer.db.import_sync_payload(incoming)
-                    peer_base = peer_base_url_from_payload(incoming)
-                    if not peer_base and self.client_address:
-                        peer_base = f"http://{self.client_address[0]}:8765"
+                        imported = outer.db.import_sync_payload(incoming, origin=peer_base)
                     attachments = download_missing_sync_attachments(outer.db, peer_base, incoming, lock=outer.lock)
                     imported["attachments_downloaded"] = attachments.get("downloaded", 0)
                     imported["attachment_errors"] = attachments.get("errors", 0)
-                    with outer.lock:
-                        payload = outer.db.export_sync_payload()
+                    # Z kursorem "since" odsyłamy tylko zmiany; bez niego (np. Android) pełny eksport
+                    since = parse_sync_cursor(incoming.get("since"))
+                    payload = outer.db.export_sync_payload(since=since, peer=peer_base)
+                    ack = parse_sync_cursor(incoming.get("cursor"))
+                    if ack is not None:
+                        payload["ack"] = ack
                     payload["ok"] = True
                     payload["imported"] = imported
                     self._send_json(200, payload)
@@ -111,6 +154,38 @@ class BudgetSyncServer:
                 except Exception as exc:
                     self._send_json(500, {"ok": False, "error": str(exc)})
 
+            def _handle_stream_sync(self):
+                try:
+                    if self.headers.get("Content-Length") is None:
+                        self._send_json(411, {"ok": False, "error": "Brak Content-Length"})
+                        return
+                    length = int(self.headers.get("Content-Length", "0"))
+                    lines = _limited_lines(self.rfile, length)
+                    imported, meta, attachment_rows = read_sync_stream(
+                        outer.db, lines, lock=outer.lock, origin=self._peer_base
+                    )
+                    peer_base = self._peer_base(meta)
+                    attachments = download_missing_sync_attachments(
+                        outer.db, peer_base, {"transactions": attachment_rows}, lock=outer.lock
+                    )
+                    imported["attachments_downloaded"] = attachments.get("downloaded", 0)
+                    imported["attachment_errors"] = attachments.get("errors", 0)
+                except Exception as exc:
+                    self._send_json(500, {"ok": False, "error": str(exc)})
+                    return
+
+                extra = {"ok": True, "imported": imported}
+                ack = parse_sync_cursor(meta.get("cursor"))
+                if ack is not None:
+                    extra["ack"] = ack
+                try:
+                    self._send_stream(since=parse_sync_cursor(meta.get("since")), extra=extra, peer=peer_base)
+                except Exception:
+                    # Nagłówki już poszły - druga strona wykryje brak rekordu "end"
+                    self.close_connection = True
+                    return
+                outer._notify_sync_received(imported, attachments, self.client_address)
+
         self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
         self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
         self.thread.start()
@@ -194,6 +269,207 @@ def peer_base_url_from_payload(payload):
     return ""
 
 
+def parse_sync_cursor(value):
+    """Kursor delta sync (nieujemna rewizja) albo None, gdy brak lub nieczytelny."""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        cursor = int(value)
+    except (TypeError, ValueError):
+        return None
+    return cursor if cursor >= 0 else None
+
+
+def prepare_sync_payload(db, peer_url):
+    """
+    Payload dla drugiego urządzenia: przy pierwszej wymianie pełny, potem tylko
+    zmiany od rewizji potwierdzonej przez drugą stronę, z prośbą o jej zmiany
+    od ostatnio otrzymanego kursora.
+    """
+    base_url = normalize_sync_url(peer_url)
+    state = db.get_sync_cursor(base_url)
+    payload = db.export_sync_payload(since=parse_sync_cursor(state.get("acked")), peer=base_url)
+    since = parse_sync_cursor(state.get("since"))
+    if since is not None:
+        payload["since"] = since
+    return payload
+
+
+def remember_sync_cursor(db, peer_url, payload, incoming):
+    """Zapisuje znaczniki po udanym imporcie odpowiedzi drugiego urządzenia."""
+    base_url = normalize_sync_url(peer_url)
+    remote_cursor = parse_sync_cursor(incoming.get("cursor")) if isinstance(incoming, dict) else None
+    if remote_cursor is None:
+        # Urządzenie bez delta sync - zostajemy przy pełnej wymianie
+        db.save_sync_cursor(base_url)
+        return
+    previous = parse_sync_cursor(db.get_sync_cursor(base_url).get("since"))
+    if previous is not None and remote_cursor < previous:
+        # Licznik drugiej strony się cofnął (np. przywrócona kopia) - następna wymiana pełna
+        db.save_sync_cursor(base_url)
+        return
+    ack = parse_sync_cursor(incoming.get("ack"))
+    sent = parse_sync_cursor(payload.get("cursor")) if isinstance(payload, dict) else None
+    db.save_sync_cursor(base_url, since=remote_cursor, acked=ack if ack is not None and ack == sent else None)
+
+
+def _limited_lines(stream, length):
+    """Czyta dokładnie length bajtów ciała żądania, linia po linii."""
+    remaining = max(0, int(length))
+    while remaining > 0:
+        line = stream.readline(min(remaining, MAX_SYNC_LINE_BYTES + 1))
+        if not line:
+            break
+        remaining -= len(line)
+        yield line
+
+
+def write_sync_stream(db, out, since=None, extra=None, lock=None, peer=""):
+    """
+    Zapisuje eksport synchronizacji jako NDJSON: rekord "meta", potem wiersze
+    sekcji prosto z kursora bazy i na końcu "end". Zwraca wysłane meta.
+    peer - adres odbiorcy: zmiany, które od niego przyszły, nie są odsyłane.
+    """
+    def produce():
+        sent_meta = {}
+        for kind, row in db.iter_sync_records(since, peer):
+            if kind == "meta":
+                row = dict(row)
+                row.update(extra or {})
+                sent_meta = row
+                record = {"kind": "meta", "data": row}
+            else:
+                record = {"kind": kind, "row": row}
+            out.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        out.write(b'{"kind": "end"}\n')
+        out.flush()
+        return sent_meta
+
+    return _with_optional_lock(lock, produce)
+
+
+def read_sync_stream(db, lines, lock=None, batch_size=SYNC_IMPORT_BATCH, origin=""):
+    """
+    Czyta strumień NDJSON do pliku tymczasowego, a po rekordzie "end" importuje
+    go porcjami po batch_size wierszy jednej sekcji w jednej transakcji
+    (import_sync_batches). Przerwany transfer (brak "end") kończy się wyjątkiem
+    i niczego nie zmienia w bazie. origin - adres nadawcy albo funkcja
+    wyliczająca go z rekordu meta.
+    Zwraca (liczniki jak import_sync_payload, meta, opisy załączników do pobrania).
+    """
+    meta = {}
+    attachment_rows = []
+    finished = False
+
+    with tempfile.TemporaryFile() as spool:
+        for raw in lines:
+            if len(raw) > MAX_SYNC_LINE_BYTES:
+                raise RuntimeError("Rekord synchronizacji jest za duży")
+            raw = raw.strip()
+            if not raw:
+                continue
+            record = json.loads(raw.decode("utf-8") if isinstance(raw, bytes) else raw)
+            if not isinstance(record, dict):
+                continue
+            kind = record.get("kind")
+            if kind == "meta":
+                data = record.get("data") or {}
+                if isinstance(data, dict):
+                    if data.get("ok") is False:
+                        raise RuntimeError(str(data.get("error") or "Urządzenie zwróciło błąd synchronizacji"))
+                    meta.update(data)
+                continue
+            if kind == "end":
+                finished = True
+                break
+            if kind not in db.SYNC_SECTIONS:
+                continue
+            row = record.get("row")
+            spool.write(json.dumps([kind, row], ensure_ascii=False).encode("utf-8") + b"\n")
+            if kind == "transactions" and isinstance(row, dict) and row.get("attachment_present"):
+                attachment_rows.append({
+                    key: row.get(key)
+                    for key in ("sync_id", "attachment_present", "attachment_name", "attachment_size", "attachment_sha256")
+                    if key in row
+                })
+        if not finished:
+            raise RuntimeError("Przerwany strumień synchronizacji")
+
+        def batches():
+            spool.seek(0)
+            batch_kind = None
+            batch = []
+            for line in spool:
+                kind, row = json.loads(line.decode("utf-8"))
+                if batch and (kind != batch_kind or len(batch) >= batch_size):
+                    yield batch_kind, batch
+                    batch = []
+                batch_kind = kind
+                batch.append(row)
+            if batch:
+                yield batch_kind, batch
+
+        source = origin(meta) if callable(origin) else origin
+        totals = _with_optional_lock(lock, lambda: db.import_sync_batches(batches(), origin=source))
+    return totals, meta, attachment_rows
+
+
+def peer_supports_stream(peer_url, timeout=5):
+    """Sprawdza w /status, czy drugie urządzenie obsługuje strumień NDJSON."""
+    base_url = normalize_sync_url(peer_url)
+    if not base_url:
+        return False
+    try:
+        request = urllib.request.Request(base_url + "/status", method="GET", headers={"Accept": "application/json"})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status = json.loads(response.read(64 * 1024).decode("utf-8"))
+    except Exception:
+        return False
+    return isinstance(status, dict) and "ndjson" in (status.get("features") or [])
+
+
+def post_sync_stream(db, peer_url, since=None, extra=None, timeout=20):
+    """
+    Strumieniowy odpowiednik post_sync_payload: eksport idzie do pliku tymczasowego
+    (stała pamięć, znana długość), odpowiedź jest importowana porcjami w locie.
+    Zwraca (wysłane meta, liczniki importu lokalnego, meta odpowiedzi, opisy załączników).
+    """
+    base_url = normalize_sync_url(peer_url)
+    if not base_url:
+        raise ValueError("Brak adresu drugiego urządzenia")
+
+    with tempfile.TemporaryFile(prefix="budget-sync-") as body:
+        sent_meta = write_sync_stream(db, body, since=since, extra=extra, peer=base_url)
+        size = body.tell()
+        body.seek(0)
+        request = urllib.request.Request(
+            base_url + "/sync",
+            data=body,
+            method="POST",
+            headers={
+                "Content-Type": NDJSON_CONTENT_TYPE + "; charset=utf-8",
+                "Content-Length": str(size),
+                "Accept": NDJSON_CONTENT_TYPE,
+            },
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                imported, incoming_meta, attachment_rows = read_sync_stream(
+                    db, response, lock=getattr(db, "write_lock", None), origin=base_url
+                )
+        except urllib.error.HTTPError as exc:
+            raw = exc.read(64 * 1024).decode("utf-8", errors="replace")
+            message = raw
+            try:
+                decoded = json.loads(raw) if raw else {}
+                if isinstance(decoded, dict):
+                    message = decoded.get("error") or decoded.get("message") or raw
+            except Exception:
+                pass
+            raise RuntimeError(message or f"HTTP {exc.code}") from exc
+    return sent_meta, imported, incoming_meta, attachment_rows
+
+
 def _sha256_file(path):
     digest = hashlib.sha256()
     with open(path, "rb") as f:
@@ -209,8 +485,101 @@ def _with_optional_lock(lock, func):
         return func()
 
 
-def download_missing_sync_attachments(db, peer_url, payload, lock=None, timeout=120):
-    """Dociąga załączniki opisane w payloadzie bez wkładania ich do JSON-a."""
+class _AttachmentFetcher:
+    """Pobiera pliki z /attachment/<sync_id>, jedno połączenie keep-alive na wątek."""
+
+    def __init__(self, base_url, timeout):
+        parsed = urlparse(base_url)
+        self.https = parsed.scheme == "https"
+        self.host = parsed.hostname or ""
+        self.port = parsed.port
+        self.prefix = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+        self.conn_lock = threading.Lock()
+
+    def _connection(self, fresh=False):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None and not fresh:
+            return conn
+        if conn is not None:
+            conn.close()
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        conn = cls(self.host, self.port, timeout=self.timeout)
+        self.local.conn = conn
+        with self.conn_lock:
+            self.connections.append(conn)
+        return conn
+
+    def close(self):
+        with self.conn_lock:
+            for conn in self.connections:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self.connections = []
+
+    def fetch(self, sync_id, target_dir, expected_size=-1, expected_sha=""):
+        """Zwraca (ścieżka pliku tymczasowego, sha256); skrót liczony w trakcie zapisu."""
+        path = self.prefix + "/attachment/" + quote(sync_id, safe="")
+        for attempt in range(2):
+            # Drugie podejście na świeżym połączeniu - serwer mógł zamknąć keep-alive
+            conn = self._connection(fresh=attempt > 0)
+            try:
+                conn.request("GET", path, headers={"Accept": "application/octet-stream"})
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                if attempt:
+                    raise
+                continue
+            return self._store(response, target_dir, expected_size, expected_sha)
+        raise RuntimeError("Brak połączenia")
+
+    def _store(self, response, target_dir, expected_size, expected_sha):
+        if response.status != 200:
+            response.read()
+            raise RuntimeError(f"HTTP {response.status}")
+        length = response.getheader("Content-Length")
+        if length and int(length) > MAX_SYNC_ATTACHMENT_BYTES:
+            response.close()
+            raise RuntimeError("Załącznik jest za duży")
+        os.makedirs(target_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".budget-sync-", suffix=".tmp", dir=target_dir)
+        digest = hashlib.sha256()
+        total = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = response.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    total += len(chunk)
+                    if total > MAX_SYNC_ATTACHMENT_BYTES:
+                        response.close()
+                        raise RuntimeError("Załącznik jest za duży")
+                    digest.update(chunk)
+                    f.write(chunk)
+            if expected_size >= 0 and total != expected_size:
+                raise RuntimeError("Niepełny załącznik")
+            if expected_sha and digest.hexdigest().lower() != expected_sha:
+                raise RuntimeError("Nieprawidłowy załącznik")
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
+            raise
+        return tmp_path, digest.hexdigest()
+
+
+def download_missing_sync_attachments(db, peer_url, payload, lock=None, timeout=120, workers=SYNC_DOWNLOAD_WORKERS):
+    """
+    Dociąga załączniki opisane w payloadzie bez wkładania ich do JSON-a.
+    Pliki idą równolegle (workers wątków z połączeniami keep-alive), a zapis
+    w bazie odbywa się na końcu w jednej transakcji.
+    """
     base_url = normalize_sync_url(peer_url)
     result = {"downloaded": 0, "errors": 0}
     if not base_url or not isinstance(payload, dict):
@@ -220,6 +589,7 @@ def download_missing_sync_attachments(db, peer_url, payload, lock=None, timeout=
     if not isinstance(rows, list):
         return result
 
+    wanted = []
     for tx in rows:
         if not isinstance(tx, dict) or not tx.get("attachment_present"):
             continue
@@ -231,60 +601,51 @@ def download_missing_sync_attachments(db, peer_url, payload, lock=None, timeout=
         except Exception:
             expected_size = -1
         expected_sha = str(tx.get("attachment_sha256") or "").strip().lower()
+        wanted.append((sync_id, tx.get("attachment_name") or "zalacznik.dat", expected_size, expected_sha))
 
-        needs_download = _with_optional_lock(
-            lock,
-            lambda: db.needs_sync_attachment_download(sync_id, expected_size, expected_sha)
-        )
-        if not needs_download:
-            continue
+    if not wanted:
+        return result
+    def pending():
+        needed = [item for item in wanted if db.needs_sync_attachment_download(item[0], item[2], item[3])]
+        # Blob o tym samym skrócie już jest lokalnie - wystarczy go podpiąć, bez transferu
+        missing = set(db.adopt_known_attachments([(item[0], item[1], item[3]) for item in needed], origin=base_url))
+        return [item for item in needed if item[0] in missing]
+
+    todo = _with_optional_lock(lock, pending)
+    if not todo:
+        return result
 
-        tmp_path = None
-        try:
-            request = urllib.request.Request(
-                base_url + "/attachment/" + quote(sync_id, safe=""),
-                method="GET",
-                headers={"Accept": "application/octet-stream"},
-            )
-            with urllib.request.urlopen(request, timeout=timeout) as response:
-                length = response.headers.get("Content-Length")
-                if length and int(length) > MAX_SYNC_ATTACHMENT_BYTES:
-                    raise RuntimeError("Załącznik jest za duży")
-                fd, tmp_path = tempfile.mkstemp(prefix="budget-sync-attachment-", suffix=".tmp")
-                os.close(fd)
-                digest = hashlib.sha256()
-                total = 0
-                with open(tmp_path, "wb") as f:
-                    while True:
-                        chunk = response.read(1024 * 1024)
-                        if not chunk:
-                            break
-                        total += len(chunk)
-                        if total > MAX_SYNC_ATTACHMENT_BYTES:
-                            raise RuntimeError("Załącznik jest za duży")
-                        digest.update(chunk)
-                        f.write(chunk)
-            if expected_size >= 0 and os.path.getsize(tmp_path) != expected_size:
-                raise RuntimeError("Niepełny załącznik")
-            if expected_sha and digest.hexdigest().lower() != expected_sha:
-                raise RuntimeError("Nieprawidłowy załącznik")
+    fetcher = _AttachmentFetcher(base_url, timeout)
+    target_dir = db.attachments_dir
 
-            saved = _with_optional_lock(
-                lock,
-                lambda: db.save_sync_attachment(sync_id, tx.get("attachment_name") or "zalacznik.dat", tmp_path)
-            )
-            if saved:
-                result["downloaded"] += 1
-            else:
-                result["errors"] += 1
+    def download(item):
+        sync_id, name, expected_size, expected_sha = item
+        try:
+            tmp_path, sha = fetcher.fetch(sync_id, target_dir, expected_size, expected_sha)
+            return sync_id, name, tmp_path, sha
         except Exception:
-            result["errors"] += 1
-        finally:
-            if tmp_path:
-                try:
-                    os.remove(tmp_path)
-                except Exception:
-                    pass
+            return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(int(workers), len(todo)))) as pool:
+            downloaded = list(pool.map(download, todo))
+    finally:
+        fetcher.close()
+
+    ready = [item for item in downloaded if item]
+    result["errors"] += len(downloaded) - len(ready)
+    try:
+        saved = _with_optional_lock(lock, lambda: db.save_sync_attachments(ready, origin=base_url)) if ready else 0
+    except Exception:
+        saved = 0
+    result["downloaded"] += saved
+    result["errors"] += len(ready) - saved
+    for _sync_id, _name, tmp_path, _sha in ready:
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
     return result
 
 
@@ -338,13 +699,42 @@ def post_sync_payload(peer_url, payload, timeout=20):
     return incoming
 
 
-def sync_with_peer(db, peer_url, timeout=20):
-    """Wysyła lokalny payload do drugiego urządzenia i scala odpowiedź."""
+def sync_with_peer(db, peer_url, timeout=20, device_urls=None):
+    """
+    Wysyła lokalne zmiany do drugiego urządzenia i scala odpowiedź.
+    Z urządzeniem obsługującym NDJSON dane idą strumieniem, z pozostałymi
+    (np. Android) jednym JSON-em jak dotąd.
+    """
     base_url = normalize_sync_url(peer_url)
-    payload = db.export_sync_payload()
+    # Zapisy z tego wątku nie mogą się przeplatać z importem serwera
+    lock = getattr(db, "write_lock", None)
+    if peer_supports_stream(base_url):
+        state = db.get_sync_cursor(base_url)
+        extra = {"device_urls": list(device_urls or [])}
+        since = parse_sync_cursor(state.get("since"))
+        if since is not None:
+            extra["since"] = since
+        sent_meta, imported_local, incoming_meta, attachment_rows = post_sync_stream(
+            db, base_url, since=parse_sync_cursor(state.get("acked")), extra=extra, timeout=timeout
+        )
+        remember_sync_cursor(db, base_url, sent_meta, incoming_meta)
+        attachments = download_missing_sync_attachments(
+            db, base_url, {"transactions": attachment_rows}, lock=lock, timeout=max(timeout, 120)
+        )
+        return {
+            "imported_local": imported_local,
+            "attachments": attachments,
+            "imported_remote": incoming_meta.get("imported", {}),
+            "peer": base_url,
+        }
+
+    payload = prepare_sync_payload(db, base_url)
+    if device_urls:
+        payload["device_urls"] = list(device_urls)
     incoming = post_sync_payload(base_url, payload, timeout=timeout)
-    imported_local = db.import_sync_payload(incoming)
-    attachments = download_missing_sync_attachments(db, base_url, incoming, timeout=max(timeout, 120))
+    imported_local = _with_optional_lock(lock, lambda: db.import_sync_payload(incoming, origin=base_url))
+    remember_sync_cursor(db, base_url, payload, incoming)
+    attachments = download_missing_sync_attachments(db, base_url, incoming, lock=lock, timeout=max(timeout, 120))
     return {
         "imported_local": imported_local,
         "attachments": attachments,
@@ -1,12 +1,396 @@
 import sqlite3
 import os
 import json
+import copy
+import functools
 import uuid
 import base64
 import hashlib
+import re
+import queue
+import threading
+import zlib
+import lzma
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
 from datetime import datetime, timedelta
 import config
 from config import APP_DIR, _
+from budget_stats import DashboardAggregates
+
+# Wartość kolumny attachment w magazynie adresowanym treścią: "<sha256>-<nazwa>"
+ATTACHMENT_BLOB_RE = re.compile(r"^([0-9a-f]{64})(?:-|$)")
+# To samo w SQL (dla wyzwalaczy liczników referencji)
+_BLOB_SQL = "(length({col}) >= 64 AND substr({col}, 1, 64) NOT GLOB '*[^0-9a-f]*')"
+
+# Ustawienia każdego połączenia: WAL pozwala czytać równolegle z zapisem,
+# NORMAL w WAL nie traci spójności (najwyżej ostatnią transakcję przy zaniku prądu)
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=67108864",
+    "PRAGMA temp_store=MEMORY",
+)
+# Ile bezczynnych połączeń tylko do odczytu trzymamy w puli
+READ_POOL_SIZE = 3
+
+# Repozytorium kopii zapasowych (podkatalog wybranej lokalizacji backupu)
+BACKUP_REPO_DIR = "budget-backup"
+BACKUP_FORMAT = 1
+# Fragment bazy = 16 stron SQLite; zmiana kilku wierszy to kilka nowych obiektów
+BACKUP_CHUNK_SIZE = 64 * 1024
+# Ile kopii (manifestów) zostaje - tak jak wcześniej 10 plików ZIP
+BACKUP_KEEP = 10
+# Ile stron kopiuje jeden krok sqlite3 backup API (między krokami zgłaszany jest postęp)
+BACKUP_STEP_PAGES = 256
+# Katalog (obok bazy), w którym przywracana kopia jest składana i sprawdzana przed podmianą
+RESTORE_STAGING_DIR = ".restore-staging"
+# Znacznik: kopia w katalogu tymczasowym jest kompletna i sprawdzona - można podmieniać
+RESTORE_READY_MARKER = "READY"
+# Ile ostatnich zakresów rewizji z importu pamiętamy dla jednego urządzenia
+SYNC_ORIGIN_RANGES = 50
+# Ile sekund przywracanie czeka, aż wątki w tle oddadzą połączenia do odczytu
+RESTORE_DRAIN_TIMEOUT = 10
+
+
+def _load_zstd():
+    """Kodek zstd jest opcjonalny: compression.zstd (Python 3.14+) albo pakiet zstandard."""
+    try:
+        from compression import zstd
+        return zstd.compress, zstd.decompress
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+            lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+# Kodeki obiektów kopii: nazwa w backup_config -> (znacznik w pliku, kompresja, dekompresja).
+# zlib, lzma i zstd zwalniają GIL, więc kompresja w puli wątków idzie na wielu rdzeniach.
+BACKUP_CODECS = {
+    "zlib": (b"z", lambda data: zlib.compress(data, 6), zlib.decompress),
+    "xz": (b"x", lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+_zstd = _load_zstd()
+if _zstd:
+    BACKUP_CODECS["zstd"] = (b"s",) + _zstd
+BACKUP_DEFAULT_CODEC = "zlib"
+# Treść zapisana bez kompresji (już skompresowane formaty)
+BACKUP_STORE_TAG = b"0"
+
+# Początki plików, które już są skompresowane: JPEG, PNG, GIF, PDF, ZIP (też DOCX/ODT),
+# gzip, xz, zstd, 7z, bzip2; WebP i HEIC/MP4 rozpoznaje is_compressed_content
+COMPRESSED_MAGIC = (
+    b"\xff\xd8\xff", b"\x89PNG", b"GIF8", b"%PDF", b"PK\x03\x04", b"\x1f\x8b",
+    b"\xfd7zXZ", b"\x28\xb5\x2f\xfd", b"7z\xbc\xaf", b"BZh",
+)
+COMPRESSED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".pdf", ".zip", ".docx", ".xlsx",
+    ".odt", ".ods", ".gz", ".xz", ".zst", ".7z", ".bz2", ".mp4",
+}
+
+
+def is_compressed_content(data, name=""):
+    """Czy treść jest już skompresowana (po bajtach nagłówka albo rozszerzeniu nazwy)."""
+    head = bytes(data[:12])
+    if head.startswith(COMPRESSED_MAGIC):
+        return True
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    if head[4:8] == b"ftyp":
+        return True
+    return os.path.splitext(str(name or ""))[1].lower() in COMPRESSED_EXTENSIONS
+
+# Wpływ typu transakcji na saldo konta - jedyna reguła znaków dla sald.
+# savings_migration przenosi odłożone już pieniądze, więc salda nie zmienia.
+BALANCE_SIGNS = {
+    "income": 1,
+    "debtor_repayment": 1,
+    "account_transfer": 1,
+    "expense": -1,
+    "liability_repayment": -1,
+    "savings": -1,
+    "goal_deposit": -1,
+}
+BALANCE_SIGN_SQL = "CASE type {} ELSE 0 END".format(
+    " ".join(f"WHEN '{t_type}' THEN {sign}" for t_type, sign in BALANCE_SIGNS.items())
+)
+
+def parse_search_text(text):
+    """
+    Zamienia tekst z paska wyszukiwania na listę filtrów:
+    ("date", "RRRR-MM-DD") dla dd.mm.rrrr, ("date_prefix", ...) dla RRRR-MM(-DD),
+    ("month", "MM") dla nazwy miesiąca, ("number", wartość, ma_grosze, tekst)
+    dla kwot (także "1 200,50 zł") i ("text", słowo) dla reszty.
+    """
+    search = str(text or "").lower().strip()
+    if not search:
+        return []
+
+    clean_num_str = search.replace("zł", "").replace(" ", "").replace(",", ".").strip()
+    if re.fullmatch(r"-?\d+(\.\d+)?", clean_num_str):
+        return [("number", float(clean_num_str), "." in clean_num_str, clean_num_str)]
+
+    month_names = [str(n).lower() for n in config.MONTH_NAME]
+    tokens = []
+    for raw in search.replace("zł", " ").split():
+        token = raw.strip(",;")
+        if not token:
+            continue
+        dm = re.fullmatch(r"(\d{1,2})\.(\d{1,2})\.(\d{4})", token)
+        if dm:
+            tokens.append(("date", f"{dm.group(3)}-{int(dm.group(2)):02d}-{int(dm.group(1)):02d}"))
+        elif re.fullmatch(r"\d{4}-\d{2}(-\d{2})?", token):
+            tokens.append(("date_prefix", token))
+        elif token in month_names:
+            tokens.append(("month", f"{month_names.index(token) + 1:02d}"))
+        elif re.fullmatch(r"-?\d+([.,]\d+)?", token):
+            num = token.replace(",", ".")
+            tokens.append(("number", float(num), "." in num, num))
+        else:
+            tokens.append(("text", token))
+    return tokens
+
+
+class QueryCache:
+    """
+    Wyniki drobnych, często powtarzanych odczytów (konta, kategorie, cele,
+    konfiguracja, blokady miesięcy, moduły) trzymane w pamięci. Każdy wpis
+    pamięta liczniki zmian swoich tabel; zapis do tabeli podbija jej licznik
+    (bump), więc nieaktualny wpis jest po prostu odczytywany z bazy od nowa.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._epoch = 0
+        self._generations = {}
+        self._entries = {}
+
+    def bump(self, *tables):
+        """Unieważnia wpisy zależne od podanych tabel (po zapisie lub wycofaniu)."""
+        with self.lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+
+    def clear(self):
+        """Czyści wszystko (nowa baza, przywrócona kopia)."""
+        with self.lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def get(self, key, tables, loader, store=True):
+        """
+        Zwraca wynik loader() spod klucza key, odczytany ponownie tylko po zmianie tabel.
+        store=False: odczyt z migawki (może być starszy niż liczniki) - nie trafia do pamięci.
+        """
+        with self.lock:
+            stamp = (self._epoch,) + tuple(self._generations.get(table, 0) for table in tables)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                return entry[1]
+        # Liczniki sprzed odczytu: zapis w trakcie loader() unieważni ten wpis
+        value = loader()
+        if store:
+            with self.lock:
+                self._entries[key] = (stamp, value)
+        return value
+
+
+def serialized_write(method):
+    """
+    Metoda zapisująca przez wspólne self.conn trzyma write_lock przez cały czas
+    razem ze swoim commit/rollback - zapis z okna nie zatwierdzi ani nie wycofa
+    połowy transakcji wątku w tle (import synchronizacji, kopia) i odwrotnie.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.write_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class BackupRepository:
+    """
+    Kopie zapasowe adresowane treścią: objects/<ab>/<sha256> przechowuje
+    każdą unikalną zawartość (fragment bazy, załącznik) dokładnie raz,
+    a manifests/<data>.json opisuje jedną kopię - listę fragmentów bazy
+    i załączników. Każdy manifest wystarcza do pełnego przywrócenia, bez
+    łańcucha wcześniejszych kopii; obiekt znika dopiero wtedy, gdy nie
+    odwołuje się do niego żaden pozostały manifest.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.manifests_dir = os.path.join(root, "manifests")
+
+    @classmethod
+    def for_manifest(cls, manifest_path):
+        return cls(os.path.dirname(os.path.dirname(os.path.abspath(manifest_path))))
+
+    def ensure(self):
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.manifests_dir, exist_ok=True)
+
+    def object_path(self, sha):
+        return os.path.join(self.objects_dir, sha[:2], sha)
+
+    def has_object(self, sha):
+        return os.path.isfile(self.object_path(sha))
+
+    def put_object(self, data, codec=BACKUP_DEFAULT_CODEC, name=""):
+        """
+        Zapisuje treść (jeśli jej jeszcze nie ma) i zwraca jej sha256. Pierwszy
+        bajt pliku to znacznik kodeka; już skompresowane formaty (JPEG, PDF...)
+        trafiają do repozytorium bez ponownej kompresji.
+        """
+        sha = hashlib.sha256(data).hexdigest()
+        path = self.object_path(sha)
+        if os.path.isfile(path):
+            return sha
+        if is_compressed_content(data, name):
+            tag, body = BACKUP_STORE_TAG, data
+        else:
+            tag, compress, _decompress = BACKUP_CODECS[codec]
+            body = compress(data)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unikalny plik tymczasowy - ta sama treść może być zapisywana z dwóch wątków
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(tag)
+            f.write(body)
+        os.replace(tmp_path, path)
+        return sha
+
+    def put_objects(self, items, codec=BACKUP_DEFAULT_CODEC, on_stored=None):
+        """
+        put_object dla wielu treści (pary dane, nazwa) w puli wątków; zwraca
+        skróty w kolejności wejścia. W locie jest najwyżej kilka treści na
+        wątek, więc pamięć nie rośnie z rozmiarem bazy ani załączników.
+        on_stored(liczba_zapisanych) jest wołane po każdej treści.
+        """
+        workers = max(1, min(8, os.cpu_count() or 1))
+        shas = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for data, name in items:
+                pending.append(pool.submit(self.put_object, data, codec, name))
+                while len(pending) >= workers * 4:
+                    shas.append(pending.popleft().result())
+                    if on_stored:
+                        on_stored(len(shas))
+            while pending:
+                shas.append(pending.popleft().result())
+                if on_stored:
+                    on_stored(len(shas))
+        return shas
+
+    def get_objects(self, shas):
+        """
+        Generator treści obiektów w kolejności shas; odczyt, dekompresja
+        i sprawdzanie skrótów idą równolegle w puli wątków (z ograniczoną
+        liczbą obiektów w locie).
+        """
+        workers = max(1, min(8, os.cpu_count() or 1))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for sha in shas:
+                pending.append(pool.submit(self.get_object, sha))
+                while len(pending) >= workers * 4:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def get_object(self, sha):
+        """Odczytuje treść obiektu i sprawdza, czy zgadza się jej skrót."""
+        with open(self.object_path(sha), "rb") as f:
+            raw = f.read()
+        tag, body = raw[:1], raw[1:]
+        if tag == BACKUP_STORE_TAG:
+            data = body
+        else:
+            decompress = next((codec[2] for codec in BACKUP_CODECS.values() if codec[0] == tag), None)
+            if decompress is None:
+                raise ValueError(f"Nieznany format obiektu kopii (np. brak modułu zstd): {sha}")
+            data = decompress(body)
+        if hashlib.sha256(data).hexdigest() != sha:
+            raise ValueError(f"Uszkodzony obiekt kopii: {sha}")
+        return data
+
+    def manifest_paths(self):
+        """Manifesty od najstarszego (nazwy to znaczniki czasu)."""
+        if not os.path.isdir(self.manifests_dir):
+            return []
+        return sorted(
+            os.path.join(self.manifests_dir, name)
+            for name in os.listdir(self.manifests_dir) if name.endswith(".json")
+        )
+
+    @staticmethod
+    def load_manifest(path):
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if not isinstance(manifest, dict) or manifest.get("format") != BACKUP_FORMAT or "db" not in manifest:
+            raise ValueError("Nieprawidlowy manifest kopii")
+        return manifest
+
+    def latest_manifest(self):
+        """(ścieżka, manifest) najnowszej czytelnej kopii albo (None, None)."""
+        for path in reversed(self.manifest_paths()):
+            try:
+                return path, self.load_manifest(path)
+            except Exception as e:
+                print(f"Info: pomijam uszkodzony manifest {path}: {e}")
+        return None, None
+
+    def write_manifest(self, manifest, path=None):
+        if path is None:
+            stamp = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+            path = os.path.join(self.manifests_dir, f"{stamp}.json")
+            suffix = 1
+            while os.path.exists(path):
+                # "_01" sortuje się po "<stamp>.json" - kolejność nazw = kolejność kopii
+                path = os.path.join(self.manifests_dir, f"{stamp}_{suffix:02d}.json")
+                suffix += 1
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+        return path
+
+    @staticmethod
+    def manifest_objects(manifest):
+        objects = set(manifest.get("db", {}).get("chunks", []))
+        objects.update(entry["sha256"] for entry in manifest.get("attachments", {}).values())
+        return objects
+
+    def prune(self, keep=BACKUP_KEEP):
+        """Usuwa najstarsze manifesty ponad limit i obiekty, których już nikt nie używa."""
+        paths = self.manifest_paths()
+        if len(paths) <= keep:
+            return 0
+        for path in paths[:len(paths) - keep]:
+            os.remove(path)
+        referenced = set()
+        for path in paths[len(paths) - keep:]:
+            referenced.update(self.manifest_objects(self.load_manifest(path)))
+        removed = 0
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if name not in referenced:
+                    os.remove(os.path.join(prefix_dir, name))
+                    removed += 1
+        return removed
+
 
 class DatabaseManager:
     def __init__(self, db_name="budzet.db"):
@@ -18,12 +402,23 @@ class DatabaseManager:
         if not os.path.exists(self.attachments_dir):
             os.makedirs(self.attachments_dir, exist_ok=True)
 
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        self.create_tables()
-        self.update_goals_table_structure()
-        self.run_fix_savings_names()
-        self.initialize_config()
-
+        # Jedno połączenie zapisujące + pula do odczytu. Każdy zapis przez self.conn
+        # (okno i wątki w tle) trzyma write_lock - metody zapisujące mają @serialized_write
+        self.write_lock = threading.RLock()
+        self._readers = queue.LifoQueue()
+        self._reader_generation = 0
+        # Licznik wydanych połączeń do odczytu; przywracanie wstrzymuje wydawanie
+        # nowych i czeka, aż wszystkie wrócą (_drain_readers)
+        self._reader_cond = threading.Condition()
+        self._readers_out = 0
+        self._readers_paused = False
+        self._resume_staged_restore()
+        self.conn = self._connect()
+        self.aggregates = DashboardAggregates()
+        self.query_cache = QueryCache()
+        self.prepare_database()
+
+    @serialized_write
     def switch_database_dir(self, directory):
         """Przełącza aktywny katalog bazy i inicjalizuje nową bazę, jeśli trzeba."""
         target_dir = os.path.abspath(os.path.expanduser(str(directory or APP_DIR)))
@@ -33,18 +428,217 @@ class DatabaseManager:
         except Exception:
             pass
 
+        self.close_readers()
         config.set_database_dir(target_dir)
         self.db_path = config.get_database_path(self.db_name)
         self.attachments_dir = config.get_attachments_dir()
         os.makedirs(self.attachments_dir, exist_ok=True)
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        self.create_tables()
-        self.update_goals_table_structure()
-        self.run_fix_savings_names()
-        self.initialize_config()
+        self._resume_staged_restore()
+        self.conn = self._connect()
+        self.aggregates.invalidate()
+        self.query_cache.clear()
+        self.prepare_database()
         return self.db_path
 
-    def create_tables(self):
+    def _connect(self, readonly=False):
+        """Nowe połączenie z bazą z ustawieniami SQLITE_PRAGMAS (WAL dla zapisującego)."""
+        if readonly:
+            uri = Path(self.db_path).absolute().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            conn.execute("PRAGMA query_only=ON")
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.DatabaseError as e:
+                # Np. baza na udziale sieciowym - zostaje zwykły dziennik
+                print(f"Info: tryb WAL niedostępny: {e}")
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def read_connection(self, snapshot=False):
+        """
+        Połączenie tylko do odczytu z puli (eksport synchronizacji, raporty, historia).
+        Nie czeka na zapis w self.conn; snapshot=True daje spójny obraz bazy
+        dla kilku zapytań. Gdy nie da się go otworzyć, używa self.conn.
+        """
+        with self._reader_cond:
+            self._reader_cond.wait_for(lambda: not self._readers_paused)
+            self._readers_out += 1
+        try:
+            generation = self._reader_generation
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                try:
+                    conn = self._connect(readonly=True)
+                except Exception as e:
+                    print(f"Info: brak połączenia do odczytu, używam głównego: {e}")
+                    yield self.conn
+                    return
+            try:
+                if snapshot:
+                    conn.execute("BEGIN")
+                yield conn
+            finally:
+                try:
+                    if conn.in_transaction:
+                        conn.rollback()
+                except Exception:
+                    pass
+                if generation == self._reader_generation and self._readers.qsize() < READ_POOL_SIZE:
+                    self._readers.put(conn)
+                else:
+                    conn.close()
+        finally:
+            with self._reader_cond:
+                self._readers_out -= 1
+                self._reader_cond.notify_all()
+
+    @contextmanager
+    def read_snapshot(self):
+        """
+        Migawka do liczenia w tle: (połączenie, znacznik sum w pamięci). Migawka
+        jest przypinana pod write_lock, więc każdy zapis jest w niej cały albo
+        wcale, a DashboardAggregates.sync wie, które zmiany są od niej nowsze.
+        Połączenia czytające self.conn podają pinned=None (widzą wszystko).
+        """
+        with self.read_connection(snapshot=True) as conn:
+            if conn is self.conn:
+                yield conn, None
+                return
+            with self.write_lock:
+                # BEGIN jest leniwy - dopiero odczyt przypina migawkę
+                conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+                pinned = self.aggregates.mark()
+            yield conn, pinned
+
+    def close_readers(self):
+        """Zamyka połączenia z puli (zmiana katalogu bazy, przywracanie kopii)."""
+        self._reader_generation += 1
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+            except Exception:
+                pass
+
+    def _drain_readers(self, timeout=RESTORE_DRAIN_TIMEOUT):
+        """
+        Wstrzymuje wydawanie połączeń do odczytu i czeka, aż wydane wrócą do puli.
+        Zwraca False po przekroczeniu czasu (wydawanie zostaje wstrzymane -
+        wołający i tak musi wywołać _resume_readers).
+        """
+        with self._reader_cond:
+            self._readers_paused = True
+            return self._reader_cond.wait_for(lambda: self._readers_out == 0, timeout)
+
+    def _resume_readers(self):
+        with self._reader_cond:
+            self._readers_paused = False
+            self._reader_cond.notify_all()
+
+    # Kroki migracji schematu: (wersja w PRAGMA user_version, metoda). Baza z user_version
+    # mniejszym niż wersja kroku wykonuje go raz, razem z podbiciem wersji w jednej transakcji.
+    # Zmiana schematu = nowy krok na końcu listy; istniejących kroków się nie zmienia,
+    # bo bazy, które już je mają, nigdy ich nie powtórzą. Kroki 1-3 to dawne create_tables
+    # i poprawki uruchamiane przy każdym starcie - są idempotentne, bo stara baza (wersja 0)
+    # może być w dowolnym stanie pośrednim.
+    SCHEMA_MIGRATIONS = (
+        (1, "_migrate_base_schema"),
+        (2, "_migrate_derived_structures"),
+        (3, "_migrate_savings_names"),
+        (4, "_migrate_sync_origins"),
+        (5, "_migrate_drop_attachment_hashes"),
+    )
+    SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+    def prepare_database(self):
+        """Po otwarciu bazy: brakujące migracje schematu i domyślna konfiguracja."""
+        self.migrate_schema()
+        self.initialize_config()
+
+    def migrate_schema(self):
+        """
+        Wykonuje kroki z SCHEMA_MIGRATIONS nowsze niż PRAGMA user_version bazy.
+        Aktualna baza kosztuje tylko odczyt wersji i sprawdzenie dostępnych funkcji
+        (FTS5, kolumny generowane). Zwraca listę wykonanych wersji.
+        """
+        done = []
+        with self.write_lock:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version > self.SCHEMA_VERSION:
+                print(f"Info: baza ma nowszy schemat ({version}) niż obsługiwany ({self.SCHEMA_VERSION}).")
+            for step_version, method in self.SCHEMA_MIGRATIONS:
+                if step_version <= version:
+                    continue
+                if self.conn.in_transaction:
+                    self.conn.commit()
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    cleanup = getattr(self, method)() or []
+                    self.conn.execute(f"PRAGMA user_version = {int(step_version)}")
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    print(f"Błąd migracji schematu do wersji {step_version} ({method}).")
+                    raise
+                # Pliki usuwane dopiero po zatwierdzeniu - wycofany krok ich nie straci
+                for path in cleanup:
+                    try:
+                        os.remove(path)
+                    except Exception:
+                        pass
+                done.append(step_version)
+            self._detect_optional_features()
+
+        if done:
+            print(f"Sukces: Zaktualizowano schemat bazy do wersji {done[-1]}.")
+            self.aggregates.invalidate()
+            self.query_cache.clear()
+            self.check_query_plans()
+        self.collect_attachment_blobs()
+        return done
+
+    def _detect_optional_features(self):
+        """Czy baza ma indeks FTS i kolumny fingerprint (kroki migracji mogły je pominąć na starym SQLite)."""
+        fts_tables = [fts for fts, _table, _cols in self.SEARCH_INDEXES]
+        names = {row[0] for row in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name IN ({})".format(
+                ", ".join("?" * len(fts_tables))
+            ), fts_tables
+        ).fetchall()}
+        self.search_fts = all(fts in names for fts in fts_tables)
+        fp_tables = list(self.FINGERPRINT_COLUMNS)
+        try:
+            with_fp = {row[0] for row in self.conn.execute(
+                "SELECT m.name FROM sqlite_master m, pragma_table_xinfo(m.name) c "
+                "WHERE m.type='table' AND c.name='fingerprint' AND m.name IN ({})".format(
+                    ", ".join("?" * len(fp_tables))
+                ), fp_tables
+            ).fetchall()}
+        except sqlite3.Error:
+            with_fp = set()
+        self.fingerprints = all(table in with_fp for table in fp_tables)
+
+    def _table_columns(self, table):
+        return {row[1] for row in self.conn.execute(f"PRAGMA table_xinfo({table})").fetchall()}
+
+    def _add_missing_columns(self, table, columns):
+        """Dodaje kolumny [(nazwa, definicja)], których tabela jeszcze nie ma. Zwraca dodane nazwy."""
+        existing = self._table_columns(table)
+        added = []
+        for col, col_def in columns:
+            if col not in existing:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {col_def}")
+                added.append(col)
+        return added
+
+    def _migrate_base_schema(self):
+        """Migracja 1: tabele, brakujące kolumny starych baz i dane domyślne."""
         # 1. Podstawowe tabele
         self.conn.execute("""
         CREATE TABLE IF NOT EXISTS transactions (
@@ -107,7 +701,18 @@ class DatabaseManager:
             )
         """)
 
-        # --- MIGRACJE KOLUMN (Try-Except) ---
+        # 4. Tabele historii i rachunków (przed migracjami kolumn, bo pending_bills też je ma)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS weekly_history (monday_date TEXT PRIMARY KEY, amount REAL, categories TEXT)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS pending_bills (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                due_date TEXT, amount REAL, category TEXT, description TEXT,
+                is_paid INTEGER DEFAULT 0, is_recurring INTEGER DEFAULT 0,
+                ref_id INTEGER, sync_id TEXT, updated_at TEXT
+            )
+        """)
+
+        # --- MIGRACJE KOLUMN ---
         migrations = [
             ("shopping_items", "store", "TEXT DEFAULT ''"),
             ("transactions", "exclude_from_weekly", "INTEGER DEFAULT 0"),
@@ -131,11 +736,22 @@ class DatabaseManager:
             ("debtors", "attachment", "TEXT"),
             ("debtors", "sync_id", "TEXT"),
             ("debtors", "updated_at", "TEXT"),
+            ("transactions", "sync_rev", "INTEGER"),
+            ("pending_bills", "sync_rev", "INTEGER"),
+            ("shopping_lists", "sync_rev", "INTEGER"),
+            ("shopping_items", "sync_rev", "INTEGER"),
+            ("liabilities", "sync_rev", "INTEGER"),
+            ("debtors", "sync_rev", "INTEGER"),
+            ("sync_deletions", "sync_rev", "INTEGER"),
+            ("pending_bills", "is_recurring", "INTEGER DEFAULT 0"),
+            ("pending_bills", "ref_id", "INTEGER"),
+            ("goals", "default_account_id", "INTEGER"),
         ]
+        by_table = {}
         for table, col, col_def in migrations:
-            try:
-                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {col_def}")
-            except: pass
+            by_table.setdefault(table, []).append((col, col_def))
+        for table, columns in by_table.items():
+            self._add_missing_columns(table, columns)
 
         # --- NAPRAWA STARYCH POWIĄZAŃ (OPCJA A) ---
         self.conn.execute("""
@@ -149,7 +765,7 @@ class DatabaseManager:
             WHERE type = 'debtor_repayment' AND ref_id IS NULL
         """)
 
-        # 4. Dane domyślne (Shops & Categories)
+        # 5. Dane domyślne (Shops & Categories)
         self.conn.execute("CREATE TABLE IF NOT EXISTS shops (name TEXT PRIMARY KEY)")
         if self.conn.execute("SELECT count(*) FROM shops").fetchone()[0] == 0:
             for s in ["Biedronka", "Dino", "Lidl", "Polo", "Kaufland", "Apteka", "Rossmann", "Pepco"]:
@@ -159,27 +775,6 @@ class DatabaseManager:
             for d in ["Zakupy", "Remonty", "Spłata Długu", "Samochód", "Ciuchy", "Opłaty", "Rozrywka", "Inne", "Zdrowie", "Pożyczki"]:
                 self.conn.execute("INSERT OR IGNORE INTO categories VALUES (?)", (d,))
 
-        # 5. Tabele historii i rachunków
-        self.conn.execute("CREATE TABLE IF NOT EXISTS weekly_history (monday_date TEXT PRIMARY KEY, amount REAL, categories TEXT)")
-        self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS pending_bills (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                due_date TEXT, amount REAL, category TEXT, description TEXT,
-                is_paid INTEGER DEFAULT 0, is_recurring INTEGER DEFAULT 0,
-                ref_id INTEGER, sync_id TEXT, updated_at TEXT
-            )
-        """)
-        for col, col_def in [
-            ("is_recurring", "INTEGER DEFAULT 0"),
-            ("ref_id", "INTEGER"),
-            ("sync_id", "TEXT"),
-            ("updated_at", "TEXT"),
-        ]:
-            try:
-                self.conn.execute(f"ALTER TABLE pending_bills ADD COLUMN {col} {col_def}")
-            except:
-                pass
-
         # --- TABELA KONT ---
         # 1. Tworzymy tabelę w podstawowej formie (jeśli nie istnieje)
         self.conn.execute("""
@@ -192,10 +787,7 @@ class DatabaseManager:
 
         # 2. MIGRACJA: Dodajemy kolumnę color ZANIM zrobimy INSERT
         # To naprawia błąd OperationalError w istniejących bazach
-        try:
-            self.conn.execute("ALTER TABLE accounts ADD COLUMN color TEXT DEFAULT '#7f8c8d'")
-        except:
-            pass # Kolumna już istnieje
+        self._add_missing_columns("accounts", [("color", "TEXT DEFAULT '#7f8c8d'")])
 
         # 3. Teraz bezpiecznie dodajemy domyślne konto "Gotówka"
         self.conn.execute("""
@@ -206,12 +798,9 @@ class DatabaseManager:
         # --- POZOSTAŁE MIGRACJE ---
 
         # Migracja tabeli transakcji - dodajemy kolumnę account_id
-        try:
-            self.conn.execute("ALTER TABLE transactions ADD COLUMN account_id INTEGER")
+        if self._add_missing_columns("transactions", [("account_id", "INTEGER")]):
             # Przypisujemy stare transakcje do konta 'Gotówka' (id=1)
             self.conn.execute("UPDATE transactions SET account_id = 1 WHERE account_id IS NULL")
-        except:
-            pass
 
         # Tabela modułów
         self.conn.execute("""
@@ -225,9 +814,817 @@ class DatabaseManager:
         self.conn.execute("INSERT OR IGNORE INTO modules VALUES ('shopping_list', 1)")
         self.conn.execute("INSERT OR IGNORE INTO modules VALUES ('weekly_limit', 1)")
 
+    def _migrate_derived_structures(self):
+        """
+        Migracja 2: sumy miesięczne, liczniki zmian, metadane synchronizacji,
+        odciski, indeksy, FTS i magazyn blobów. Zwraca stare pliki załączników
+        do usunięcia po zatwierdzeniu.
+        """
+        self.ensure_monthly_totals()
+        self.ensure_sync_revisions()
         self.ensure_transaction_sync_metadata()
         self.ensure_aux_sync_metadata()
-        self.conn.commit()
+        self.ensure_fingerprints()
+        self.ensure_indexes()
+        self.ensure_search_index()
+        return self.ensure_attachment_store()
+
+    # Indeksy pomocnicze: (nazwa, tabela, kolumny, unikalny, warunek częściowy)
+    MANAGED_INDEXES = [
+        ("idx_transactions_sync_id", "transactions", "sync_id", True, "sync_id IS NOT NULL"),
+        ("idx_transactions_date", "transactions", "date", False, None),
+        ("idx_transactions_account_date", "transactions", "account_id, date", False, None),
+        ("idx_transactions_type_ref", "transactions", "type, ref_id", False, None),
+        ("idx_transactions_type_subcategory", "transactions", "type, subcategory", False, None),
+        ("idx_transactions_sync_rev", "transactions", "sync_rev", False, None),
+        ("idx_pending_bills_sync_id", "pending_bills", "sync_id", True, "sync_id IS NOT NULL"),
+        ("idx_shopping_lists_sync_id", "shopping_lists", "sync_id", True, "sync_id IS NOT NULL"),
+        ("idx_shopping_items_sync_id", "shopping_items", "sync_id", True, "sync_id IS NOT NULL"),
+        ("idx_shopping_items_list", "shopping_items", "list_id", False, None),
+        ("idx_liabilities_sync_id", "liabilities", "sync_id", True, "sync_id IS NOT NULL"),
+        ("idx_debtors_sync_id", "debtors", "sync_id", True, "sync_id IS NOT NULL"),
+        ("idx_transactions_fingerprint", "transactions", "fingerprint", False, None),
+        ("idx_pending_bills_fingerprint", "pending_bills", "fingerprint", False, None),
+        ("idx_shopping_lists_fingerprint", "shopping_lists", "fingerprint", False, None),
+        ("idx_shopping_items_fingerprint", "shopping_items", "fingerprint", False, None),
+        ("idx_liabilities_fingerprint", "liabilities", "fingerprint", False, None),
+        ("idx_debtors_fingerprint", "debtors", "fingerprint", False, None),
+    ]
+
+    # Zapytania z gorących ścieżek: ten sam tekst wykonuje metoda i sprawdza
+    # check_query_plans. Części zależne od argumentów wstawia str.format.
+    YEAR_TRANSACTIONS_SQL = """
+        SELECT id, date, type, category, subcategory, amount FROM transactions
+        WHERE date >= ? AND date < ? ORDER BY date
+    """
+    REPORT_TRANSACTIONS_SQL = """
+        SELECT id, date, type, category, subcategory, amount, details,
+        CASE WHEN attachment IS NOT NULL AND attachment != '' THEN 1 ELSE 0 END,
+        account_id
+        FROM transactions
+        WHERE date >= ? AND date < ?
+        ORDER BY date, id
+    """
+    TRANSACTIONS_IN_RANGE_SQL = """
+        SELECT id, date, type, category, subcategory, amount, details,
+        CASE WHEN attachment IS NOT NULL AND attachment != '' THEN 1 ELSE 0 END,
+        account_id
+        FROM transactions
+        WHERE date >= ? AND date < ?
+        ORDER BY IFNULL(sync_order, IFNULL(updated_at, '')) DESC, id DESC
+    """
+    EXPENSES_IN_RANGE_SQL = """
+        SELECT category, SUM(amount)
+        FROM transactions
+        WHERE type='expense'
+        AND exclude_from_weekly = 0
+        AND date >= ? AND date <= ?{categories}
+        GROUP BY category ORDER BY SUM(amount) DESC
+    """
+    ACCOUNT_HISTORY_SQL = """
+        SELECT date, type, category, subcategory, amount, details
+        FROM transactions
+        WHERE account_id = ? AND date BETWEEN ? AND ?{type_filter}
+        ORDER BY date DESC
+    """
+    BALANCES_SQL = f"""
+        SELECT a.id, a.name, a.color, IFNULL(a.initial_balance, 0),
+               IFNULL(SUM(f.current), 0), IFNULL(SUM(f.before), 0)
+        FROM accounts a
+        LEFT JOIN (
+            SELECT account_id,
+                   total * {BALANCE_SIGN_SQL} AS current,
+                   CASE WHEN ? IS NULL OR month < ? THEN total * {BALANCE_SIGN_SQL} ELSE 0 END AS before
+            FROM monthly_account_totals
+            UNION ALL
+            SELECT account_id, 0, amount * {BALANCE_SIGN_SQL}
+            FROM transactions
+            WHERE ? IS NOT NULL AND date >= ? AND date < ?
+        ) f ON f.account_id = a.id
+        GROUP BY a.id
+        ORDER BY a.id
+    """
+    DEBT_LEDGER_SQL = """
+        SELECT d.id, d.name, d.total_amount, d.deadline, d.attachment, by_ref.paid, by_name.paid
+        FROM {table} d
+        LEFT JOIN (
+            SELECT ref_id, SUM(amount) AS paid
+            FROM transactions
+            WHERE type = ? AND ref_id IS NOT NULL
+            GROUP BY ref_id
+        ) by_ref ON by_ref.ref_id = d.id
+        LEFT JOIN (
+            SELECT subcategory, SUM(amount) AS paid
+            FROM transactions
+            WHERE type = ?
+            GROUP BY subcategory
+        ) by_name ON by_name.subcategory = d.name
+        {where}
+        ORDER BY d.id
+    """
+    GOAL_DEPOSITS_SQL = """
+        SELECT goal_id, SUM(amount) FROM (
+            SELECT g.id AS goal_id, t.amount
+            FROM goals g
+            JOIN transactions t ON t.type = 'goal_deposit' AND t.ref_id = g.id
+            WHERE 1 = 1{account}
+            UNION ALL
+            SELECT g.id, t.amount
+            FROM goals g
+            JOIN transactions t ON t.type = 'goal_deposit' AND t.ref_id IS NULL AND t.subcategory = g.name
+            WHERE 1 = 1{account}
+        )
+        GROUP BY goal_id
+    """
+    GOAL_SAVINGS_SQL = """
+        WITH goal_map(subcategory, goal_id) AS (VALUES {values})
+        SELECT m.goal_id, SUM(t.amount)
+        FROM goal_map m
+        JOIN transactions t ON t.type IN ('savings', 'savings_migration') AND t.subcategory = m.subcategory
+        WHERE 1 = 1{account}
+        GROUP BY m.goal_id
+    """
+    SYNC_TRANSACTION_SQL = "SELECT id, IFNULL(updated_at, ''), IFNULL(attachment, '') FROM transactions WHERE sync_id=?"
+    SYNC_BILL_SQL = "SELECT id, IFNULL(updated_at,'') FROM pending_bills WHERE sync_id=?"
+    SYNC_SHOPPING_ITEM_SQL = "SELECT id, IFNULL(updated_at,'') FROM shopping_items WHERE sync_id=?"
+    LEGACY_DUPLICATE_TRANSACTION_SQL = """
+        SELECT id
+        FROM transactions
+        WHERE {key}IFNULL(date, '') = ?
+          AND IFNULL(type, '') = ?
+          AND IFNULL(category, '') = ?
+          AND IFNULL(subcategory, '') = ?
+          AND ABS(IFNULL(amount, 0.0) - ?) < 0.000001
+          AND IFNULL(exclude_from_weekly, 0) = ?
+          AND IFNULL(details, '') = ?
+          AND IFNULL(account_id, 1) = ?
+          AND (sync_id IS NULL OR sync_id != ?)
+          AND (
+                sync_order IS NULL
+                OR TRIM(sync_order) = ''
+                OR sync_order GLOB '*|[0-9]*'
+              )
+        ORDER BY id
+        LIMIT 1
+    """
+    DUPLICATE_BILL_SQL = """
+        SELECT id
+        FROM pending_bills
+        WHERE {key}IFNULL(due_date,'')=?
+          AND ABS(IFNULL(amount,0.0) - ?) < 0.000001
+          AND IFNULL(category,'')=?
+          AND IFNULL(description,'')=?
+          AND IFNULL(is_recurring,0)=?
+          AND (sync_id IS NULL OR TRIM(sync_id)='' OR sync_id != ?)
+        ORDER BY id LIMIT 1
+    """
+
+    # (nazwa, SQL, przykładowe parametry, tabele/aliasy z planu, których nie wolno
+    # czytać w całości). Pełny SCAN małych tabel (konta, długi, cele) jest zamierzony.
+    HOT_QUERIES = [
+        ("get_year_transactions", YEAR_TRANSACTIONS_SQL, ("2000", "2001"), ("transactions",)),
+        ("iter_report_transactions", REPORT_TRANSACTIONS_SQL, ("2000", "2001"), ("transactions",)),
+        ("get_transactions_in_range", TRANSACTIONS_IN_RANGE_SQL, ("2000-01", "2000-02"), ("transactions",)),
+        ("get_expenses_in_range", EXPENSES_IN_RANGE_SQL.format(categories=""),
+         ("2000-01-01", "2000-01-07"), ("transactions",)),
+        ("get_account_history", ACCOUNT_HISTORY_SQL.format(type_filter=""),
+         (1, "2000-01-01", "2000-12-31"), ("transactions",)),
+        ("get_balances", BALANCES_SQL, ("2000-01",) * 4 + ("2000-01-15",), ("transactions",)),
+        ("get_debt_ledger", DEBT_LEDGER_SQL.format(table="liabilities", where=""),
+         ("liability_repayment",) * 2, ("transactions",)),
+        ("get_goal_totals", GOAL_DEPOSITS_SQL.format(account=""), (), ("t",)),
+        ("get_goal_totals (oszczędności)", GOAL_SAVINGS_SQL.format(values="(?, ?)", account=""), ("x", 1), ("t",)),
+        ("import_sync_transaction", SYNC_TRANSACTION_SQL, ("x",), ("transactions",)),
+        ("import_sync_bill", SYNC_BILL_SQL, ("x",), ("pending_bills",)),
+        ("import_sync_shopping_item", SYNC_SHOPPING_ITEM_SQL, ("x",), ("shopping_items",)),
+        ("find_legacy_duplicate_transaction", LEGACY_DUPLICATE_TRANSACTION_SQL.format(key="fingerprint = ? AND "),
+         ("x", "2000-01-01", "expense", "x", "x", 1.0, 0, "", 1, "x"), ("transactions",)),
+        ("import_sync_bill_duplicate", DUPLICATE_BILL_SQL.format(key="fingerprint = ? AND "),
+         ("x", "2000-01-01", 1.0, "x", "", 0, "x"), ("pending_bills",)),
+    ]
+
+    # Odcisk treści wiersza do wykrywania starych duplikatów (bez sync_id) przy imporcie.
+    # Kolumna generowana "fingerprint" + indeks; _fingerprint liczy to samo po stronie Pythona.
+    FINGERPRINT_COLUMNS = {
+        "transactions": (
+            "IFNULL(date,'')", "IFNULL(type,'')", "IFNULL(category,'')", "IFNULL(subcategory,'')",
+            "CAST(ROUND(IFNULL(amount,0.0) * 100) AS INTEGER)",
+            "CAST(IFNULL(exclude_from_weekly,0) AS INTEGER)", "IFNULL(details,'')",
+            "CAST(IFNULL(account_id,1) AS INTEGER)",
+        ),
+        "pending_bills": (
+            "IFNULL(due_date,'')", "CAST(ROUND(IFNULL(amount,0.0) * 100) AS INTEGER)",
+            "IFNULL(category,'')", "IFNULL(description,'')", "CAST(IFNULL(is_recurring,0) AS INTEGER)",
+        ),
+        "shopping_lists": ("IFNULL(name,'')", "IFNULL(created_at,'')"),
+        "shopping_items": (
+            "CAST(IFNULL(list_id,0) AS INTEGER)", "IFNULL(product_name,'')",
+            "IFNULL(quantity,'')", "IFNULL(store,'')",
+        ),
+        "liabilities": (
+            "IFNULL(name,'')", "CAST(ROUND(IFNULL(total_amount,0.0) * 100) AS INTEGER)", "IFNULL(deadline,'')",
+        ),
+        "debtors": (
+            "IFNULL(name,'')", "CAST(ROUND(IFNULL(total_amount,0.0) * 100) AS INTEGER)", "IFNULL(deadline,'')",
+        ),
+    }
+
+    @classmethod
+    def _fingerprint_sql(cls, table):
+        return " || '|' || ".join(cls.FINGERPRINT_COLUMNS[table])
+
+    @staticmethod
+    def _fingerprint(*parts):
+        return "|".join(str(part) for part in parts)
+
+    @staticmethod
+    def _fingerprint_cents(value):
+        # Jak ROUND() w SQLite: połówki od zera
+        cents = float(value or 0.0) * 100
+        return int(cents + 0.5) if cents >= 0 else -int(-cents + 0.5)
+
+    def ensure_fingerprints(self):
+        """
+        Dodaje kolumnę generowaną "fingerprint" do tabel synchronizowanych.
+        SQLite liczy ją sama przy każdym zapisie, a indeks z MANAGED_INDEXES
+        zamienia szukanie starych duplikatów przy imporcie w jedno trafienie w indeks.
+        """
+        self.fingerprints = True
+        for table in self.FINGERPRINT_COLUMNS:
+            try:
+                columns = [row[1] for row in self.conn.execute(f"PRAGMA table_xinfo({table})").fetchall()]
+                if "fingerprint" in columns:
+                    continue
+                self.conn.execute(
+                    f"ALTER TABLE {table} ADD COLUMN fingerprint TEXT "
+                    f"GENERATED ALWAYS AS ({self._fingerprint_sql(table)}) VIRTUAL"
+                )
+            except Exception as e:
+                # Stary SQLite bez kolumn generowanych - import porówna kolumny jak dawniej
+                print(f"Info: brak kolumny fingerprint w {table}: {e}")
+                self.fingerprints = False
+
+    def _fingerprint_filter(self, *parts):
+        """Warunek "fingerprint = ? AND " z parametrem (pusty, gdy kolumny nie ma)."""
+        if not getattr(self, "fingerprints", False):
+            return "", ()
+        return "fingerprint = ? AND ", (self._fingerprint(*parts),)
+
+    def ensure_indexes(self):
+        """Zakłada brakujące indeksy z MANAGED_INDEXES (idempotentnie)."""
+        for name, table, columns, unique, where in self.MANAGED_INDEXES:
+            sql = f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+            if where:
+                sql += f" WHERE {where}"
+            try:
+                self.conn.execute(sql)
+            except sqlite3.IntegrityError as e:
+                # Stara baza z powtórzonym sync_id - zostaje zwykły indeks, żeby nie blokować startu
+                print(f"Info: indeks {name} nie może być unikalny ({e}), zakładam zwykły.")
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+            except Exception as e:
+                print(f"Info: nie udało się założyć indeksu {name}: {e}")
+
+    def check_query_plans(self):
+        """
+        Sprawdza EXPLAIN QUERY PLAN dla HOT_QUERIES i zgłasza te, które
+        przechodzą przez całą wskazaną tabelę. Zwraca listę (nazwa, plan).
+        """
+        problems = []
+        for name, sql, params, tables in self.HOT_QUERIES:
+            try:
+                plan = [str(row[-1]) for row in self.conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+            except Exception as e:
+                problems.append((name, str(e)))
+                continue
+            full_scans = [
+                step for step in plan
+                if step.startswith("SCAN ") and " USING " not in step and step.split()[1] in tables
+            ]
+            if full_scans:
+                problems.append((name, "; ".join(full_scans)))
+        for name, detail in problems:
+            print(f"Ostrzeżenie: zapytanie {name} nie używa indeksu: {detail}")
+        return problems
+
+    # Tabele, których zmiany dostają kolejny numer rewizji (delta sync)
+    SYNC_REV_TABLES = (
+        "transactions", "pending_bills", "shopping_lists", "shopping_items",
+        "liabilities", "debtors", "sync_deletions",
+    )
+
+    def ensure_sync_revisions(self):
+        """
+        Licznik zmian dla synchronizacji przyrostowej. Każdy insert/update
+        w SYNC_REV_TABLES dostaje kolejny numer w kolumnie sync_rev, więc
+        "co się zmieniło od ostatniej wymiany" to zwykłe sync_rev > kursor.
+        """
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                revision INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.conn.execute("INSERT OR IGNORE INTO sync_state (id, revision) VALUES (1, 0)")
+        for table in self.SYNC_REV_TABLES:
+            try:
+                for event, cond in (("INSERT", ""), ("UPDATE", "WHEN new.sync_rev IS old.sync_rev")):
+                    self.conn.execute(f"""
+                        CREATE TRIGGER IF NOT EXISTS trg_{table}_sync_rev_{event.lower()}
+                        AFTER {event} ON {table} {cond}
+                        BEGIN
+                            UPDATE sync_state SET revision = revision + 1 WHERE id = 1;
+                            UPDATE {table} SET sync_rev = (SELECT revision FROM sync_state WHERE id = 1)
+                            WHERE rowid = new.rowid;
+                        END
+                    """)
+            except Exception as e:
+                print(f"Info: nie udało się założyć licznika zmian dla {table}: {e}")
+
+    def current_sync_revision(self, conn=None):
+        row = (conn or self.conn).execute("SELECT revision FROM sync_state WHERE id = 1").fetchone()
+        return int(row[0]) if row else 0
+
+    def get_sync_cursor(self, peer):
+        """
+        Znaczniki wymiany z danym urządzeniem: "since" - ostatnia rewizja
+        drugiej strony, którą mamy u siebie; "acked" - nasza rewizja potwierdzona
+        przez drugą stronę. None oznacza pełną wymianę.
+        """
+        cursors = self.get_config("sync_peer_cursors") or {}
+        state = cursors.get(str(peer or "")) if isinstance(cursors, dict) else None
+        if not isinstance(state, dict):
+            return {"since": None, "acked": None}
+        return {"since": state.get("since"), "acked": state.get("acked")}
+
+    def save_sync_cursor(self, peer, since=None, acked=None):
+        cursors = self.get_config("sync_peer_cursors") or {}
+        if not isinstance(cursors, dict):
+            cursors = {}
+        if since is None and acked is None:
+            cursors.pop(str(peer or ""), None)
+        else:
+            cursors[str(peer or "")] = {"since": since, "acked": acked}
+        self.save_config("sync_peer_cursors", cursors)
+
+    def _record_sync_origin(self, origin, rev_from):
+        """
+        Zapisuje (przed commit, pod write_lock), że rewizje nadane od rev_from
+        pochodzą z urządzenia origin. Zapisy idą tylko przez self.conn pod
+        write_lock, więc cały zakres to zmiany z importu.
+        """
+        rev_to = self.current_sync_revision()
+        if not origin or rev_to <= rev_from:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sync_import_ranges (peer, rev_from, rev_to) VALUES (?, ?, ?)",
+            (str(origin), int(rev_from), rev_to)
+        )
+        # Starsze zakresy leżą poniżej kursorów potwierdzonych przez urządzenie
+        self.conn.execute("""
+            DELETE FROM sync_import_ranges WHERE peer = ? AND rev_to NOT IN (
+                SELECT rev_to FROM sync_import_ranges WHERE peer = ? ORDER BY rev_to DESC LIMIT ?
+            )
+        """, (str(origin), str(origin), SYNC_ORIGIN_RANGES))
+
+    # Indeksy pełnotekstowe FTS5 (external content): (tabela FTS, tabela źródłowa, kolumny)
+    SEARCH_INDEXES = [
+        ("transactions_fts", "transactions", ("category", "subcategory", "details")),
+        ("pending_bills_fts", "pending_bills", ("category", "description")),
+        ("shopping_lists_fts", "shopping_lists", ("name",)),
+        ("shopping_items_fts", "shopping_items", ("product_name", "store")),
+    ]
+
+    def ensure_search_index(self):
+        """
+        Zakłada tabele FTS5 i wyzwalacze, które trzymają je w zgodzie z danymi.
+        Nowo założony indeks jest jednorazowo budowany z istniejących wierszy.
+        Bez FTS5 w SQLite wyszukiwanie wraca do zwykłego LIKE.
+        """
+        self.search_fts = True
+        for fts, table, columns in self.SEARCH_INDEXES:
+            try:
+                exists = self.conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (fts,)
+                ).fetchone()
+                cols = ", ".join(columns)
+                new_cols = ", ".join(f"new.{c}" for c in columns)
+                old_cols = ", ".join(f"old.{c}" for c in columns)
+                if not exists:
+                    self.conn.execute(f"""
+                        CREATE VIRTUAL TABLE {fts} USING fts5(
+                            {cols}, content='{table}', content_rowid='id',
+                            tokenize='unicode61 remove_diacritics 2'
+                        )
+                    """)
+                self.conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{fts}_insert AFTER INSERT ON {table} BEGIN
+                        INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_cols});
+                    END
+                """)
+                self.conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{fts}_delete AFTER DELETE ON {table} BEGIN
+                        INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                    END
+                """)
+                self.conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{fts}_update AFTER UPDATE OF id, {cols} ON {table} BEGIN
+                        INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                        INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_cols});
+                    END
+                """)
+                if not exists:
+                    self.conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+            except Exception as e:
+                self.search_fts = False
+                print(f"Info: wyszukiwanie pełnotekstowe niedostępne ({fts}): {e}")
+
+    @staticmethod
+    def _fts_term(word):
+        # Fraza w cudzysłowie z gwiazdką = wyszukiwanie po prefiksie, bez składni MATCH od użytkownika
+        return '"' + str(word).replace('"', '""') + '"*'
+
+    def search_index(self, text, table="transactions", limit=None, conn=None):
+        """Zwraca [(id, ranga)] z indeksu pełnotekstowego, najlepsze trafienia (bm25) najpierw."""
+        words = [tok[1] if tok[0] == "text" else tok[-1] for tok in parse_search_text(text)
+                 if tok[0] in ("text", "number")]
+        spec = next((item for item in self.SEARCH_INDEXES if item[1] == table), None)
+        if not words or not spec or not getattr(self, "search_fts", False):
+            return []
+        fts = spec[0]
+        query = f"SELECT rowid, bm25({fts}) FROM {fts} WHERE {fts} MATCH ? ORDER BY bm25({fts})"
+        params = [" AND ".join(self._fts_term(w) for w in words)]
+        if limit:
+            query += " LIMIT ?"
+            params.append(int(limit))
+        try:
+            return (conn or self.conn).execute(query, params).fetchall()
+        except sqlite3.OperationalError as e:
+            print(f"Błąd wyszukiwania: {e}")
+            return []
+
+    def _search_ranks(self, text, table, conn=None):
+        """
+        {id: ranga} wierszy tabeli pasujących do wszystkich słów (prefiksowo).
+        Z FTS5 ranga to bm25 (mniejsza = lepsza), bez niego LIKE i ranga 0.
+        None, gdy tekst nie zawiera słów do szukania.
+        """
+        words = [tok[1] if tok[0] == "text" else tok[-1] for tok in parse_search_text(text)
+                 if tok[0] in ("text", "number")]
+        if not words:
+            return None
+        if getattr(self, "search_fts", False):
+            return dict(self.search_index(text, table, conn=conn))
+        columns = next(item[2] for item in self.SEARCH_INDEXES if item[1] == table)
+        conditions = []
+        params = []
+        for word in words:
+            conditions.append("(" + " OR ".join(f"LOWER({c}) LIKE ?" for c in columns) + ")")
+            params.extend([f"%{word.lower()}%"] * len(columns))
+        rows = (conn or self.conn).execute(
+            f"SELECT id FROM {table} WHERE {' AND '.join(conditions)}", params
+        ).fetchall()
+        return {row[0]: 0.0 for row in rows}
+
+    def _search_text_condition(self, word, params):
+        if getattr(self, "search_fts", False):
+            params.append(self._fts_term(word))
+            return "id IN (SELECT rowid FROM transactions_fts WHERE transactions_fts MATCH ?)"
+        like = f"%{word}%"
+        params.extend([like, like, like])
+        return "(LOWER(category) LIKE ? OR LOWER(subcategory) LIKE ? OR LOWER(details) LIKE ?)"
+
+    def search_transactions(self, text, conn=None):
+        """
+        Wyszukiwanie z górnego paska. Daty, nazwy miesięcy i kwoty są filtrami
+        na kolumnach, słowa idą przez indeks FTS (prefiksowo). Wynik ma ten sam
+        format co get_all_transactions; ze słowami jest uporządkowany wg trafności.
+        """
+        tokens = parse_search_text(text)
+        if not tokens:
+            return self.get_all_transactions(conn)
+
+        conditions = []
+        params = []
+        for tok in tokens:
+            kind = tok[0]
+            if kind == "date":
+                conditions.append("date = ?")
+                params.append(tok[1])
+            elif kind == "date_prefix":
+                conditions.append("date LIKE ?")
+                params.append(f"{tok[1]}%")
+            elif kind == "month":
+                conditions.append("substr(date, 6, 2) = ?")
+                params.append(tok[1])
+            elif kind == "number":
+                value, has_decimals, raw = tok[1], tok[2], tok[3]
+                options = []
+                if has_decimals:
+                    options.append("ABS(ABS(amount) - ?) < 0.005")
+                    params.append(abs(value))
+                else:
+                    # "12" znajduje 12.00 - 12.99, tak jak wcześniej dopasowanie tekstowe kwoty
+                    options.append("(ABS(amount) >= ? AND ABS(amount) < ?)")
+                    params.extend([abs(value), abs(value) + 1])
+                if not has_decimals and len(raw) == 4 and 1900 <= value <= 2100:
+                    options.append("date LIKE ?")
+                    params.append(f"{raw}%")
+                options.append(self._search_text_condition(raw, params))
+                conditions.append("(" + " OR ".join(options) + ")")
+            else:
+                conditions.append(self._search_text_condition(tok[1], params))
+
+        try:
+            cursor = (conn or self.conn).execute(f"""
+                SELECT id, date, type, category, subcategory, amount, details,
+                CASE WHEN attachment IS NOT NULL AND attachment != '' THEN 1 ELSE 0 END,
+                account_id
+                FROM transactions
+                WHERE {" AND ".join(conditions)}
+                ORDER BY IFNULL(sync_order, IFNULL(updated_at, '')) DESC, id DESC
+            """, params)
+            rows = cursor.fetchall()
+        except sqlite3.OperationalError as e:
+            print(f"Błąd wyszukiwania: {e}")
+            return []
+        words = [tok[1] for tok in tokens if tok[0] == "text"]
+        if words and getattr(self, "search_fts", False):
+            # Najlepiej pasujące (bm25) na górze, przy równej randze najnowsze
+            ranks = dict(self.search_index(" ".join(words), conn=conn))
+            rows.sort(key=lambda row: ranks.get(row[0], 0.0))
+        return rows
+
+    ATTACHMENT_TABLES = ("transactions", "liabilities", "debtors")
+
+    def ensure_attachment_store(self):
+        """
+        Załączniki jako bloby nazwane skrótem sha256 (każda treść zapisana raz)
+        z licznikiem referencji utrzymywanym wyzwalaczami na kolumnach attachment.
+        Stare pliki (uuid.dat, uuid-nazwa) są jednorazowo przenoszone do blobów.
+        """
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS attachment_blobs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                touched_at TEXT
+            )
+        """)
+        new_blob = _BLOB_SQL.format(col="new.attachment")
+        old_blob = _BLOB_SQL.format(col="old.attachment")
+        add_ref = """
+            INSERT INTO attachment_blobs (sha256, refcount) VALUES (substr(new.attachment, 1, 64), 1)
+            ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1;
+        """
+        drop_ref = "UPDATE attachment_blobs SET refcount = refcount - 1 WHERE sha256 = substr(old.attachment, 1, 64);"
+        for table in self.ATTACHMENT_TABLES:
+            try:
+                self.conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_blob_insert
+                    AFTER INSERT ON {table} WHEN {new_blob}
+                    BEGIN {add_ref} END
+                """)
+                self.conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_blob_delete
+                    AFTER DELETE ON {table} WHEN {old_blob}
+                    BEGIN {drop_ref} END
+                """)
+                self.conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_blob_update_old
+                    AFTER UPDATE OF attachment ON {table}
+                    WHEN old.attachment IS NOT new.attachment AND {old_blob}
+                    BEGIN {drop_ref} END
+                """)
+                self.conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_blob_update_new
+                    AFTER UPDATE OF attachment ON {table}
+                    WHEN old.attachment IS NOT new.attachment AND {new_blob}
+                    BEGIN {add_ref} END
+                """)
+            except Exception as e:
+                print(f"Info: nie udało się założyć liczników załączników dla {table}: {e}")
+        return self._migrate_legacy_attachments()
+
+    def _migrate_legacy_attachments(self):
+        """Przenosi stare pliki do blobów; zwraca ścieżki do usunięcia po zatwierdzeniu transakcji."""
+        legacy = {}
+        for table in self.ATTACHMENT_TABLES:
+            try:
+                for (value,) in self.conn.execute(
+                    f"SELECT DISTINCT attachment FROM {table} WHERE attachment IS NOT NULL AND attachment != ''"
+                ).fetchall():
+                    if not ATTACHMENT_BLOB_RE.match(os.path.basename(value)):
+                        legacy.setdefault(value, []).append(table)
+            except Exception as e:
+                print(f"Info: pomijam migrację załączników {table}: {e}")
+        if not legacy:
+            return []
+        moved_files = []
+        for value, tables in legacy.items():
+            path = os.path.join(self.attachments_dir, os.path.basename(value))
+            if not os.path.isfile(path):
+                continue
+            sha = self._store_attachment_blob(source_path=path)
+            if not sha:
+                continue
+            new_value = self._attachment_value(sha, value)
+            for table in tables:
+                self.conn.execute(f"UPDATE {table} SET attachment=? WHERE attachment=?", (new_value, value))
+            moved_files.append(path)
+        if moved_files:
+            print(f"Sukces: Przeniesiono {len(moved_files)} załączników do magazynu blobów.")
+        return moved_files
+
+    def attachment_path(self, value):
+        """Ścieżka pliku dla wartości kolumny attachment (blob albo stary plik)."""
+        name = os.path.basename(str(value or ""))
+        if not name:
+            return None
+        match = ATTACHMENT_BLOB_RE.match(name)
+        return os.path.join(self.attachments_dir, match.group(1) if match else name)
+
+    def _attachment_value(self, sha, raw_name):
+        """Wartość kolumny attachment: skrót + czytelna nazwa (bez starego prefiksu uuid/sha)."""
+        name = self._safe_attachment_name(raw_name)
+        name = re.sub(r"^(?:[0-9a-f]{64}|[0-9a-f]{32})-", "", name) or "zalacznik.dat"
+        return f"{sha}-{name}"
+
+    def _store_attachment_blob(self, data=None, source_path=None, known_sha=""):
+        """
+        Zapisuje treść (bytes albo plik) jako blob i zwraca jej sha256.
+        Gdy blob o tym skrócie już istnieje, nic nie jest kopiowane.
+        """
+        known_sha = str(known_sha or "").strip().lower()
+        os.makedirs(self.attachments_dir, exist_ok=True)
+        if known_sha and os.path.isfile(os.path.join(self.attachments_dir, known_sha)):
+            self._touch_attachment_blob(known_sha)
+            return known_sha
+
+        import tempfile
+        fd, tmp_path = tempfile.mkstemp(prefix=".blob-", suffix=".tmp", dir=self.attachments_dir)
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                if data is not None:
+                    digest.update(data)
+                    dst.write(data)
+                else:
+                    with open(source_path, "rb") as src:
+                        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                            digest.update(chunk)
+                            dst.write(chunk)
+            sha = digest.hexdigest()
+            target = os.path.join(self.attachments_dir, sha)
+            if os.path.isfile(target):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, target)
+            self._touch_attachment_blob(sha)
+            return sha
+        except Exception as e:
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
+            print(f"Błąd zapisu załącznika: {e}")
+            return ""
+
+    def _touch_attachment_blob(self, sha):
+        path = os.path.join(self.attachments_dir, sha)
+        size = os.path.getsize(path) if os.path.isfile(path) else None
+        self.conn.execute("""
+            INSERT INTO attachment_blobs (sha256, size, refcount, touched_at) VALUES (?, ?, 0, ?)
+            ON CONFLICT(sha256) DO UPDATE SET size = excluded.size, touched_at = excluded.touched_at
+        """, (sha, size, self.sync_timestamp()))
+
+    @serialized_write
+    def collect_attachment_blobs(self, grace_seconds=60):
+        """
+        Usuwa bloby bez referencji. Świeżo zapisane (grace_seconds) zostają,
+        bo wiersz, który ich użyje, może być jeszcze w trakcie zapisu.
+        """
+        limit = (datetime.utcnow() - timedelta(seconds=grace_seconds)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+        try:
+            rows = self.conn.execute(
+                "SELECT sha256 FROM attachment_blobs WHERE refcount <= 0 AND (touched_at IS NULL OR touched_at < ?)",
+                (limit,)
+            ).fetchall()
+            if not rows:
+                return 0
+            for (sha,) in rows:
+                self.conn.execute("DELETE FROM attachment_blobs WHERE sha256=? AND refcount <= 0", (sha,))
+            self.conn.commit()
+        except Exception as e:
+            print(f"Info: nie udało się posprzątać załączników: {e}")
+            return 0
+        removed = 0
+        for (sha,) in rows:
+            try:
+                os.remove(os.path.join(self.attachments_dir, sha))
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Info: nie udało się usunąć pliku załącznika {sha}: {e}")
+        return removed
+
+    def ensure_monthly_totals(self):
+        """
+        Tabela sum miesiąc x konto x typ utrzymywana triggerami na transactions.
+        Przy pierwszym uruchomieniu (albo po przywróceniu starej kopii) jest
+        jednorazowo wypełniana z całej historii.
+        """
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='monthly_account_totals'"
+        ).fetchone()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS monthly_account_totals (
+                month TEXT NOT NULL,
+                account_id INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                total REAL NOT NULL DEFAULT 0,
+                row_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (month, account_id, type)
+            )
+        """)
+        if not exists:
+            self.rebuild_monthly_totals()
+
+        add_new = """
+            INSERT INTO monthly_account_totals (month, account_id, type, total, row_count)
+            VALUES (substr(IFNULL(NEW.date, ''), 1, 7), IFNULL(NEW.account_id, 0), IFNULL(NEW.type, ''), IFNULL(NEW.amount, 0), 1)
+            ON CONFLICT(month, account_id, type)
+            DO UPDATE SET total = total + excluded.total, row_count = row_count + 1;
+        """
+        remove_old = """
+            UPDATE monthly_account_totals
+            SET total = total - IFNULL(OLD.amount, 0), row_count = row_count - 1
+            WHERE month = substr(IFNULL(OLD.date, ''), 1, 7)
+              AND account_id = IFNULL(OLD.account_id, 0)
+              AND type = IFNULL(OLD.type, '');
+            DELETE FROM monthly_account_totals WHERE row_count <= 0;
+        """
+        self.conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_monthly_totals_insert
+            AFTER INSERT ON transactions
+            BEGIN {add_new} END
+        """)
+        self.conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_monthly_totals_update
+            AFTER UPDATE OF date, type, amount, account_id ON transactions
+            BEGIN {remove_old} {add_new} END
+        """)
+        self.conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_monthly_totals_delete
+            AFTER DELETE ON transactions
+            BEGIN {remove_old} END
+        """)
+
+    def rebuild_monthly_totals(self):
+        """Przelicza monthly_account_totals od zera na podstawie transactions."""
+        self.conn.execute("DELETE FROM monthly_account_totals")
+        self.conn.execute("""
+            INSERT INTO monthly_account_totals (month, account_id, type, total, row_count)
+            SELECT substr(IFNULL(date, ''), 1, 7), IFNULL(account_id, 0), IFNULL(type, ''),
+                   SUM(IFNULL(amount, 0)), COUNT(*)
+            FROM transactions
+            GROUP BY 1, 2, 3
+        """)
+
+    def _type_totals(self, account_id=None, before=None, until=None):
+        """
+        Sumy kwot per typ transakcji: z miesięcy zamkniętych bierze gotowe sumy
+        z monthly_account_totals, a tylko z miesiąca granicznego czyta transakcje.
+        before - data < before, until - data <= until (format YYYY-MM-DD).
+        """
+        limit = before if before is not None else until
+        totals = {}
+
+        query = "SELECT type, SUM(total) FROM monthly_account_totals WHERE 1=1"
+        params = []
+        if account_id is not None:
+            query += " AND account_id = ?"
+            params.append(account_id)
+        if limit is not None:
+            query += " AND month < ?"
+            params.append(str(limit)[:7])
+        query += " GROUP BY type"
+        for t_type, amt in self.conn.execute(query, params).fetchall():
+            totals[t_type] = totals.get(t_type, 0.0) + (amt or 0.0)
+
+        if limit is not None:
+            query = "SELECT type, SUM(amount) FROM transactions WHERE date >= ?"
+            params = [str(limit)[:7]]
+            query += " AND date < ?" if before is not None else " AND date <= ?"
+            params.append(limit)
+            if account_id is not None:
+                query += " AND account_id = ?"
+                params.append(account_id)
+            query += " GROUP BY type"
+            for t_type, amt in self.conn.execute(query, params).fetchall():
+                totals[t_type] = totals.get(t_type, 0.0) + (amt or 0.0)
+        return totals
 
     def initialize_config(self):
         if not self.get_config("backup_config"):
@@ -235,18 +1632,27 @@ class DatabaseManager:
         if not self.get_config("weekly_limit_config"):
             self.save_config("weekly_limit_config", {"enabled": False, "amount": 500.0, "categories": self.get_categories()})
 
-    def get_config(self, key):
-        cursor = self.conn.execute("SELECT value FROM app_config WHERE key=?", (key,))
+    def get_config(self, key, conn=None):
+        value = self.query_cache.get(
+            ("config", key), ("app_config",), lambda: self._load_config(key, conn), store=conn is None
+        )
+        # Słowniki i listy z konfiguracji bywają modyfikowane przed zapisem - oddajemy kopię
+        return copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+    def _load_config(self, key, conn=None):
+        cursor = (conn or self.conn).execute("SELECT value FROM app_config WHERE key=?", (key,))
         res = cursor.fetchone()
         if res:
             try: return json.loads(res[0])
             except: return res[0]
         return None
 
+    @serialized_write
     def save_config(self, key, value):
         json_val = json.dumps(value)
         self.conn.execute("INSERT OR REPLACE INTO app_config (key, value) VALUES (?, ?)", (key, json_val))
         self.conn.commit()
+        self.query_cache.bump("app_config")
 
     # --- TUTAJ DODAJEMY NOWE METODY ---
 
@@ -257,6 +1663,7 @@ class DatabaseManager:
         # Sprawdzamy różne warianty zapisu prawdy w SQLite
         return str(res).lower() in ['true', '1', 'yes', 't', 'y']
 
+    @serialized_write
     def set_config(self, key, value):
         """Zapisuje prostą wartość (np. bool lub string) do konfiguracji."""
         # Konwertujemy na string "1"/"0" dla SQLite, co ułatwia późniejszy odczyt
@@ -267,6 +1674,7 @@ class DatabaseManager:
 
         self.conn.execute("INSERT OR REPLACE INTO app_config (key, value) VALUES (?, ?)", (key, val_to_save))
         self.conn.commit()
+        self.query_cache.bump("app_config")
 
     # ----------------------------------
 
@@ -329,12 +1737,8 @@ class DatabaseManager:
 
     def _delete_local_synced_row(self, table_name, row_id):
         if table_name == "transactions":
-            res = self.conn.execute("SELECT attachment FROM transactions WHERE id=?", (row_id,)).fetchone()
-            if res and res[0]:
-                try:
-                    os.remove(os.path.join(self.attachments_dir, os.path.basename(res[0])))
-                except Exception:
-                    pass
+            # Plik załącznika zwalnia licznik referencji (wyzwalacz), blob sprząta collect_attachment_blobs
+            self.aggregates.touch(row_id)
         elif table_name == "shopping_lists":
             self.conn.execute("DELETE FROM shopping_items WHERE list_id=?", (row_id,))
 
@@ -359,14 +1763,15 @@ class DatabaseManager:
             return "deleted"
         return "updated" if changed_tombstone else None
 
-    def _export_sync_deletions(self):
+    def _export_sync_deletions(self, since=None, conn=None, peer=""):
         return [
             {"table_name": table_name, "sync_id": sync_id, "deleted_at": deleted_at}
-            for table_name, sync_id, deleted_at in self.conn.execute("""
+            for table_name, sync_id, deleted_at in (conn or self.conn).execute(f"""
                 SELECT table_name, sync_id, deleted_at
                 FROM sync_deletions
+                WHERE {self.SYNC_DELTA_FILTER.format(rev="sync_rev")}
                 ORDER BY deleted_at, table_name, sync_id
-            """).fetchall()
+            """, (since, since, str(peer or ""))).fetchall()
         ]
 
     def ensure_transaction_sync_metadata(self):
@@ -423,41 +1828,36 @@ class DatabaseManager:
         if not cfg: return False, 0.0, None
         return cfg.get("enabled", False), cfg.get("amount", 0.0), cfg.get("categories", None)
 
-    def run_fix_savings_names(self):
-        """Jednorazowa poprawka nazw podkategorii oszczędności."""
-        try:
-            # Sprawdzamy, czy w ogóle mamy coś do poprawienia
-            check = self.conn.execute(
-                "SELECT COUNT(*) FROM transactions WHERE subcategory = 'Oszczędności gotówka'"
-            ).fetchone()[0]
+    def _migrate_savings_names(self):
+        """Migracja 3: poprawka nazw podkategorii oszczędności."""
+        cursor = self.conn.execute(
+            "UPDATE transactions SET subcategory = 'Oszczędności' WHERE subcategory = 'Oszczędności gotówka'"
+        )
+        if cursor.rowcount > 0:
+            print(f"Sukces: Zaktualizowano {cursor.rowcount} wpisów z 'Oszczędności gotówka' na 'Oszczędności'.")
 
-            if check > 0:
-                self.conn.execute("BEGIN TRANSACTION")
-                self.conn.execute(
-                    "UPDATE transactions SET subcategory = 'Oszczędności' WHERE subcategory = 'Oszczędności gotówka'"
-                )
-                self.conn.commit()
-                print(f"Sukces: Zaktualizowano {check} wpisów z 'Oszczędności gotówka' na 'Oszczędności'.")
-            else:
-                # Jeśli check == 0, to znaczy, że albo już to zrobiliśmy, albo nie było takich wpisów
-                pass
-        except Exception as e:
-            self.conn.rollback()
-            print(f"Błąd podczas aktualizacji nazw oszczędności: {e}")
+    def _migrate_sync_origins(self):
+        """
+        Migracja 4: zakresy rewizji nadanych przez import z danego urządzenia
+        (peer - adres jak w kursorach synchronizacji, rev_from < sync_rev <= rev_to).
+        Eksport przyrostowy do tego urządzenia je pomija, więc nie odsyła mu
+        jego własnych zmian.
+        """
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_import_ranges (
+                peer TEXT NOT NULL,
+                rev_from INTEGER NOT NULL,
+                rev_to INTEGER NOT NULL,
+                PRIMARY KEY (peer, rev_to)
+            )
+        """)
 
-    def update_goals_table_structure(self):
-        """Dodaje brakującą kolumnę default_account_id do tabeli goals."""
-        try:
-            # Próbujemy dodać kolumnę. Jeśli już istnieje, SQLite rzuci błędem, który przechwycimy.
-            self.conn.execute("ALTER TABLE goals ADD COLUMN default_account_id INTEGER")
-            self.conn.commit()
-            print("Sukces: Dodano kolumnę default_account_id do tabeli goals.")
-        except Exception as e:
-            # Jeśli błąd zawiera informację, że kolumna już jest, to ignorujemy go
-            if "duplicate column name" in str(e).lower():
-                pass
-            else:
-                print(f"Informacja: {e}")
+    def _migrate_drop_attachment_hashes(self):
+        """
+        Migracja 5: usuwa cache skrótów attachment_hashes. Po przeniesieniu
+        załączników do blobów (migracja 2) skrót jest w nazwie pliku.
+        """
+        self.conn.execute("DROP TABLE IF EXISTS attachment_hashes")
 
     def _copy_with_progress(self, src, dst, progress_callback=None):
         """Kopiuje plik bajt po bajcie, informując o postępie."""
@@ -479,9 +1879,13 @@ class DatabaseManager:
                         progress_callback(percent)
 
     def perform_backup(self, progress_callback=None):
+        """
+        Kopia przyrostowa do repozytorium BackupRepository w lokalizacji backupu:
+        zapisywane są tylko nowe fragmenty bazy i nowe załączniki, a sama kopia
+        to mały manifest. Gdy od ostatniej kopii nic się nie zmieniło, nowy
+        manifest nie powstaje. Zwraca (True, ścieżka manifestu) albo (False, błąd).
+        """
         import os
-        import zipfile
-        from datetime import datetime
         from config import _
 
         cfg = self.get_config("backup_config")
@@ -490,41 +1894,173 @@ class DatabaseManager:
         if not target_dir or not os.path.exists(target_dir):
             return False, _("Brak prawidłowej ścieżki backupu")
 
-        filename = f"{datetime.now().strftime('%Y-%m-%d')}.zip"
-        target_path = os.path.join(target_dir, filename)
+        repo = BackupRepository(os.path.join(target_dir, BACKUP_REPO_DIR))
+        try:
+            repo.ensure()
+            previous_path, previous = repo.latest_manifest()
+            # Niezatwierdzone zmiany głównego połączenia też mają trafić do kopii
+            with self.write_lock:
+                self.conn.commit()
+            codec = cfg.get("codec", BACKUP_DEFAULT_CODEC)
+            if codec not in BACKUP_CODECS:
+                codec = BACKUP_DEFAULT_CODEC
+            db_entry = self._backup_db_file(repo, previous, codec, progress_callback)
+            if progress_callback:
+                progress_callback(40)
+
+            attachments = self._backup_attachments(repo, previous, codec, progress_callback)
+
+            if previous and self._backup_content(previous) == self._backup_content({"db": db_entry, "attachments": attachments}):
+                # Ta sama treść - odświeżamy tylko zapamiętane daty plików, żeby
+                # następne porównanie znów nie musiało liczyć skrótów
+                if previous["db"] != db_entry or previous.get("attachments") != attachments:
+                    previous["db"], previous["attachments"] = db_entry, attachments
+                    repo.write_manifest(previous, previous_path)
+                if progress_callback:
+                    progress_callback(100)
+                return True, previous_path
 
+            manifest = {
+                "format": BACKUP_FORMAT,
+                "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "db": db_entry,
+                "attachments": attachments,
+            }
+            manifest_path = repo.write_manifest(manifest)
+            self._cleanup_backups(repo)
+            if progress_callback:
+                progress_callback(100)
+            return True, manifest_path
+        except Exception as e:
+            return False, str(e)
+
+    @staticmethod
+    def _backup_content(manifest):
+        """To, co decyduje o treści kopii (bez dat modyfikacji plików)."""
+        return (
+            manifest["db"].get("sha256"),
+            {name: entry["sha256"] for name, entry in manifest.get("attachments", {}).items()},
+        )
+
+    def _db_file_state(self):
+        """Rozmiar i data modyfikacji bazy oraz pliku -wal - każdy zapis zmienia któryś z nich."""
+        state = []
+        for path in (self.db_path, self.db_path + "-wal"):
+            try:
+                st = os.stat(path)
+                state += [st.st_size, st.st_mtime_ns]
+            except FileNotFoundError:
+                state += [0, 0]
+        return state
+
+    def _snapshot_database(self, target_path, progress_callback=None):
+        """
+        Spójna kopia bazy przez sqlite3 backup API, po BACKUP_STEP_PAGES stron
+        na krok. Źródłem jest połączenie z puli odczytu w otwartej transakcji,
+        więc zapisy innych połączeń (GUI, serwer synchronizacji) nie blokują
+        się na kopii ani nie rozrywają jej w połowie.
+        """
+        def on_step(status, remaining, total):
+            if progress_callback and total:
+                progress_callback(int((total - remaining) / total * 20))
+
+        target = sqlite3.connect(target_path)
+        try:
+            with self.read_connection(snapshot=True) as source:
+                # BEGIN jest leniwy - dopiero odczyt przypina migawkę na czas wszystkich kroków
+                source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+                source.backup(target, pages=BACKUP_STEP_PAGES, progress=on_step)
+        finally:
+            target.close()
+
+    def _backup_db_file(self, repo, previous, codec=BACKUP_DEFAULT_CODEC, progress_callback=None):
+        """
+        Migawka bazy (_snapshot_database) do pliku tymczasowego, a z niej fragmenty
+        BACKUP_CHUNK_SIZE; do repozytorium trafiają tylko nowe. Gdy pliki bazy
+        nie zmieniły się od poprzedniej kopii, migawka w ogóle nie powstaje.
+        """
+        import tempfile
+        state = self._db_file_state()
+        prev_db = previous.get("db") if previous else None
+        if prev_db and prev_db.get("source") == state and prev_db.get("chunk_size") == BACKUP_CHUNK_SIZE:
+            return dict(prev_db)
+
+        fd, tmp_path = tempfile.mkstemp(prefix=".snapshot-", suffix=".db", dir=os.path.dirname(os.path.abspath(self.db_path)))
+        os.close(fd)
         try:
-            with zipfile.ZipFile(target_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                zipf.write(self.db_path, "budzet.db")
+            self._snapshot_database(tmp_path, progress_callback)
+            size = os.path.getsize(tmp_path)
+            total_chunks = max(1, -(-size // BACKUP_CHUNK_SIZE))
+            digest = hashlib.sha256()
+
+            def read_chunks(f):
+                for chunk in iter(lambda: f.read(BACKUP_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    yield chunk, ""
+
+            def on_stored(count):
                 if progress_callback:
-                    progress_callback(30)
+                    progress_callback(20 + int(count / total_chunks * 20))
+
+            with open(tmp_path, "rb") as f:
+                chunks = repo.put_objects(read_chunks(f), codec, on_stored)
+        finally:
+            for suffix in ("", "-journal", "-wal", "-shm"):
+                if os.path.exists(tmp_path + suffix):
+                    os.remove(tmp_path + suffix)
+        return {
+            "name": "budzet.db",
+            "size": size,
+            "source": state,
+            "sha256": digest.hexdigest(),
+            "chunk_size": BACKUP_CHUNK_SIZE,
+            "chunks": chunks,
+        }
 
-                if os.path.exists(self.attachments_dir):
-                    files = [f for f in os.listdir(self.attachments_dir) if os.path.isfile(os.path.join(self.attachments_dir, f))]
-                    total_files = len(files)
-                    for i, f in enumerate(files):
-                        file_full_path = os.path.join(self.attachments_dir, f)
-                        zipf.write(file_full_path, os.path.join("attachments", f))
+    def _backup_attachments(self, repo, previous, codec=BACKUP_DEFAULT_CODEC, progress_callback=None):
+        """
+        Załączniki jako obiekty repozytorium. Bloby mają w nazwie swój sha256,
+        więc zapisany już blob nie jest nawet czytany; pozostałe pliki są
+        porównywane z poprzednią kopią po rozmiarze i dacie modyfikacji.
+        Nowe pliki są kompresowane równolegle (put_objects).
+        """
+        attachments = {}
+        if not os.path.isdir(self.attachments_dir):
+            return attachments
+        prev_attachments = previous.get("attachments", {}) if previous else {}
+        to_store = []
+        for entry in os.scandir(self.attachments_dir):
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            st = entry.stat()
+            prev = prev_attachments.get(entry.name)
+            if prev and prev.get("size") == st.st_size and prev.get("mtime_ns") == st.st_mtime_ns:
+                sha = prev["sha256"]
+            elif re.fullmatch(r"[0-9a-f]{64}", entry.name) and repo.has_object(entry.name):
+                sha = entry.name
+            else:
+                to_store.append(entry)
+                sha = None
+            attachments[entry.name] = {"sha256": sha, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
 
-                        if progress_callback and total_files > 0:
-                            p = 30 + int((i + 1) / total_files * 70)
-                            progress_callback(p)
+        def read_files():
+            for entry in to_store:
+                with open(entry.path, "rb") as f:
+                    yield f.read(), entry.name
 
-            self._cleanup_backups(target_dir)
-            return True, target_path
-        except Exception as e:
-            return False, str(e)
+        def on_stored(count):
+            if progress_callback:
+                progress_callback(40 + int(count / len(to_store) * 60))
 
-    def _cleanup_backups(self, folder):
-        import glob
-        import os
+        for entry, sha in zip(to_store, repo.put_objects(read_files(), codec, on_stored)):
+            attachments[entry.name]["sha256"] = sha
+        return attachments
+
+    def _cleanup_backups(self, repo):
         try:
-            files = glob.glob(os.path.join(folder, "*.zip"))
-            files.sort(key=os.path.getmtime)
-            while len(files) > 10:
-                oldest = files.pop(0)
-                os.remove(oldest)
-        except: pass
+            repo.prune(BACKUP_KEEP)
+        except Exception as e:
+            print(f"Info: nie udało się posprzątać starych kopii: {e}")
 
     def _safe_backup_member_path(self, base_dir, member):
         import os
@@ -547,68 +2083,286 @@ class DatabaseManager:
             shutil.copyfileobj(src, dst)
 
     def restore_database(self, backup_file, progress_callback=None):
-        import os
-        import gc
+        """
+        Przywraca bazę i załączniki z manifestu repozytorium kopii albo ze starego
+        pliku ZIP. Kopia jest najpierw rozpakowywana (równolegle) do katalogu
+        RESTORE_STAGING_DIR obok bazy i sprawdzana: sumy CRC/sha256 każdego wpisu
+        oraz PRAGMA integrity_check. Dopiero potem bieżące dane są podmieniane
+        zmianą nazw; błąd podmiany cofa ją, a przerwaną awarią kończy
+        następne uruchomienie (_finish_staged_restore).
+        """
         import zipfile
         import shutil
-        import sqlite3
         if not os.path.exists(backup_file): return False
 
+        staging = self._restore_staging_dir()
         try:
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(os.path.join(staging, "attachments"))
+            if zipfile.is_zipfile(backup_file):
+                self._stage_zip_files(backup_file, staging, progress_callback)
+            else:
+                manifest = BackupRepository.load_manifest(backup_file)
+                self._stage_manifest_files(backup_file, manifest, staging, progress_callback)
+            self._verify_staged_database(os.path.join(staging, os.path.basename(self.db_path)))
+            if progress_callback:
+                progress_callback(85)
+            with open(os.path.join(staging, RESTORE_READY_MARKER), "w", encoding="utf-8") as f:
+                f.write(os.path.abspath(backup_file))
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            # Bieżąca baza i załączniki są nietknięte
+            print(f"Błąd przywracania: {e}")
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+
+        # Wątki w tle oddają połączenia do odczytu, zanim pliki bazy zmienią nazwę
+        # (otwarty plik blokuje podmianę w Windows)
+        try:
+            if not self._drain_readers():
+                print("Błąd przywracania: połączenia do odczytu wciąż zajęte")
+                shutil.rmtree(staging, ignore_errors=True)
+                return False
+            # Podmiana pod write_lock: żaden zapis w tle nie trafi na zamykane połączenie
+            with self.write_lock:
+                return self._swap_staged_restore(progress_callback)
+        finally:
+            self._resume_readers()
+
+    def _swap_staged_restore(self, progress_callback=None):
+        """
+        Podmienia bazę na kopię z katalogu staging i otwiera ją od nowa.
+        Przy błędzie cofa podmianę (_rollback_staged_restore) i wraca do
+        poprzedniej bazy - po nieudanym przywracaniu nie zostaje nic.
+        """
+        import gc
+        try:
+            self.close_readers()
             self.conn.close()
             self.conn = None
             gc.collect()
+            # Po zamknięciu ostatniego połączenia SQLite przenosi WAL do pliku bazy
+            # i go usuwa; jeśli WAL został, bazę trzyma otwartą inny proces
+            if os.path.exists(self.db_path + "-wal"):
+                raise RuntimeError("Baza jest otwarta w innym programie")
+
+            self._apply_staged_restore()
+            if progress_callback:
+                progress_callback(95)
+
+            self.conn = self._connect()
+            self.aggregates.invalidate()
+            self.query_cache.clear()
+            self.prepare_database()
+            self._cleanup_staged_restore()
+            if progress_callback:
+                progress_callback(100)
+            return True
+        except Exception as e:
+            print(f"Błąd przywracania: {e}")
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+            try:
+                self._rollback_staged_restore()
+            except Exception as e:
+                print(f"Błąd cofania przywracania: {e}")
+            self.conn = self._connect()
+            self.aggregates.invalidate()
+            self.query_cache.clear()
+            return False
 
-            with zipfile.ZipFile(backup_file, 'r') as zipf:
-                contents = zipf.namelist()
-
-                if "budzet.db" not in contents:
-                    raise ValueError("Nieprawidlowy plik kopii: brak budzet.db")
-
-                if progress_callback:
-                    progress_callback(20)
-
-                self._copy_backup_member(zipf, "budzet.db", self.db_path)
-                if progress_callback:
-                    progress_callback(50)
+    def _restore_staging_dir(self):
+        return os.path.join(os.path.dirname(os.path.abspath(self.db_path)), RESTORE_STAGING_DIR)
 
-                if os.path.exists(self.attachments_dir):
-                    shutil.rmtree(self.attachments_dir)
-                os.makedirs(self.attachments_dir, exist_ok=True)
+    def _stage_zip_files(self, backup_file, staging, progress_callback=None):
+        """
+        Kopia w starym formacie (ZIP z budzet.db i katalogiem attachments/)
+        rozpakowana do staging. zipfile sprawdza CRC każdego wpisu przy
+        odczycie do końca, więc uszkodzony wpis przerywa przywracanie.
+        """
+        import zipfile
+        with zipfile.ZipFile(backup_file, 'r') as zipf:
+            contents = zipf.namelist()
 
-                db_dir = os.path.abspath(os.path.dirname(self.db_path))
-                attachments_dir = os.path.abspath(self.attachments_dir)
-                for member in contents:
-                    if not member.startswith("attachments/") or member.endswith("/"):
-                        continue
-                    target = self._safe_backup_member_path(db_dir, member)
-                    if os.path.commonpath([attachments_dir, os.path.abspath(target)]) != attachments_dir:
-                        raise ValueError("Nieprawidlowy wpis ZIP")
-                    self._copy_backup_member(zipf, member, target)
+            if "budzet.db" not in contents:
+                raise ValueError("Nieprawidlowy plik kopii: brak budzet.db")
 
+            staged_attachments = os.path.abspath(os.path.join(staging, "attachments"))
+            jobs = [("budzet.db", os.path.join(staging, os.path.basename(self.db_path)))]
+            for member in contents:
+                if not member.startswith("attachments/") or member.endswith("/"):
+                    continue
+                target = self._safe_backup_member_path(staging, member)
+                if os.path.commonpath([staged_attachments, os.path.abspath(target)]) != staged_attachments:
+                    raise ValueError("Nieprawidlowy wpis ZIP")
+                jobs.append((member, target))
+
+            if progress_callback:
+                progress_callback(5)
+
+            # ZipFile pozwala czytać wpisy z kilku wątków; dekompresja zwalnia GIL
+            workers = max(1, min(8, os.cpu_count() or 1))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(self._copy_backup_member, zipf, member, target) for member, target in jobs]
+                for i, future in enumerate(futures):
+                    future.result()
+                    if progress_callback:
+                        progress_callback(5 + int((i + 1) / len(futures) * 65))
+
+    def _stage_manifest_files(self, manifest_path, manifest, staging, progress_callback=None):
+        """Składa bazę z fragmentów i odtwarza załączniki z manifestu w katalogu staging."""
+        repo = BackupRepository.for_manifest(manifest_path)
+        attachments = manifest.get("attachments", {})
+        for name in attachments:
+            if not name or os.path.basename(name) != name or name.startswith("."):
+                raise ValueError("Nieprawidlowy wpis manifestu")
+        # Zanim cokolwiek rozpakujemy: czy repozytorium ma wszystkie potrzebne obiekty
+        missing = [sha for sha in BackupRepository.manifest_objects(manifest) if not repo.has_object(sha)]
+        if missing:
+            raise ValueError(f"Brak {len(missing)} obiektów kopii w {repo.objects_dir}")
+
+        if progress_callback:
+            progress_callback(5)
+
+        chunks = manifest["db"]["chunks"]
+        digest = hashlib.sha256()
+        with open(os.path.join(staging, os.path.basename(self.db_path)), "wb") as dst:
+            for i, chunk in enumerate(repo.get_objects(chunks)):
+                digest.update(chunk)
+                dst.write(chunk)
                 if progress_callback:
-                    progress_callback(100)
-
-            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-            self.create_tables()
-            self.update_goals_table_structure()
-            self.run_fix_savings_names()
-            self.initialize_config()
-            return True
+                    progress_callback(5 + int((i + 1) / len(chunks) * 25))
+        if digest.hexdigest() != manifest["db"].get("sha256"):
+            raise ValueError("Suma kontrolna przywróconej bazy się nie zgadza")
+
+        names = list(attachments)
+        staged_attachments = os.path.join(staging, "attachments")
+        for i, (name, data) in enumerate(zip(names, repo.get_objects(attachments[n]["sha256"] for n in names))):
+            with open(os.path.join(staged_attachments, name), "wb") as dst:
+                dst.write(data)
+            if progress_callback:
+                progress_callback(30 + int((i + 1) / len(names) * 40))
+
+    def _verify_staged_database(self, path):
+        """PRAGMA integrity_check na rozpakowanej bazie - uszkodzona kopia nie zastąpi bieżącej."""
+        conn = sqlite3.connect(path)
+        try:
+            rows = conn.execute("PRAGMA integrity_check").fetchall()
+            conn.execute("SELECT count(*) FROM transactions").fetchone()
+        finally:
+            conn.close()
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        if rows != [("ok",)]:
+            raise ValueError("Baza z kopii jest uszkodzona: " + "; ".join(str(r[0]) for r in rows[:5]))
+
+    def _resume_staged_restore(self):
+        """Kończy przywracanie przerwane w trakcie podmiany plików (przed otwarciem bazy)."""
+        try:
+            self._finish_staged_restore()
         except Exception as e:
-            print(f"Błąd przywracania: {e}")
-            if not self.conn:
-                self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-            return False
+            print(f"Błąd kończenia przywracania kopii: {e}")
+
+    def _finish_staged_restore(self):
+        """
+        Kończy podmianę przerwaną awarią (wołane z __init__ przed otwarciem bazy).
+        Znacznik gotowości jest usuwany dopiero na końcu podmiany albo jej
+        cofania, więc jego obecność znaczy, że kopię trzeba dokończyć. Katalog
+        bez znacznika to przerwane rozpakowywanie - jest po prostu usuwany.
+        """
+        import shutil
+        staging = self._restore_staging_dir()
+        if not os.path.isdir(staging):
+            return
+        if not os.path.exists(os.path.join(staging, RESTORE_READY_MARKER)):
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        self._apply_staged_restore()
+        self._cleanup_staged_restore()
 
+    def _apply_staged_restore(self):
+        """
+        Przenosi kopię z katalogu staging na miejsce bazy, potem załączników.
+        Bieżące pliki nie są kasowane, tylko odkładane jako .old (do cofnięcia).
+        Każdy krok to zmiana nazwy i można go bezpiecznie powtórzyć.
+        """
+        import shutil
+        staging = self._restore_staging_dir()
+        staged_db = os.path.join(staging, os.path.basename(self.db_path))
+        old_db = self.db_path + ".old"
+        if os.path.exists(staged_db):
+            if os.path.exists(self.db_path):
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(old_db + suffix):
+                        os.remove(old_db + suffix)
+                # Razem z bazą odkładany jest jej WAL - nie może trafić do przywróconej
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(self.db_path + suffix):
+                        os.replace(self.db_path + suffix, old_db + suffix)
+            os.replace(staged_db, self.db_path)
+
+        staged_attachments = os.path.join(staging, "attachments")
+        old_attachments = self.attachments_dir + ".old"
+        if os.path.isdir(staged_attachments):
+            if os.path.isdir(self.attachments_dir):
+                shutil.rmtree(old_attachments, ignore_errors=True)
+                os.replace(self.attachments_dir, old_attachments)
+            os.replace(staged_attachments, self.attachments_dir)
+
+    def _cleanup_staged_restore(self):
+        """Usuwa znacznik, katalog staging i odłożone pliki .old po udanej podmianie."""
+        import shutil
+        staging = self._restore_staging_dir()
+        os.remove(os.path.join(staging, RESTORE_READY_MARKER))
+        shutil.rmtree(staging, ignore_errors=True)
+        shutil.rmtree(self.attachments_dir + ".old", ignore_errors=True)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.db_path + ".old" + suffix):
+                os.remove(self.db_path + ".old" + suffix)
+
+    def _rollback_staged_restore(self):
+        """
+        Cofa przerwaną podmianę: pliki .old wracają na miejsce, a przywrócone
+        do katalogu staging. Znacznik i staging są usuwane na samym końcu -
+        awaria w trakcie cofania zostawia stan, który następne uruchomienie
+        dokończy jak zwykłą podmianę.
+        """
+        import shutil
+        staging = self._restore_staging_dir()
+        old_attachments = self.attachments_dir + ".old"
+        if os.path.isdir(old_attachments):
+            if os.path.isdir(self.attachments_dir):
+                os.replace(self.attachments_dir, os.path.join(staging, "attachments"))
+            os.replace(old_attachments, self.attachments_dir)
+
+        old_db = self.db_path + ".old"
+        if os.path.exists(old_db):
+            if os.path.exists(self.db_path):
+                os.replace(self.db_path, os.path.join(staging, os.path.basename(self.db_path)))
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(self.db_path + suffix):
+                    os.remove(self.db_path + suffix)
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(old_db + suffix):
+                    os.replace(old_db + suffix, self.db_path + suffix)
+
+        marker = os.path.join(staging, RESTORE_READY_MARKER)
+        if os.path.exists(marker):
+            os.remove(marker)
+        shutil.rmtree(staging, ignore_errors=True)
+
+    @serialized_write
     def add_transaction(self, date, t_type, category, subcategory, amount, exclude=0, details="", attachment=None, ref_id=None, account_id=1, commit=True):
+        # commit=False: wołający trzyma write_lock aż do własnego commit (jak transfer_savings)
         filename = None
         if attachment and isinstance(attachment, bytes):
-            filename = f"{uuid.uuid4().hex}.dat"
-            with open(os.path.join(self.attachments_dir, filename), "wb") as f:
-                f.write(attachment)
+            sha = self._store_attachment_blob(data=attachment)
+            filename = self._attachment_value(sha, "zalacznik.dat") if sha else None
 
-        self.conn.execute("""
+        cur = self.conn.execute("""
             INSERT INTO transactions (
                 date, type, category, subcategory, amount,
                 currency, exchange_rate, exclude_from_weekly,
@@ -617,10 +2371,12 @@ class DatabaseManager:
             VALUES (?, ?, ?, ?, ?, 'PLN', 1.0, ?, ?, ?, ?, ?, ?, ?, ?)""",
             (date, t_type, category, subcategory, amount, exclude, details, filename, ref_id, account_id,
              str(uuid.uuid4()), self.sync_timestamp(), self.sync_order_value()))
+        self.aggregates.touch(cur.lastrowid)
 
         if commit:
             self.conn.commit()
 
+    @serialized_write
     def transfer_savings(self, from_acc_id, to_acc_id, amount, goal_name):
         """Migracja oszczędności z pobieraniem nazw kont mBank/Gotówka zamiast ID."""
         from datetime import datetime
@@ -665,9 +2421,11 @@ class DatabaseManager:
         except Exception as e:
             if self.conn.in_transaction:
                 self.conn.rollback()
+            self.aggregates.invalidate()
             print(f"Błąd migracji oszczędności: {e}")
             return False
 
+    @serialized_write
     def transfer_accounts(self, from_acc_id, to_acc_id, amount, details=""):
         """Ukryte przeniesienie środków między istniejącymi kontami."""
         from datetime import datetime
@@ -713,22 +2471,17 @@ class DatabaseManager:
         except Exception as e:
             if self.conn.in_transaction:
                 self.conn.rollback()
+            self.aggregates.invalidate()
             print(f"Błąd migracji kasy: {e}")
             return False
 
+    @serialized_write
     def update_transaction(self, tid, tdate, ttype, tcat, tsub, tamt, tdetails, attachment=None, account_id=None):
         try:
             if attachment and isinstance(attachment, bytes):
-                # Usuń stary plik jeśli istniał
-                old = self.conn.execute("SELECT attachment FROM transactions WHERE id=?", (tid,)).fetchone()
-                if old and old[0]:
-                    old_path = os.path.join(self.attachments_dir, os.path.basename(old[0]))
-                    if os.path.exists(old_path): os.remove(old_path)
-
-                # Zapisz nowy plik
-                filename = f"{uuid.uuid4().hex}.dat"
-                with open(os.path.join(self.attachments_dir, filename), "wb") as f:
-                    f.write(attachment)
+                # Nowy blob; stary traci referencję i zostanie sprzątnięty po zapisie
+                sha = self._store_attachment_blob(data=attachment)
+                filename = self._attachment_value(sha, "zalacznik.dat") if sha else None
 
                 self.conn.execute("""
                     UPDATE transactions
@@ -741,27 +2494,26 @@ class DatabaseManager:
                     SET date=?, type=?, category=?, subcategory=?, amount=?, details=?, account_id=?, updated_at=?
                     WHERE id=?
                 """, (tdate, ttype, tcat, tsub, tamt, tdetails, account_id, self.sync_timestamp(), tid))
+            self.aggregates.touch(tid)
             self.conn.commit()
+            self.collect_attachment_blobs()
         except Exception as e:
             print(f"Błąd aktualizacji transakcji: {e}")
 
+    @serialized_write
     def delete_transaction(self, t_id):
         # --- NOWE: Usuwanie pliku przy usuwaniu transakcji ---
         self._record_sync_deletion("transactions", t_id)
-        res = self.conn.execute("SELECT attachment FROM transactions WHERE id=?", (t_id,)).fetchone()
-        if res and res[0]:
-            file_path = os.path.join(self.attachments_dir, os.path.basename(res[0]))
-            if os.path.exists(file_path):
-                try: os.remove(file_path)
-                except: pass
-
         self.conn.execute("DELETE FROM transactions WHERE id=?", (t_id,))
+        self.aggregates.touch(t_id)
         self.conn.commit()
+        # Plik znika dopiero, gdy żaden wpis nie wskazuje na ten sam blob
+        self.collect_attachment_blobs()
 
-    def get_all_transactions(self):
+    def get_all_transactions(self, conn=None):
         try:
             # Musimy pobrać account_id, żeby load_transactions wiedziało jak liczyć salda kont
-            cursor = self.conn.execute("""
+            cursor = (conn or self.conn).execute("""
                 SELECT id, date, type, category, subcategory, amount, details,
                 CASE WHEN attachment IS NOT NULL AND attachment != '' THEN 1 ELSE 0 END,
                 account_id
@@ -772,23 +2524,92 @@ class DatabaseManager:
         except sqlite3.OperationalError:
             return []
 
-    def export_sync_payload(self):
-        """Zwraca dane potrzebne do synchronizacji wpisów z Androidem."""
-        self.ensure_transaction_sync_metadata()
-        self.ensure_aux_sync_metadata()
-        self.conn.commit()
-
-        accounts = [
-            {"name": name, "initial_balance": initial, "color": color}
-            for _acc_id, name, initial, color in self.get_accounts()
-        ]
-        categories = self.get_categories()
-        people = self.get_people()
+    def get_transactions_in_range(self, date_from, date_to, conn=None):
+        """Jak get_all_transactions, ale tylko date_from <= data < date_to."""
+        try:
+            cursor = (conn or self.conn).execute(self.TRANSACTIONS_IN_RANGE_SQL, (date_from, date_to))
+            return cursor.fetchall()
+        except sqlite3.OperationalError:
+            return []
 
-        liabilities = self._export_sync_debts("liabilities")
-        debtors = self._export_sync_debts("debtors")
+    def get_month_aggregates(self, month_str, conn=None, pinned=None):
+        """
+        Sumy miesiąca z pamięci: [((account_id, type, category, subcategory), kwota)].
+        conn/pinned z read_snapshot - doczytanie zmian z migawki zamiast z self.conn.
+        """
+        self.aggregates.sync(conn or self.conn, pinned if conn is not None else None)
+        return self.aggregates.month_cells(month_str)
+
+    def get_history_aggregates(self, from_month=None, conn=None, pinned=None):
+        """Sumy z całej historii (albo od from_month) w tym samym kształcie co get_month_aggregates."""
+        self.aggregates.sync(conn or self.conn, pinned if conn is not None else None)
+        return self.aggregates.total_cells(from_month)
+
+    # Kolejność sekcji taka, w jakiej import_sync_payload je scala
+    SYNC_SECTIONS = (
+        "accounts", "categories", "people", "deletions", "liabilities", "debtors",
+        "transactions", "pending_bills", "shopping_lists", "shopping_items",
+    )
+
+    # Warunek eksportu przyrostowego: zmienione po since (rewizja), bez zakresów
+    # z importu od urządzenia, do którego idzie eksport. Parametry: (since, since, peer)
+    SYNC_DELTA_FILTER = """(? IS NULL OR (IFNULL({rev}, 0) > ? AND NOT EXISTS (
+        SELECT 1 FROM sync_import_ranges o
+        WHERE o.peer = ? AND o.rev_to >= {rev} AND o.rev_from < {rev}
+    )))"""
+
+    def export_sync_payload(self, since=None, peer=""):
+        """
+        Zwraca dane potrzebne do synchronizacji wpisów z Androidem.
+        Z since (rewizja) zwraca tylko wpisy i usunięcia zmienione po niej,
+        pomijając te, które przyszły z urządzenia peer;
+        konta, kategorie, osoby i długi są małe i idą zawsze w całości.
+        """
+        payload = {"device": "BudgetApp PC"}
+        for section in self.SYNC_SECTIONS:
+            payload[section] = []
+        for kind, row in self.iter_sync_records(since, peer):
+            if kind == "meta":
+                payload.update(row)
+            else:
+                payload[kind].append(row)
+        return payload
 
-        tx_rows = self.conn.execute("""
+    def iter_sync_records(self, since=None, peer=""):
+        """
+        To samo co export_sync_payload, ale jako strumień (sekcja, wiersz) czytany
+        kursorem z bazy - do przesyłania porcjami bez trzymania całości w pamięci.
+        Pierwszy rekord to ("meta", {...}) z kursorem.
+        """
+        with self.write_lock:
+            self.ensure_transaction_sync_metadata()
+            self.ensure_aux_sync_metadata()
+            self.conn.commit()
+        # Reszta z migawki na połączeniu do odczytu - nie blokuje zapisu ani okna
+        with self.read_connection(snapshot=True) as conn:
+            yield from self._iter_sync_snapshot(conn, since, peer)
+
+    def _iter_sync_snapshot(self, conn, since, peer=""):
+        since = None if since is None else int(since)
+        delta = (since, since, str(peer or ""))
+        # Kursor czytamy w tej samej migawce co dane
+        cursor = self.current_sync_revision(conn)
+        yield "meta", {"device": "BudgetApp PC", "cursor": cursor, "delta": since is not None}
+
+        for name, initial, color in conn.execute("SELECT name, initial_balance, color FROM accounts").fetchall():
+            yield "accounts", {"name": name, "initial_balance": initial, "color": color}
+        for (category,) in conn.execute("SELECT name FROM categories ORDER BY name").fetchall():
+            yield "categories", category
+        for (person,) in conn.execute("SELECT name FROM people ORDER BY name").fetchall():
+            yield "people", person
+        for item in self._export_sync_deletions(since, conn, peer):
+            yield "deletions", item
+        for item in self._export_sync_debts("liabilities", conn):
+            yield "liabilities", item
+        for item in self._export_sync_debts("debtors", conn):
+            yield "debtors", item
+
+        tx_rows = conn.execute(f"""
             SELECT t.date, t.type, t.category, t.subcategory, t.amount,
                    IFNULL(t.exclude_from_weekly, 0), IFNULL(t.details, ''),
                    IFNULL(t.sync_id, ''), IFNULL(t.updated_at, ''),
@@ -804,11 +2625,11 @@ class DatabaseManager:
                    END, '')
             FROM transactions t
             LEFT JOIN accounts a ON a.id = t.account_id
+            WHERE {self.SYNC_DELTA_FILTER.format(rev="t.sync_rev")}
             ORDER BY IFNULL(t.sync_order, IFNULL(t.updated_at, '')), t.id
-        """).fetchall()
-        transactions = []
+        """, delta)
         for row in tx_rows:
-            transactions.append({
+            tx = {
                 "date": row[0],
                 "type": row[1],
                 "category": row[2],
@@ -822,26 +2643,20 @@ class DatabaseManager:
                 "account_name": row[10] or "Gotówka",
                 "account_color": row[11] or "#7f8c8d",
                 "ref_sync_id": row[13] or "",
-            })
-            transactions[-1].update(self._sync_attachment_metadata(row[12]))
-
-        bills = []
-        for row in self.conn.execute("""
-            SELECT id, due_date, amount, category, description, IFNULL(is_paid,0),
-                   IFNULL(is_recurring,0), ref_id, IFNULL(sync_id,''), IFNULL(updated_at,'')
-            FROM pending_bills
-            ORDER BY IFNULL(updated_at, ''), id
-        """).fetchall():
-            ref_name = ""
-            ref_sync_id = ""
-            if row[7]:
-                found = self.conn.execute(
-                    "SELECT name, IFNULL(sync_id,'') FROM liabilities WHERE id=?",
-                    (row[7],)
-                ).fetchone()
-                ref_name = found[0] if found else ""
-                ref_sync_id = found[1] if found else ""
-            bills.append({
+            }
+            tx.update(self._sync_attachment_metadata(row[12]))
+            yield "transactions", tx
+
+        for row in conn.execute(f"""
+            SELECT b.id, b.due_date, b.amount, b.category, b.description, IFNULL(b.is_paid,0),
+                   IFNULL(b.is_recurring,0), b.ref_id, IFNULL(b.sync_id,''), IFNULL(b.updated_at,''),
+                   IFNULL(l.name,''), IFNULL(l.sync_id,'')
+            FROM pending_bills b
+            LEFT JOIN liabilities l ON l.id = b.ref_id
+            WHERE {self.SYNC_DELTA_FILTER.format(rev="b.sync_rev")}
+            ORDER BY IFNULL(b.updated_at, ''), b.id
+        """, delta):
+            yield "pending_bills", {
                 "sync_id": row[8],
                 "updated_at": row[9],
                 "due_date": row[1],
@@ -850,37 +2665,37 @@ class DatabaseManager:
                 "description": row[4],
                 "is_paid": row[5],
                 "is_recurring": row[6],
-                "ref_name": ref_name,
-                "ref_sync_id": ref_sync_id,
-            })
+                "ref_name": row[10] if row[7] else "",
+                "ref_sync_id": row[11] if row[7] else "",
+            }
 
-        shopping_lists = []
-        list_sync_by_id = {}
-        for row in self.conn.execute("""
+        for row in conn.execute(f"""
             SELECT id, name, created_at, status, IFNULL(sync_id,''), IFNULL(updated_at,'')
             FROM shopping_lists
+            WHERE {self.SYNC_DELTA_FILTER.format(rev="sync_rev")}
             ORDER BY IFNULL(created_at, ''), id
-        """).fetchall():
-            list_sync_by_id[row[0]] = row[4]
-            shopping_lists.append({
+        """, delta):
+            yield "shopping_lists", {
                 "sync_id": row[4],
                 "updated_at": row[5],
                 "name": row[1],
                 "created_at": row[2],
                 "status": row[3],
-            })
+            }
 
-        shopping_items = []
-        for row in self.conn.execute("""
-            SELECT id, list_id, product_name, quantity, IFNULL(store,''), IFNULL(is_checked,0),
-                   IFNULL(sync_id,''), IFNULL(updated_at,'')
-            FROM shopping_items
-            ORDER BY list_id, IFNULL(store,''), product_name, id
-        """).fetchall():
-            parent_sync = list_sync_by_id.get(row[1])
+        # Lista nadrzędna z JOIN, bo w trybie delta sama lista może nie być w paczce
+        for row in conn.execute(f"""
+            SELECT i.id, i.list_id, i.product_name, i.quantity, IFNULL(i.store,''), IFNULL(i.is_checked,0),
+                   IFNULL(i.sync_id,''), IFNULL(i.updated_at,''), IFNULL(l.sync_id,'')
+            FROM shopping_items i
+            JOIN shopping_lists l ON l.id = i.list_id
+            WHERE {self.SYNC_DELTA_FILTER.format(rev="i.sync_rev")}
+            ORDER BY i.list_id, IFNULL(i.store,''), i.product_name, i.id
+        """, delta):
+            parent_sync = row[8]
             if not parent_sync:
                 continue
-            shopping_items.append({
+            yield "shopping_items", {
                 "sync_id": row[6],
                 "updated_at": row[7],
                 "list_sync_id": parent_sync,
@@ -888,24 +2703,38 @@ class DatabaseManager:
                 "quantity": row[3],
                 "store": row[4],
                 "is_checked": row[5],
-            })
+            }
 
-        return {
-            "device": "BudgetApp PC",
-            "accounts": accounts,
-            "categories": categories,
-            "people": people,
-            "liabilities": liabilities,
-            "debtors": debtors,
-            "transactions": transactions,
-            "pending_bills": bills,
-            "shopping_lists": shopping_lists,
-            "shopping_items": shopping_items,
-            "deletions": self._export_sync_deletions(),
-        }
+    def import_sync_batches(self, batches, origin=""):
+        """
+        Importuje porcje (sekcja, wiersze) ze strumienia synchronizacji w jednej
+        transakcji: błąd w dowolnej porcji wycofuje cały import.
+        origin - adres urządzenia, od którego przyszły dane (_record_sync_origin).
+        """
+        totals = {"inserted": 0, "updated": 0, "deleted": 0}
+        with self.write_lock:
+            try:
+                rev_from = self.current_sync_revision()
+                for kind, rows in batches:
+                    result = self.import_sync_payload({kind: rows}, commit=False)
+                    for key in totals:
+                        totals[key] += int(result.get(key, 0) or 0)
+                self._record_sync_origin(origin, rev_from)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                self.aggregates.invalidate()
+                raise
+        self.collect_attachment_blobs()
+        return totals
 
-    def import_sync_payload(self, payload):
-        """Scala wpisy z drugiego urządzenia. Nie usuwa lokalnych danych."""
+    @serialized_write
+    def import_sync_payload(self, payload, commit=True, origin=""):
+        """
+        Scala wpisy z drugiego urządzenia. Nie usuwa lokalnych danych.
+        commit=False zostawia zatwierdzenie (i sprzątanie blobów) wołającemu.
+        origin - adres urządzenia: nadane rewizje nie wrócą do niego w eksporcie.
+        """
         if not isinstance(payload, dict):
             return {"inserted": 0, "updated": 0, "deleted": 0}
 
@@ -913,6 +2742,7 @@ class DatabaseManager:
         updated = 0
         deleted = 0
         try:
+            rev_from = self.current_sync_revision()
             for account in payload.get("accounts", []):
                 if isinstance(account, dict):
                     self._ensure_account_by_name(
@@ -954,14 +2784,9 @@ class DatabaseManager:
                 elif change == "updated":
                     updated += 1
 
-            for tx in payload.get("transactions", []):
-                if not isinstance(tx, dict):
-                    continue
-                change = self._import_sync_transaction(tx)
-                if change == "inserted":
-                    inserted += 1
-                elif change == "updated":
-                    updated += 1
+            tx_inserted, tx_updated = self._import_sync_transactions(payload.get("transactions", []))
+            inserted += tx_inserted
+            updated += tx_updated
 
             for bill in payload.get("pending_bills", []):
                 if not isinstance(bill, dict):
@@ -994,10 +2819,18 @@ class DatabaseManager:
                     updated += 1
 
             self._normalize_debt_transaction_refs()
-            self.conn.commit()
+            self._record_sync_origin(origin, rev_from)
+            if commit:
+                self.conn.commit()
         except Exception:
             self.conn.rollback()
+            self.aggregates.invalidate()
             raise
+        finally:
+            # Import dopisuje konta i kategorie (także w przypadku wycofania)
+            self.query_cache.bump("accounts", "categories")
+        if commit:
+            self.collect_attachment_blobs()
         return {"inserted": inserted, "updated": updated, "deleted": deleted}
 
     def _ensure_account_by_name(self, name, initial=0.0, color="#7f8c8d"):
@@ -1023,8 +2856,8 @@ class DatabaseManager:
             WHERE type = 'debtor_repayment' AND ref_id IS NULL
         """)
 
-    def _export_sync_debts(self, table):
-        rows = self.conn.execute(f"""
+    def _export_sync_debts(self, table, conn=None):
+        rows = (conn or self.conn).execute(f"""
             SELECT name, total_amount, deadline, IFNULL(sync_id,''), IFNULL(updated_at,'')
             FROM {table}
             ORDER BY IFNULL(updated_at,''), id
@@ -1070,15 +2903,16 @@ class DatabaseManager:
             self._clear_sync_deletion(table, sync_id)
             return "updated"
 
+        key_sql, key = self._fingerprint_filter(name, self._fingerprint_cents(total), deadline)
         duplicate = self.conn.execute(f"""
             SELECT id
             FROM {table}
-            WHERE IFNULL(name,'')=?
+            WHERE {key_sql}IFNULL(name,'')=?
               AND ABS(IFNULL(total_amount,0.0) - ?) < 0.000001
               AND IFNULL(deadline,'')=?
               AND (sync_id IS NULL OR TRIM(sync_id)='' OR sync_id != ?)
             ORDER BY id LIMIT 1
-        """, (name, total, deadline, sync_id)).fetchone()
+        """, key + (name, total, deadline, sync_id)).fetchone()
         if duplicate:
             self.conn.execute(f"""
                 UPDATE {table}
@@ -1155,7 +2989,7 @@ class DatabaseManager:
     def _sync_attachment_metadata(self, filename):
         if not filename:
             return {"attachment_present": False}
-        path = os.path.join(self.attachments_dir, os.path.basename(filename))
+        path = self.attachment_path(filename)
         if not os.path.isfile(path):
             return {"attachment_present": False}
         meta = {
@@ -1163,7 +2997,10 @@ class DatabaseManager:
             "attachment_name": self._safe_attachment_name(filename),
             "attachment_size": os.path.getsize(path),
         }
-        sha = self._attachment_sha256(path)
+        match = ATTACHMENT_BLOB_RE.match(os.path.basename(filename))
+        # Nazwa bloba to jego skrót - nie trzeba czytać pliku. Stara nazwa zostaje
+        # po migracji tylko przy brakującym pliku, więc liczenie skrótu to wyjątek
+        sha = match.group(1) if match else self._attachment_sha256(path)
         if sha:
             meta["attachment_sha256"] = sha
         return meta
@@ -1172,13 +3009,14 @@ class DatabaseManager:
         sync_id = str(sync_id or "").strip()
         if not sync_id:
             return None
-        row = self.conn.execute(
-            "SELECT IFNULL(attachment,'') FROM transactions WHERE sync_id=?",
-            (sync_id,)
-        ).fetchone()
+        with self.read_connection() as conn:
+            row = conn.execute(
+                "SELECT IFNULL(attachment,'') FROM transactions WHERE sync_id=?",
+                (sync_id,)
+            ).fetchone()
         if not row or not row[0]:
             return None
-        path = os.path.join(self.attachments_dir, os.path.basename(row[0]))
+        path = self.attachment_path(row[0])
         return path if os.path.isfile(path) else None
 
     def needs_sync_attachment_download(self, sync_id, expected_size=-1, expected_sha256=""):
@@ -1192,50 +3030,87 @@ class DatabaseManager:
         if expected_size >= 0 and os.path.getsize(path) != expected_size:
             return True
         expected_sha256 = str(expected_sha256 or "").strip().lower()
-        return bool(expected_sha256 and self._attachment_sha256(path).lower() != expected_sha256)
-
-    def save_sync_attachment(self, sync_id, raw_name, source_path):
-        sync_id = str(sync_id or "").strip()
-        if not sync_id or not source_path or not os.path.isfile(source_path):
-            return False
-        row = self.conn.execute(
-            "SELECT IFNULL(attachment,'') FROM transactions WHERE sync_id=?",
-            (sync_id,)
-        ).fetchone()
-        if not row:
+        if not expected_sha256:
             return False
-        old_filename = row[0] or ""
-        filename = f"{uuid.uuid4().hex}-{self._safe_attachment_name(raw_name)}"
-        target = os.path.join(self.attachments_dir, filename)
+        name = os.path.basename(path)
+        if ATTACHMENT_BLOB_RE.match(name):
+            return name != expected_sha256
+        return self._attachment_sha256(path).lower() != expected_sha256
+
+    def save_sync_attachment(self, sync_id, raw_name, source_path, sha256=""):
+        return self.save_sync_attachments([(sync_id, raw_name, source_path, sha256)]) == 1
+
+    @serialized_write
+    def save_sync_attachments(self, items, origin=""):
+        """
+        Zapis wielu pobranych załączników w jednej transakcji.
+        items: (sync_id, nazwa, plik tymczasowy, sha256). Treść trafia do magazynu
+        blobów (identyczna już istniejąca nie jest kopiowana), a stare bloby
+        bez referencji są sprzątane po commicie. Zwraca liczbę zapisanych.
+        """
+        saved = 0
         try:
-            os.makedirs(self.attachments_dir, exist_ok=True)
-            with open(source_path, "rb") as src, open(target, "wb") as dst:
-                for chunk in iter(lambda: src.read(1024 * 1024), b""):
-                    dst.write(chunk)
-            self.conn.execute("UPDATE transactions SET attachment=? WHERE sync_id=?", (filename, sync_id))
+            rev_from = self.current_sync_revision()
+            for sync_id, raw_name, tmp_path, sha256 in items:
+                sync_id = str(sync_id or "").strip()
+                if not sync_id or not tmp_path or not os.path.isfile(tmp_path):
+                    continue
+                row = self.conn.execute(
+                    "SELECT IFNULL(attachment,'') FROM transactions WHERE sync_id=?",
+                    (sync_id,)
+                ).fetchone()
+                if not row:
+                    continue
+                sha = self._store_attachment_blob(source_path=tmp_path, known_sha=sha256)
+                if not sha:
+                    continue
+                self.conn.execute(
+                    "UPDATE transactions SET attachment=? WHERE sync_id=?",
+                    (self._attachment_value(sha, raw_name), sync_id)
+                )
+                saved += 1
+            self._record_sync_origin(origin, rev_from)
             self.conn.commit()
-            if old_filename and old_filename != filename:
-                try:
-                    os.remove(os.path.join(self.attachments_dir, os.path.basename(old_filename)))
-                except Exception:
-                    pass
-            return True
-        except Exception:
-            try:
-                if os.path.exists(target):
-                    os.remove(target)
-            except Exception:
-                pass
-            return False
+        except Exception as e:
+            self.conn.rollback()
+            print(f"Błąd zapisu załączników z synchronizacji: {e}")
+            return 0
+        self.collect_attachment_blobs()
+        return saved
+
+    @serialized_write
+    def adopt_known_attachments(self, items, origin=""):
+        """
+        Dla (sync_id, nazwa, sha256) podpina lokalnie istniejący blob o tym skrócie
+        zamiast pobierać plik. Zwraca listę sync_id, które trzeba jednak pobrać.
+        """
+        missing = []
+        adopted = 0
+        rev_from = self.current_sync_revision()
+        for sync_id, raw_name, sha256 in items:
+            sha = str(sha256 or "").strip().lower()
+            if not re.fullmatch(r"[0-9a-f]{64}", sha) or not os.path.isfile(os.path.join(self.attachments_dir, sha)):
+                missing.append(sync_id)
+                continue
+            cur = self.conn.execute(
+                "UPDATE transactions SET attachment=? WHERE sync_id=?",
+                (self._attachment_value(sha, raw_name), str(sync_id or "").strip())
+            )
+            if cur.rowcount:
+                adopted += 1
+            else:
+                missing.append(sync_id)
+        if adopted:
+            self._record_sync_origin(origin, rev_from)
+            self.conn.commit()
+            self.collect_attachment_blobs()
+        return missing
 
     def _write_sync_attachment(self, tx, existing_filename=None):
+        # Stare bloby tracą referencję przez wyzwalacze; pliki sprząta collect_attachment_blobs
         has_payload = bool(str(tx.get("attachment_data") or "").strip())
         if not has_payload:
             if tx.get("attachment_present") is False and existing_filename:
-                try:
-                    os.remove(os.path.join(self.attachments_dir, os.path.basename(existing_filename)))
-                except Exception:
-                    pass
                 return None
             return existing_filename
 
@@ -1246,22 +3121,10 @@ class DatabaseManager:
         if not data:
             return existing_filename
 
-        raw_name = os.path.basename(str(tx.get("attachment_name") or "zalacznik.dat")).replace("\\", "_").replace("/", "_")
-        if not raw_name:
-            raw_name = "zalacznik.dat"
-        filename = f"{uuid.uuid4().hex}-{raw_name}"
-        try:
-            os.makedirs(self.attachments_dir, exist_ok=True)
-            with open(os.path.join(self.attachments_dir, filename), "wb") as f:
-                f.write(data)
-            if existing_filename and existing_filename != filename:
-                try:
-                    os.remove(os.path.join(self.attachments_dir, os.path.basename(existing_filename)))
-                except Exception:
-                    pass
-            return filename
-        except Exception:
+        sha = self._store_attachment_blob(data=data)
+        if not sha:
             return existing_filename
+        return self._attachment_value(sha, tx.get("attachment_name") or "zalacznik.dat")
 
     def _import_sync_bill(self, bill):
         sync_id = str(bill.get("sync_id") or "").strip()
@@ -1270,10 +3133,7 @@ class DatabaseManager:
         remote_updated = str(bill.get("updated_at") or self.sync_timestamp())
         if self._is_sync_deleted("pending_bills", sync_id, remote_updated):
             return None
-        existing = self.conn.execute(
-            "SELECT id, IFNULL(updated_at,'') FROM pending_bills WHERE sync_id=?",
-            (sync_id,)
-        ).fetchone()
+        existing = self.conn.execute(self.SYNC_BILL_SQL, (sync_id,)).fetchone()
         if existing and existing[1] >= remote_updated:
             return None
 
@@ -1301,17 +3161,13 @@ class DatabaseManager:
             self._clear_sync_deletion("pending_bills", sync_id)
             return "updated"
 
-        duplicate = self.conn.execute("""
-            SELECT id
-            FROM pending_bills
-            WHERE IFNULL(due_date,'')=?
-              AND ABS(IFNULL(amount,0.0) - ?) < 0.000001
-              AND IFNULL(category,'')=?
-              AND IFNULL(description,'')=?
-              AND IFNULL(is_recurring,0)=?
-              AND (sync_id IS NULL OR TRIM(sync_id)='' OR sync_id != ?)
-            ORDER BY id LIMIT 1
-        """, (values[0], values[1], values[2], values[3], values[5], sync_id)).fetchone()
+        key_sql, key = self._fingerprint_filter(
+            values[0], self._fingerprint_cents(values[1]), values[2], values[3], values[5]
+        )
+        duplicate = self.conn.execute(
+            self.DUPLICATE_BILL_SQL.format(key=key_sql),
+            key + (values[0], values[1], values[2], values[3], values[5], sync_id)
+        ).fetchone()
         if duplicate:
             self.conn.execute("""
                 UPDATE pending_bills
@@ -1356,12 +3212,13 @@ class DatabaseManager:
             self._clear_sync_deletion("shopping_lists", sync_id)
             return "updated", existing[0]
 
-        duplicate = self.conn.execute("""
+        key_sql, key = self._fingerprint_filter(name, created)
+        duplicate = self.conn.execute(f"""
             SELECT id FROM shopping_lists
-            WHERE IFNULL(name,'')=? AND IFNULL(created_at,'')=?
+            WHERE {key_sql}IFNULL(name,'')=? AND IFNULL(created_at,'')=?
               AND (sync_id IS NULL OR TRIM(sync_id)='' OR sync_id != ?)
             ORDER BY id LIMIT 1
-        """, (name, created, sync_id)).fetchone()
+        """, key + (name, created, sync_id)).fetchone()
         if duplicate:
             self.conn.execute("""
                 UPDATE shopping_lists SET name=?, created_at=?, status=?, sync_id=?, updated_at=? WHERE id=?
@@ -1396,10 +3253,7 @@ class DatabaseManager:
         list_id = self._local_shopping_list_id(list_sync_id, list_id_by_sync)
         if not list_id:
             return None
-        existing = self.conn.execute(
-            "SELECT id, IFNULL(updated_at,'') FROM shopping_items WHERE sync_id=?",
-            (sync_id,)
-        ).fetchone()
+        existing = self.conn.execute(self.SYNC_SHOPPING_ITEM_SQL, (sync_id,)).fetchone()
         if existing and existing[1] >= remote_updated:
             return None
 
@@ -1417,12 +3271,13 @@ class DatabaseManager:
             self._clear_sync_deletion("shopping_items", sync_id)
             return "updated"
 
-        duplicate = self.conn.execute("""
+        key_sql, key = self._fingerprint_filter(list_id, product, quantity, store)
+        duplicate = self.conn.execute(f"""
             SELECT id FROM shopping_items
-            WHERE list_id=? AND IFNULL(product_name,'')=? AND IFNULL(quantity,'')=? AND IFNULL(store,'')=?
+            WHERE {key_sql}list_id=? AND IFNULL(product_name,'')=? AND IFNULL(quantity,'')=? AND IFNULL(store,'')=?
               AND (sync_id IS NULL OR TRIM(sync_id)='' OR sync_id != ?)
             ORDER BY id LIMIT 1
-        """, (list_id, product, quantity, store, sync_id)).fetchone()
+        """, key + (list_id, product, quantity, store, sync_id)).fetchone()
         if duplicate:
             self.conn.execute("""
                 UPDATE shopping_items
@@ -1450,26 +3305,7 @@ class DatabaseManager:
         if remote_has_order and not self._is_legacy_sync_order(remote_order):
             return None
 
-        row = self.conn.execute("""
-            SELECT id
-            FROM transactions
-            WHERE IFNULL(date, '') = ?
-              AND IFNULL(type, '') = ?
-              AND IFNULL(category, '') = ?
-              AND IFNULL(subcategory, '') = ?
-              AND ABS(IFNULL(amount, 0.0) - ?) < 0.000001
-              AND IFNULL(exclude_from_weekly, 0) = ?
-              AND IFNULL(details, '') = ?
-              AND IFNULL(account_id, 1) = ?
-              AND (sync_id IS NULL OR sync_id != ?)
-              AND (
-                    sync_order IS NULL
-                    OR TRIM(sync_order) = ''
-                    OR sync_order GLOB '*|[0-9]*'
-                  )
-            ORDER BY id
-            LIMIT 1
-        """, (
+        values = (
             str(tx.get("date") or datetime.now().strftime("%Y-%m-%d")),
             str(tx.get("type") or "expense"),
             str(tx.get("category") or "Inne"),
@@ -1478,10 +3314,294 @@ class DatabaseManager:
             int(tx.get("exclude_from_weekly") or 0),
             str(tx.get("details") or ""),
             account_id,
-            sync_id,
-        )).fetchone()
+        )
+        key_sql, key = self._fingerprint_filter(*(values[:4] + (self._fingerprint_cents(values[4]),) + values[5:]))
+        row = self.conn.execute(
+            self.LEGACY_DUPLICATE_TRANSACTION_SQL.format(key=key_sql), key + values + (sync_id,)
+        ).fetchone()
         return row[0] if row else None
 
+    def _import_sync_transactions(self, transactions):
+        """
+        Import transakcji zbiorczo: wiersze trafiają do tabeli TEMP, a istnienie,
+        tombstone'y i "nowszy wygrywa" rozstrzyga kilka zapytań z JOIN zamiast
+        kilku SELECT-ów na wiersz. Wynik i liczniki jak w _import_sync_transaction;
+        wiersze zależne od wcześniejszych w tej samej paczce (powtórzony sync_id,
+        identyczne stare wpisy bez sync_order) idą potem po jednym.
+        Zwraca (inserted, updated).
+        """
+        today = datetime.now().strftime("%Y-%m-%d")
+        staged = []
+        by_seq = {}
+        later = []
+        seen_sync_ids = set()
+        seen_contents = set()
+        for tx in transactions:
+            if not isinstance(tx, dict):
+                continue
+            sync_id = str(tx.get("sync_id") or "").strip()
+            if not sync_id:
+                continue
+            remote_updated = str(tx.get("updated_at") or self.sync_timestamp())
+            remote_has_order = bool(str(tx.get("sync_order") or "").strip())
+            remote_order = str(tx.get("sync_order") or remote_updated or self.sync_order_value())
+            legacy = not remote_has_order or self._is_legacy_sync_order(remote_order)
+            row = (
+                len(staged) + len(later),
+                sync_id,
+                str(tx.get("date") or today),
+                str(tx.get("type") or "expense"),
+                str(tx.get("category") or "Inne"),
+                str(tx.get("subcategory") or ""),
+                float(tx.get("amount") or 0.0),
+                int(tx.get("exclude_from_weekly") or 0),
+                str(tx.get("details") or ""),
+                str(tx.get("account_name") or "Gotówka").strip() or "Gotówka",
+                tx.get("account_color") or "#7f8c8d",
+                str(tx.get("ref_sync_id") or "").strip(),
+                remote_updated,
+                remote_order,
+                int(legacy),
+                "data" if str(tx.get("attachment_data") or "").strip()
+                else ("clear" if tx.get("attachment_present") is False else "keep"),
+            )
+            content = row[2:6] + (round(row[6], 6),) + row[7:10]
+            if sync_id in seen_sync_ids or (legacy and content in seen_contents):
+                later.append(tx)
+                continue
+            seen_sync_ids.add(sync_id)
+            seen_contents.add(content)
+            staged.append(row)
+            by_seq[row[0]] = tx
+
+        inserted = 0
+        updated = 0
+        if staged:
+            inserted, updated = self._merge_staged_transactions(staged, by_seq)
+        for tx in later:
+            change = self._import_sync_transaction(tx)
+            if change == "inserted":
+                inserted += 1
+            elif change == "updated":
+                updated += 1
+        return inserted, updated
+
+    def _merge_staged_transactions(self, staged, by_seq):
+        c = self.conn
+        c.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS sync_stage_tx (
+                seq INTEGER PRIMARY KEY,
+                sync_id TEXT, date TEXT, type TEXT, category TEXT, subcategory TEXT,
+                amount REAL, exclude_from_weekly INTEGER, details TEXT,
+                account_name TEXT, account_color TEXT, ref_sync_id TEXT,
+                remote_updated TEXT, remote_order TEXT, legacy INTEGER, att_mode TEXT,
+                action TEXT, local_id INTEGER, local_updated TEXT, local_att TEXT,
+                account_id INTEGER, ref_id INTEGER, att_value TEXT, fingerprint TEXT
+            )
+        """)
+        c.execute("DELETE FROM temp.sync_stage_tx")
+        c.executemany("""
+            INSERT INTO temp.sync_stage_tx (
+                seq, sync_id, date, type, category, subcategory, amount, exclude_from_weekly, details,
+                account_name, account_color, ref_sync_id, remote_updated, remote_order, legacy, att_mode
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, staged)
+
+        # Tombstone nowszy lub równy od zmiany zdalnej - wiersz pomijamy
+        c.execute("""
+            DELETE FROM temp.sync_stage_tx
+            WHERE EXISTS (
+                SELECT 1 FROM sync_deletions d
+                WHERE d.table_name = 'transactions'
+                  AND d.sync_id = sync_stage_tx.sync_id
+                  AND d.deleted_at >= sync_stage_tx.remote_updated
+            )
+        """)
+        c.execute("""
+            UPDATE temp.sync_stage_tx
+            SET local_id = (SELECT t.id FROM transactions t WHERE t.sync_id = sync_stage_tx.sync_id)
+        """)
+        c.execute("""
+            UPDATE temp.sync_stage_tx
+            SET local_updated = (SELECT IFNULL(t.updated_at, '') FROM transactions t WHERE t.id = sync_stage_tx.local_id),
+                local_att = (SELECT IFNULL(t.attachment, '') FROM transactions t WHERE t.id = sync_stage_tx.local_id)
+            WHERE local_id IS NOT NULL
+        """)
+        # Lokalny wpis nowszy: co najwyżej dopinamy brakujący załącznik
+        c.execute("""
+            UPDATE temp.sync_stage_tx
+            SET action = CASE
+                WHEN local_id IS NULL THEN 'new'
+                WHEN local_updated < remote_updated THEN 'update'
+                WHEN local_att = '' AND att_mode = 'data' THEN 'attach'
+            END
+        """)
+        c.execute("DELETE FROM temp.sync_stage_tx WHERE action IS NULL")
+
+        c.execute("""
+            INSERT INTO accounts (name, initial_balance, color)
+            SELECT s.account_name, 0.0, s.account_color
+            FROM temp.sync_stage_tx s
+            WHERE s.action IN ('new', 'update')
+              AND s.seq = (
+                    SELECT MIN(s2.seq) FROM temp.sync_stage_tx s2
+                    WHERE s2.account_name = s.account_name AND s2.action IN ('new', 'update')
+                  )
+              AND NOT EXISTS (SELECT 1 FROM accounts a WHERE a.name = s.account_name)
+            ORDER BY s.seq
+        """)
+        c.execute("""
+            UPDATE temp.sync_stage_tx
+            SET account_id = (SELECT a.id FROM accounts a WHERE a.name = sync_stage_tx.account_name)
+            WHERE action IN ('new', 'update')
+        """)
+        c.execute("""
+            INSERT OR IGNORE INTO people
+            SELECT category FROM temp.sync_stage_tx
+            WHERE action IN ('new', 'update') AND type = 'income' ORDER BY seq
+        """)
+        c.execute("""
+            INSERT OR IGNORE INTO categories
+            SELECT category FROM temp.sync_stage_tx
+            WHERE action IN ('new', 'update') AND type = 'expense' ORDER BY seq
+        """)
+        # To samo co _resolve_sync_ref: najpierw sync_id długu, potem nazwa
+        c.execute("""
+            UPDATE temp.sync_stage_tx
+            SET ref_id = CASE type
+                WHEN 'liability_repayment' THEN COALESCE(
+                    (SELECT l.id FROM liabilities l WHERE ref_sync_id != '' AND l.sync_id = ref_sync_id LIMIT 1),
+                    (SELECT l.id FROM liabilities l WHERE subcategory != '' AND l.name = subcategory LIMIT 1))
+                WHEN 'debtor_repayment' THEN COALESCE(
+                    (SELECT d.id FROM debtors d WHERE ref_sync_id != '' AND d.sync_id = ref_sync_id LIMIT 1),
+                    (SELECT d.id FROM debtors d WHERE subcategory != '' AND d.name = subcategory LIMIT 1))
+                WHEN 'goal_deposit' THEN
+                    (SELECT g.id FROM goals g WHERE subcategory != '' AND g.name = subcategory LIMIT 1)
+            END
+            WHERE action IN ('new', 'update')
+        """)
+
+        # Stare wpisy bez sync_id/sync_order o identycznej treści przejmują zdalny sync_id
+        updating = {row[0] for row in c.execute(
+            "SELECT local_id FROM temp.sync_stage_tx WHERE local_id IS NOT NULL"
+        )}
+        if self.fingerprints:
+            # Te same wyrażenia co w kolumnie transactions.fingerprint (nazwy kolumn się pokrywają)
+            c.execute(f"UPDATE temp.sync_stage_tx SET fingerprint = {self._fingerprint_sql('transactions')} "
+                      "WHERE action = 'new' AND legacy = 1")
+            match_on = "t.fingerprint = s.fingerprint"
+        else:
+            match_on = "t.date = s.date"
+        claimed = {}
+        for seq, local_id in c.execute(f"""
+            SELECT s.seq, t.id
+            FROM temp.sync_stage_tx s
+            JOIN transactions t ON {match_on}
+            WHERE s.action = 'new'
+              AND s.legacy = 1
+              AND IFNULL(t.type, '') = s.type
+              AND IFNULL(t.category, '') = s.category
+              AND IFNULL(t.subcategory, '') = s.subcategory
+              AND ABS(IFNULL(t.amount, 0.0) - s.amount) < 0.000001
+              AND IFNULL(t.exclude_from_weekly, 0) = s.exclude_from_weekly
+              AND IFNULL(t.details, '') = s.details
+              AND IFNULL(t.account_id, 1) = s.account_id
+              AND (t.sync_id IS NULL OR t.sync_id != s.sync_id)
+              AND (
+                    t.sync_order IS NULL
+                    OR TRIM(t.sync_order) = ''
+                    OR t.sync_order GLOB '*|[0-9]*'
+                  )
+            ORDER BY s.seq, t.id
+        """).fetchall():
+            if seq in claimed or local_id in updating:
+                continue
+            claimed[seq] = local_id
+            updating.add(local_id)
+        c.executemany("""
+            UPDATE temp.sync_stage_tx
+            SET action = 'duplicate',
+                local_id = ?,
+                local_att = (SELECT IFNULL(t.attachment, '') FROM transactions t WHERE t.id = ?)
+            WHERE seq = ?
+        """, [(local_id, local_id, seq) for seq, local_id in claimed.items()])
+        c.execute("UPDATE temp.sync_stage_tx SET action = 'insert' WHERE action = 'new'")
+
+        # Załączniki: bez danych zostaje lokalny (albo znika, gdy zdalnie usunięty)
+        c.execute("""
+            UPDATE temp.sync_stage_tx
+            SET att_value = CASE
+                WHEN att_mode = 'clear' AND IFNULL(local_att, '') != '' THEN NULL
+                ELSE local_att
+            END
+        """)
+        with_data = c.execute(
+            "SELECT seq, local_att FROM temp.sync_stage_tx WHERE att_mode = 'data'"
+        ).fetchall()
+        if with_data:
+            c.executemany(
+                "UPDATE temp.sync_stage_tx SET att_value = ? WHERE seq = ?",
+                [(self._write_sync_attachment(by_seq[seq], local_att), seq) for seq, local_att in with_data]
+            )
+        c.execute("DELETE FROM temp.sync_stage_tx WHERE action = 'attach' AND IFNULL(att_value, '') = ''")
+
+        c.execute("""
+            UPDATE transactions
+            SET attachment = (
+                SELECT s.att_value FROM temp.sync_stage_tx s
+                WHERE s.action = 'attach' AND s.local_id = transactions.id
+            )
+            WHERE id IN (SELECT local_id FROM temp.sync_stage_tx WHERE action = 'attach')
+        """)
+        changed = c.execute("""
+            SELECT date, type, category, subcategory, amount, exclude_from_weekly, details, att_value,
+                   ref_id, account_id, sync_id, remote_updated, remote_order, local_id
+            FROM temp.sync_stage_tx
+            WHERE action IN ('update', 'duplicate')
+            ORDER BY seq
+        """).fetchall()
+        c.executemany("""
+            UPDATE transactions
+            SET date=?, type=?, category=?, subcategory=?, amount=?,
+                currency='PLN', exchange_rate=1.0, exclude_from_weekly=?,
+                details=?, attachment=?, ref_id=?, account_id=?, sync_id=?, updated_at=?, sync_order=?
+            WHERE id=?
+        """, changed)
+        c.execute("""
+            INSERT INTO transactions (
+                date, type, category, subcategory, amount,
+                currency, exchange_rate, exclude_from_weekly,
+                details, attachment, ref_id, account_id, sync_id, updated_at, sync_order
+            )
+            SELECT date, type, category, subcategory, amount, 'PLN', 1.0, exclude_from_weekly,
+                   details, att_value, ref_id, account_id, sync_id, remote_updated, remote_order
+            FROM temp.sync_stage_tx
+            WHERE action = 'insert'
+            ORDER BY seq
+        """)
+        c.execute("""
+            DELETE FROM sync_deletions
+            WHERE table_name = 'transactions'
+              AND sync_id IN (
+                    SELECT sync_id FROM temp.sync_stage_tx
+                    WHERE action IN ('update', 'duplicate', 'insert')
+                  )
+        """)
+
+        touched = [row[-1] for row in changed]
+        touched.extend(row[0] for row in c.execute("""
+            SELECT t.id FROM temp.sync_stage_tx s
+            JOIN transactions t ON t.sync_id = s.sync_id
+            WHERE s.action = 'insert'
+        """))
+        self.aggregates.touch(*touched)
+        counts = dict(c.execute(
+            "SELECT action, COUNT(*) FROM temp.sync_stage_tx GROUP BY action"
+        ).fetchall())
+        c.execute("DELETE FROM temp.sync_stage_tx")
+        inserted = counts.get("insert", 0)
+        return inserted, counts.get("update", 0) + counts.get("duplicate", 0) + counts.get("attach", 0)
+
     def _import_sync_transaction(self, tx):
         sync_id = str(tx.get("sync_id") or "").strip()
         if not sync_id:
@@ -1491,10 +3611,7 @@ class DatabaseManager:
             return None
         remote_has_order = bool(str(tx.get("sync_order") or "").strip())
         remote_order = str(tx.get("sync_order") or remote_updated or self.sync_order_value())
-        existing = self.conn.execute(
-            "SELECT id, IFNULL(updated_at, ''), IFNULL(attachment, '') FROM transactions WHERE sync_id=?",
-            (sync_id,)
-        ).fetchone()
+        existing = self.conn.execute(self.SYNC_TRANSACTION_SQL, (sync_id,)).fetchone()
         if existing and existing[1] >= remote_updated:
             if not existing[2] and str(tx.get("attachment_data") or "").strip():
                 filename = self._write_sync_attachment(tx, existing[2])
@@ -1543,6 +3660,7 @@ class DatabaseManager:
                     details=?, attachment=?, ref_id=?, account_id=?, sync_id=?, updated_at=?, sync_order=?
                 WHERE id=?
             """, values + (existing[0],))
+            self.aggregates.touch(existing[0])
             self._clear_sync_deletion("transactions", sync_id)
             return "updated"
 
@@ -1558,11 +3676,12 @@ class DatabaseManager:
                     details=?, attachment=?, ref_id=?, account_id=?, sync_id=?, updated_at=?, sync_order=?
                 WHERE id=?
             """, dup_values + (duplicate_id,))
+            self.aggregates.touch(duplicate_id)
             self._clear_sync_deletion("transactions", sync_id)
             return "updated"
 
         insert_values = values[:7] + (self._write_sync_attachment(tx, None),) + values[8:]
-        self.conn.execute("""
+        cur = self.conn.execute("""
             INSERT INTO transactions (
                 date, type, category, subcategory, amount,
                 currency, exchange_rate, exclude_from_weekly,
@@ -1570,41 +3689,53 @@ class DatabaseManager:
             )
             VALUES (?, ?, ?, ?, ?, 'PLN', 1.0, ?, ?, ?, ?, ?, ?, ?, ?)
         """, insert_values)
+        self.aggregates.touch(cur.lastrowid)
         self._clear_sync_deletion("transactions", sync_id)
         return "inserted"
 
     def get_year_transactions(self, year_str):
         try:
-            cursor = self.conn.execute("SELECT id, date, type, category, subcategory, amount FROM transactions WHERE date LIKE ? ORDER BY date", (f"{year_str}%",))
-            return cursor.fetchall()
+            year = int(str(year_str)[:4])
+            with self.read_connection() as conn:
+                return conn.execute(self.YEAR_TRANSACTIONS_SQL, (f"{year:04d}", f"{year + 1:04d}")).fetchall()
         except: return []
 
+    def iter_report_transactions(self, date_from, date_to, batch_size=500):
+        """
+        Wiersze do raportu PDF (jak get_all_transactions) z zakresu
+        date_from <= data < date_to w kolejności dat, czytane kursorem partiami
+        - raport roczny nie trzyma całej historii w pamięci.
+        """
+        with self.read_connection() as conn:
+            cursor = conn.execute(self.REPORT_TRANSACTIONS_SQL, (date_from, date_to))
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield from batch
+
     def get_transaction_by_id(self, t_id):
         cursor = self.conn.execute("SELECT id, date, type, category, subcategory, amount, details FROM transactions WHERE id=?", (t_id,))
         return cursor.fetchone()
 
-    def get_expenses_in_range(self, start_date, end_date, allowed_categories=None):
-        query = """
-            SELECT category, SUM(amount)
-            FROM transactions
-            WHERE type='expense'
-            AND exclude_from_weekly = 0
-            AND date >= ? AND date <= ?
-        """
+    def get_expenses_in_range(self, start_date, end_date, allowed_categories=None, conn=None):
+        categories = ""
         params = [start_date, end_date]
         if allowed_categories is not None:
             if not allowed_categories: return []
             placeholders = ','.join('?' for _ in allowed_categories)
-            query += f" AND category IN ({placeholders})"
+            categories = f" AND category IN ({placeholders})"
             params.extend(allowed_categories)
-        query += " GROUP BY category ORDER BY SUM(amount) DESC"
-        return self.conn.execute(query, params).fetchall()
+        query = self.EXPENSES_IN_RANGE_SQL.format(categories=categories)
+        return (conn or self.conn).execute(query, params).fetchall()
 
+    @serialized_write
     def add_person(self, name):
         if name:
             self.conn.execute("INSERT OR IGNORE INTO people VALUES (?)", (name,))
             self.conn.commit()
 
+    @serialized_write
     def add_category(self, name):
         if name:
             name = name.strip()
@@ -1624,7 +3755,9 @@ class DatabaseManager:
                     cats.append(name)
                     self.set_weekly_limit_for_week(monday, amt, cats)
             self.conn.commit()
+            self.query_cache.bump("categories")
 
+    @serialized_write
     def delete_category_safe(self, name):
         fallback_cat = "Inne"
         if name == fallback_cat: return False
@@ -1633,15 +3766,21 @@ class DatabaseManager:
             self.conn.execute("UPDATE transactions SET category=? WHERE category=? AND type='expense'", (fallback_cat, name))
             self.conn.execute("DELETE FROM categories WHERE name=?", (name,))
             self.conn.commit()
+            self.aggregates.invalidate()
             return True
         except: return False
+        finally:
+            self.query_cache.bump("categories")
 
     def get_people(self):
         return [r[0] for r in self.conn.execute("SELECT name FROM people ORDER BY name").fetchall()]
 
     def get_categories(self):
-        return [r[0] for r in self.conn.execute("SELECT name FROM categories ORDER BY name").fetchall()]
+        return list(self.query_cache.get("categories", ("categories",), lambda: tuple(
+            r[0] for r in self.conn.execute("SELECT name FROM categories ORDER BY name").fetchall()
+        )))
 
+    @serialized_write
     def add_goal(self, name, target_amount, default_account_id):
         try:
             self.conn.execute(
@@ -1653,18 +3792,22 @@ class DatabaseManager:
         except Exception as e:
             print(f"Błąd: {e}")
             return False
+        finally:
+            self.query_cache.bump("goals")
 
+    @serialized_write
     def delete_goal(self, goal_id):
         self.conn.execute("DELETE FROM goals WHERE id=?", (goal_id,))
         self.conn.commit()
+        self.query_cache.bump("goals")
 
     def get_goals(self):
-        return [r[0] for r in self.conn.execute("SELECT name FROM goals ORDER BY name").fetchall()]
+        return [row[1] for row in self.get_goals_with_details()]
 
-    def get_goals_with_details(self):
-        return self.conn.execute(
+    def get_goals_with_details(self, conn=None):
+        return list(self.query_cache.get("goals", ("goals",), lambda: tuple((conn or self.conn).execute(
             "SELECT id, name, target_amount, default_account_id FROM goals ORDER BY name"
-        ).fetchall()
+        ).fetchall()), store=conn is None))
 
     def _get_goal_subcategory_variants(self, goal_name):
         if not goal_name:
@@ -1680,11 +3823,16 @@ class DatabaseManager:
             variants.add(template.format(goal_name))
         return tuple(variants)
 
-    def get_all_goal_subcategory_variants(self):
+    def get_all_goal_subcategory_variants(self, conn=None):
+        return set(self.query_cache.get(
+            "goal_variants", ("goals",), lambda: self._load_goal_subcategory_variants(conn), store=conn is None
+        ))
+
+    def _load_goal_subcategory_variants(self, conn=None):
         variants = set()
-        for _goal_id, goal_name, _target, _default_account_id in self.get_goals_with_details():
+        for _goal_id, goal_name, _target, _default_account_id in self.get_goals_with_details(conn):
             variants.update(self._get_goal_subcategory_variants(goal_name))
-        return variants
+        return frozenset(variants)
 
     def get_goal_total(self, goal_name, goal_id=None, account_id=None):
         variants = self._get_goal_subcategory_variants(goal_name)
@@ -1732,21 +3880,58 @@ class DatabaseManager:
 
         return goal_total
 
+    def _goal_subcategory_map(self):
+        """Pary (podkategoria, id celu) dla starych wpisów savings/savings_migration."""
+        def load():
+            pairs = []
+            for g_id, g_name, _target, _default_account_id in self.get_goals_with_details():
+                pairs.extend((variant, g_id) for variant in self._get_goal_subcategory_variants(g_name))
+            return tuple(pairs)
+        # Warianty zależą od języka, więc jest on częścią klucza
+        return self.query_cache.get(("goal_subcategory_map", _("Wpłata: {}"), _("Wypłata: {}")), ("goals",), load)
+
+    def get_goal_totals(self, account_id=None):
+        """
+        Zebrane kwoty wszystkich celów {id: suma} - to samo co get_goal_total
+        dla każdego celu, ale dwoma zapytaniami z GROUP BY zamiast dwóch na cel.
+        """
+        totals = {g_id: 0.0 for g_id, _name, _target, _default_account_id in self.get_goals_with_details()}
+        if not totals:
+            return totals
+
+        account_sql = " AND t.account_id = ?" if account_id is not None else ""
+        account_params = [account_id] if account_id is not None else []
+
+        deposit_query = self.GOAL_DEPOSITS_SQL.format(account=account_sql)
+        for g_id, total in self.conn.execute(deposit_query, account_params * 2).fetchall():
+            if g_id in totals and total is not None:
+                totals[g_id] += total
+
+        pairs = self._goal_subcategory_map()
+        if pairs:
+            values = ",".join("(?, ?)" for _unused in pairs)
+            legacy_query = self.GOAL_SAVINGS_SQL.format(values=values, account=account_sql)
+            params = [value for pair in pairs for value in pair] + account_params
+            for g_id, total in self.conn.execute(legacy_query, params).fetchall():
+                if g_id in totals and total is not None:
+                    totals[g_id] += total
+        return totals
+
     def get_goals_progress_simple(self):
+        totals = self.get_goal_totals()
         goals_data = []
         for g_id, g_name, g_target, _default_account_id in self.get_goals_with_details():
-            current_sum = self.get_goal_total(g_name, goal_id=g_id)
-            goals_data.append({'id': g_id, 'name': g_name, 'target': g_target, 'collected': current_sum})
+            goals_data.append({'id': g_id, 'name': g_name, 'target': g_target, 'collected': totals.get(g_id, 0.0)})
         return goals_data
 
     # --- DŁUGI (MOJE ZOBOWIĄZANIA) ---
     # --- DŁUGI (MOJE ZOBOWIĄZANIA) ---
+    @serialized_write
     def add_liability(self, name, amount, deadline, attachment=None):
         filename = None
         if attachment and isinstance(attachment, bytes):
-            filename = f"{uuid.uuid4().hex}.dat"
-            with open(os.path.join(self.attachments_dir, filename), "wb") as f:
-                f.write(attachment)
+            sha = self._store_attachment_blob(data=attachment)
+            filename = self._attachment_value(sha, "zalacznik.dat") if sha else None
 
         try:
             cursor = self.conn.execute(
@@ -1763,47 +3948,77 @@ class DatabaseManager:
             print(f"Błąd add_liability: {e}")
             return False
 
+    @serialized_write
     def delete_liability(self, lid):
         self._record_sync_deletion("liabilities", lid)
         self.conn.execute("DELETE FROM liabilities WHERE id=?", (lid,))
         self.conn.commit()
 
+    # Tabela długów -> typ transakcji spłaty
+    DEBT_LEDGERS = {
+        "liabilities": "liability_repayment",
+        "debtors": "debtor_repayment",
+    }
+
+    def get_debt_ledger(self, table, debt_id=None):
+        """
+        Stan wszystkich długów (liabilities) albo dłużników (debtors) jednym
+        zapytaniem: LEFT JOIN z sumami spłat zgrupowanymi po ref_id i po nazwie.
+        Zwraca listę słowników: id, name, total, deadline, attachment,
+        paid (spłaty po ref_id), paid_by_name (stare spłaty po subcategory), remaining.
+        """
+        repayment_type = self.DEBT_LEDGERS[table]
+        where = "WHERE d.id = ?" if debt_id is not None else ""
+        query = self.DEBT_LEDGER_SQL.format(table=table, where=where)
+        params = [repayment_type, repayment_type]
+        if debt_id is not None:
+            params.append(debt_id)
+
+        ledger = []
+        for d_id, name, total, deadline, attachment, paid, paid_by_name in self.conn.execute(query, params).fetchall():
+            paid = paid if paid else 0.0
+            ledger.append({
+                'id': d_id, 'name': name, 'total': total, 'deadline': deadline, 'attachment': attachment,
+                'paid': paid, 'paid_by_name': paid_by_name if paid_by_name else 0.0,
+                'remaining': (total or 0.0) - paid,
+            })
+        return ledger
+
+    def _debt_status(self, table):
+        return [
+            {'id': d['id'], 'name': d['name'], 'total': d['total'], 'paid': d['paid'], 'deadline': d['deadline']}
+            for d in self.get_debt_ledger(table)
+        ]
+
+    def _active_debt_names(self, table):
+        # Starsze wpisy spłat wiążą się z długiem tylko po nazwie (subcategory)
+        return sorted(d['name'] for d in self.get_debt_ledger(table) if d['paid_by_name'] < d['total'])
+
+    def _active_debts_detailed(self, table):
+        active = [(d['id'], d['name'], d['remaining']) for d in self.get_debt_ledger(table) if d['remaining'] > 0.001]
+        return sorted(active, key=lambda row: row[1])
+
+    def _debt_full_info(self, table, debt_id):
+        ledger = self.get_debt_ledger(table, debt_id)
+        if not ledger: return None
+        d = ledger[0]
+        return {"name": d['name'], "total": d['total'], "deadline": d['deadline'], "attachment": d['attachment'], "remaining": d['remaining']}
+
     def get_liabilities_list(self):
         """Zwraca listę nazw długów, które mają jeszcze coś do spłacenia."""
-        active_liabilities = []
-        # Pobieramy wszystkie długi
-        query = "SELECT name, total_amount FROM liabilities"
-        for name, total in self.conn.execute(query).fetchall():
-            # Sprawdzamy sumę spłat dla tego konkretnego długu w transakcjach
-            res = self.conn.execute(
-                "SELECT SUM(amount) FROM transactions WHERE type='liability_repayment' AND subcategory=?",
-                (name,)
-            ).fetchone()[0]
-            paid = res if res else 0.0
-
-            # Jeśli suma spłat jest mniejsza niż całkowita kwota długu, dodajemy do listy
-            if paid < total:
-                active_liabilities.append(name)
-
-        return sorted(active_liabilities)
+        return self._active_debt_names("liabilities")
 
     def get_liabilities_status(self):
-        liabilities = []
-        for lid, name, total, deadline in self.conn.execute("SELECT id, name, total_amount, deadline FROM liabilities").fetchall():
-            # ZMIANA: Sumujemy po ref_id zamiast po subcategory
-            res = self.conn.execute("SELECT SUM(amount) FROM transactions WHERE type='liability_repayment' AND ref_id=?", (lid,)).fetchone()[0]
-            paid = res if res else 0.0
-            liabilities.append({'id': lid, 'name': name, 'total': total, 'paid': paid, 'deadline': deadline})
-        return liabilities
+        return self._debt_status("liabilities")
 
     # --- DŁUŻNICY (LUDZIE WISZĄ MI KASĘ) - NOWE ---
     # --- DŁUŻNICY (LUDZIE WISZĄ MI KASĘ) ---
+    @serialized_write
     def add_debtor(self, name, amount, deadline, attachment=None):
         filename = None
         if attachment and isinstance(attachment, bytes):
-            filename = f"{uuid.uuid4().hex}.dat"
-            with open(os.path.join(self.attachments_dir, filename), "wb") as f:
-                f.write(attachment)
+            sha = self._store_attachment_blob(data=attachment)
+            filename = self._attachment_value(sha, "zalacznik.dat") if sha else None
 
         try:
             cursor = self.conn.execute(
@@ -1820,6 +4035,7 @@ class DatabaseManager:
             print(f"Błąd add_debtor: {e}")
             return False
 
+    @serialized_write
     def delete_debtor(self, did):
         self._record_sync_deletion("debtors", did)
         self.conn.execute("DELETE FROM debtors WHERE id=?", (did,))
@@ -1827,34 +4043,10 @@ class DatabaseManager:
 
     def get_debtors_list(self):
         """Zwraca listę nazw dłużników, którzy jeszcze nie oddali całości kwoty."""
-        active_debtors = []
-        # 1. Pobieramy wszystkich dłużników z tabeli debtors
-        query = "SELECT name, total_amount FROM debtors"
-        for name, total in self.conn.execute(query).fetchall():
-
-            # 2. Sumujemy wszystkie zwroty od tego dłużnika z tabeli transakcji
-            # Zakładamy, że w subcategory zapisujesz imię dłużnika
-            res = self.conn.execute(
-                "SELECT SUM(amount) FROM transactions WHERE type='debtor_repayment' AND subcategory=?",
-                (name,)
-            ).fetchone()[0]
-
-            paid = res if res else 0.0
-
-            # 3. Dodajemy do listy tylko tych, którzy mają jeszcze dług (total > paid)
-            if paid < total:
-                active_debtors.append(name)
-
-        return sorted(active_debtors)
+        return self._active_debt_names("debtors")
 
     def get_debtors_status(self):
-        debtors = []
-        for did, name, total, deadline in self.conn.execute("SELECT id, name, total_amount, deadline FROM debtors").fetchall():
-            # ZMIANA: Sumujemy po ref_id (ID dłużnika)
-            res = self.conn.execute("SELECT SUM(amount) FROM transactions WHERE type='debtor_repayment' AND ref_id=?", (did,)).fetchone()[0]
-            paid = res if res else 0.0
-            debtors.append({'id': did, 'name': name, 'total': total, 'paid': paid, 'deadline': deadline})
-        return debtors
+        return self._debt_status("debtors")
 
     def get_all_historical_liabilities(self):
         # Pobiera nazwy z historii transakcji (zarówno moje długi jak i dłużników)
@@ -1862,52 +4054,57 @@ class DatabaseManager:
         l2 = [r[0] for r in self.conn.execute("SELECT DISTINCT subcategory FROM transactions WHERE type='debtor_repayment'").fetchall()]
         return list(set(l1 + l2))
 
-    def is_month_locked(self, month_str):
-        return self.conn.execute("SELECT 1 FROM month_locks WHERE month_str=?", (month_str,)).fetchone() is not None
+    def is_month_locked(self, month_str, conn=None):
+        locked = self.query_cache.get("month_locks", ("month_locks",), lambda: frozenset(
+            r[0] for r in (conn or self.conn).execute("SELECT month_str FROM month_locks").fetchall()
+        ), store=conn is None)
+        return month_str in locked
 
+    @serialized_write
     def lock_month(self, month_str):
         self.conn.execute("INSERT OR IGNORE INTO month_locks VALUES (?)", (month_str,))
         self.conn.commit()
+        self.query_cache.bump("month_locks")
 
+    @serialized_write
     def unlock_month(self, month_str):
         self.conn.execute("DELETE FROM month_locks WHERE month_str=?", (month_str,))
         self.conn.commit()
+        self.query_cache.bump("month_locks")
 
     def get_total_savings_cash_pln(self, account_id=None):
         """
         Pobiera sumę wszystkich oszczędności z całej historii bazy.
         Cele są liczone osobno i nie wchodzą do tego zestawienia.
         """
-        goal_variants = self.get_all_goal_subcategory_variants()
-        query = """
-            SELECT amount, subcategory
-            FROM transactions
-            WHERE type IN ('savings', 'savings_migration')
-        """
-        params = []
-        if account_id is not None:
-            query += " AND account_id = ?"
-            params.append(account_id)
+        goal_variants = list(self.get_all_goal_subcategory_variants())
         try:
-            total = 0.0
-            for amount, subcategory in self.conn.execute(query, params).fetchall():
-                if subcategory in goal_variants:
-                    continue
-                total += amount
+            totals = self._type_totals(account_id=account_id)
+            total = totals.get('savings', 0.0) + totals.get('savings_migration', 0.0)
+            if goal_variants:
+                # Stare wpłaty na cele zapisane jako oszczędności odejmujemy osobno
+                placeholders = ",".join("?" for _unused in goal_variants)
+                query = f"""
+                    SELECT SUM(amount)
+                    FROM transactions
+                    WHERE type IN ('savings', 'savings_migration')
+                      AND subcategory IN ({placeholders})
+                """
+                params = list(goal_variants)
+                if account_id is not None:
+                    query += " AND account_id = ?"
+                    params.append(account_id)
+                total -= self.conn.execute(query, params).fetchone()[0] or 0.0
             return total
         except Exception as e:
             print(f"Błąd bazy przy sumowaniu oszczędności: {e}")
             return 0.0
 
     def get_net_balance_pln_before_date(self, date_limit_str):
-        balance = 0.0
-        for t_type, amt in self.conn.execute("SELECT type, amount FROM transactions WHERE date < ?", (date_limit_str,)).fetchall():
-            if t_type == 'income': balance += amt
-            elif t_type in ['expense', 'savings', 'liability_repayment', 'goal_deposit']: balance -= amt
-            elif t_type == 'debtor_repayment': balance += amt # Zwrot od dłużnika to plus
-            elif t_type == 'account_transfer': balance += amt
-        return balance
+        # Sam ruch na kontach przed datą, bez sald początkowych
+        return sum(b['as_of_balance'] - b['initial'] for b in self.get_balances(as_of=date_limit_str))
 
+    @serialized_write
     def create_shopping_list(self, name):
         created = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         cur = self.conn.execute(
@@ -1920,6 +4117,26 @@ class DatabaseManager:
     def get_shopping_lists(self):
         return self.conn.execute("SELECT id, name, created_at, status FROM shopping_lists ORDER BY created_at DESC").fetchall()
 
+    def search_shopping_lists(self, text):
+        """
+        Listy zakupów (jak get_shopping_lists), których nazwa albo produkt/sklep
+        pasuje do tekstu; najtrafniejsze najpierw.
+        """
+        lists = self.get_shopping_lists()
+        ranks = self._search_ranks(text, "shopping_lists")
+        if ranks is None:
+            return lists
+        item_ranks = self._search_ranks(text, "shopping_items")
+        item_ids = list(item_ranks)
+        for start in range(0, len(item_ids), 500):
+            chunk = item_ids[start:start + 500]
+            for item_id, list_id in self.conn.execute(
+                f"SELECT id, list_id FROM shopping_items WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall():
+                ranks[list_id] = min(ranks.get(list_id, 0.0), item_ranks[item_id])
+        return sorted((r for r in lists if r[0] in ranks), key=lambda r: ranks[r[0]])
+
+    @serialized_write
     def add_shopping_item(self, list_id, product, quantity, store=""):
         self.conn.execute(
             "INSERT INTO shopping_items (list_id, product_name, quantity, store, is_checked, sync_id, updated_at) VALUES (?, ?, ?, ?, 0, ?, ?)",
@@ -1934,11 +4151,13 @@ class DatabaseManager:
         )
         return cursor.fetchall()
 
+    @serialized_write
     def delete_shopping_item(self, item_id):
         self._record_sync_deletion("shopping_items", item_id)
         self.conn.execute("DELETE FROM shopping_items WHERE id=?", (item_id,))
         self.conn.commit()
 
+    @serialized_write
     def update_shopping_item(self, item_id, p, q):
         self.conn.execute(
             "UPDATE shopping_items SET product_name=?, quantity=?, updated_at=? WHERE id=?",
@@ -1947,12 +4166,17 @@ class DatabaseManager:
         self.conn.commit()
 
     def close_shopping_list(self, list_id):
+        self.set_shopping_list_status(list_id, "closed")
+
+    @serialized_write
+    def set_shopping_list_status(self, list_id, status):
         self.conn.execute(
-            "UPDATE shopping_lists SET status='closed', updated_at=? WHERE id=?",
-            (self.sync_timestamp(), list_id)
+            "UPDATE shopping_lists SET status=?, updated_at=? WHERE id=?",
+            (status, self.sync_timestamp(), list_id)
         )
         self.conn.commit()
 
+    @serialized_write
     def delete_shopping_list(self, list_id):
         child_ids = [row[0] for row in self.conn.execute("SELECT id FROM shopping_items WHERE list_id=?", (list_id,)).fetchall()]
         for item_id in child_ids:
@@ -1962,6 +4186,7 @@ class DatabaseManager:
         self.conn.execute("DELETE FROM shopping_lists WHERE id=?", (list_id,))
         self.conn.commit()
 
+    @serialized_write
     def add_shop(self, name):
         if name and name.strip():
             self.conn.execute("INSERT OR IGNORE INTO shops VALUES (?)", (name.strip(),))
@@ -2051,13 +4276,14 @@ class DatabaseManager:
                 pass
         return sorted(suggestions, key=lambda value: value.lower())[:limit]
 
+    @serialized_write
     def set_weekly_limit_for_week(self, monday_date, amount, categories_list):
         cat_json = json.dumps(categories_list)
         self.conn.execute("INSERT OR REPLACE INTO weekly_history (monday_date, amount, categories) VALUES (?, ?, ?)", (monday_date, amount, cat_json))
         self.conn.commit()
 
-    def get_weekly_limit_for_week(self, monday_date):
-        cursor = self.conn.execute("SELECT amount, categories FROM weekly_history WHERE monday_date=?", (monday_date,))
+    def get_weekly_limit_for_week(self, monday_date, conn=None):
+        cursor = (conn or self.conn).execute("SELECT amount, categories FROM weekly_history WHERE monday_date=?", (monday_date,))
         row = cursor.fetchone()
         if row:
             try: cats = json.loads(row[1])
@@ -2065,8 +4291,8 @@ class DatabaseManager:
             return True, row[0], cats
         return False, 0.0, []
 
-    def is_weekly_system_enabled(self):
-        cfg = self.get_config("weekly_limit_config")
+    def is_weekly_system_enabled(self, conn=None):
+        cfg = self.get_config("weekly_limit_config", conn)
         return cfg.get("enabled", False) if cfg else False
 
     def set_weekly_system_enabled(self, enabled):
@@ -2075,20 +4301,7 @@ class DatabaseManager:
         self.save_config("weekly_limit_config", cfg)
 
     def get_pending_bills(self):
-        # Automatyczna szybka migracja - dodaje kolumny, jeśli ich nie ma
-        try:
-            self.conn.execute("ALTER TABLE pending_bills ADD COLUMN is_recurring INTEGER DEFAULT 0")
-            self.conn.commit()
-        except:
-            pass # Kolumna już istnieje
-
-        try:
-            # NOWE: Dodajemy kolumnę ref_id dla powiązania z długami
-            self.conn.execute("ALTER TABLE pending_bills ADD COLUMN ref_id INTEGER")
-            self.conn.commit()
-        except:
-            pass # Kolumna już istnieje
-
+        # Kolumny is_recurring i ref_id zakłada migracja schematu (_migrate_base_schema)
         # Pobieramy 7 kolumn: id, data, kwota, kategoria, opis, czy_staly, ref_id
         cursor = self.conn.execute("""
             SELECT id, due_date, amount, category, description, is_recurring, ref_id
@@ -2098,6 +4311,15 @@ class DatabaseManager:
         """)
         return cursor.fetchall()
 
+    def search_pending_bills(self, text):
+        """Nieopłacone rachunki (jak get_pending_bills) pasujące do tekstu, najtrafniejsze najpierw."""
+        bills = self.get_pending_bills()
+        ranks = self._search_ranks(text, "pending_bills")
+        if ranks is None:
+            return bills
+        return sorted((b for b in bills if b[0] in ranks), key=lambda b: ranks[b[0]])
+
+    @serialized_write
     def add_pending_bill(self, due_date, amount, category, description, is_recurring=0, ref_id=None):
         # Dodajemy obsługę ref_id w zapytaniu INSERT
         self.conn.execute("""
@@ -2106,15 +4328,18 @@ class DatabaseManager:
         """, (due_date, amount, category, description, is_recurring, ref_id, str(uuid.uuid4()), self.sync_timestamp()))
         self.conn.commit()
 
+    @serialized_write
     def mark_bill_paid(self, bill_id):
         self.conn.execute("UPDATE pending_bills SET is_paid = 1, updated_at = ? WHERE id = ?", (self.sync_timestamp(), bill_id))
         self.conn.commit()
 
+    @serialized_write
     def delete_pending_bill(self, bill_id):
         self._record_sync_deletion("pending_bills", bill_id)
         self.conn.execute("DELETE FROM pending_bills WHERE id = ?", (bill_id,))
         self.conn.commit()
 
+    @serialized_write
     def update_pending_bill(self, bill_id, due_date, amount, category, description, is_recurring=0, ref_id=None):
         self.conn.execute("""
             UPDATE pending_bills
@@ -2123,6 +4348,7 @@ class DatabaseManager:
         """, (due_date, amount, category, description, is_recurring, ref_id, self.sync_timestamp(), bill_id))
         self.conn.commit()
 
+    @serialized_write
     def toggle_bill_recurring(self, bill_id, current_status):
         new_status = 0 if current_status == 1 else 1
         self.conn.execute("UPDATE pending_bills SET is_recurring = ?, updated_at = ? WHERE id = ?", (new_status, self.sync_timestamp(), bill_id))
@@ -2148,9 +4374,11 @@ class DatabaseManager:
 
     def get_attachment(self, transaction_id):
         # --- ZMIANA: Pobieranie z pliku zamiast z bazy ---
-        res = self.conn.execute("SELECT attachment FROM transactions WHERE id = ?", (transaction_id,)).fetchone()
+        # Połączenie z puli - wołane też z wątku generującego PDF
+        with self.read_connection() as conn:
+            res = conn.execute("SELECT attachment FROM transactions WHERE id = ?", (transaction_id,)).fetchone()
         if res and res[0]:
-            file_path = os.path.join(self.attachments_dir, os.path.basename(res[0]))
+            file_path = self.attachment_path(res[0])
             if os.path.exists(file_path):
                 try:
                     with open(file_path, "rb") as f:
@@ -2160,28 +4388,13 @@ class DatabaseManager:
 
     def get_active_liabilities_detailed(self):
         """Zwraca listę aktywnych długów: (id, nazwa, pozostało_do_spłaty)"""
-        query = """
-            SELECT l.id, l.name, (l.total_amount - IFNULL(SUM(t.amount), 0)) as remaining
-            FROM liabilities l
-            LEFT JOIN transactions t ON l.id = t.ref_id AND t.type = 'liability_repayment'
-            GROUP BY l.id
-            HAVING remaining > 0.001
-            ORDER BY l.name ASC
-        """
-        return self.conn.execute(query).fetchall()
+        return self._active_debts_detailed("liabilities")
 
     def get_active_debtors_detailed(self):
         """Zwraca listę aktywnych dłużników: (id, nazwa, pozostało_do_oddania)"""
-        query = """
-            SELECT d.id, d.name, (d.total_amount - IFNULL(SUM(t.amount), 0)) as remaining
-            FROM debtors d
-            LEFT JOIN transactions t ON d.id = t.ref_id AND t.type = 'debtor_repayment'
-            GROUP BY d.id
-            HAVING remaining > 0.001
-            ORDER BY d.name ASC
-        """
-        return self.conn.execute(query).fetchall()
+        return self._active_debts_detailed("debtors")
 
+    @serialized_write
     def add_account(self, name, initial_balance, color="#7f8c8d"):
         """Dodaje nowe konto z określonym kolorem."""
         try:
@@ -2193,89 +4406,96 @@ class DatabaseManager:
             return True
         except:
             return False
+        finally:
+            self.query_cache.bump("accounts")
 
-    def get_accounts(self):
+    def get_accounts(self, conn=None):
         """Pobiera wszystkie konta wraz z kolorami."""
         try:
-            # Upewnij się, że 'color' jest na końcu (indeks 3)
-            cursor = self.conn.execute("SELECT id, name, initial_balance, color FROM accounts")
-            return cursor.fetchall()
+            return list(self.query_cache.get(
+                "accounts", ("accounts",), lambda: self._load_accounts(conn), store=conn is None
+            ))
         except Exception as e:
             print(f"Błąd pobierania kont: {e}")
             return []
 
+    def _load_accounts(self, conn=None):
+        # Upewnij się, że 'color' jest na końcu (indeks 3)
+        cursor = (conn or self.conn).execute("SELECT id, name, initial_balance, color FROM accounts")
+        return tuple(cursor.fetchall())
+
+    @serialized_write
     def delete_account(self, acc_id):
         if acc_id == 1: return False # Nie pozwalamy usunąć głównej Gotówki
         self.conn.execute("DELETE FROM accounts WHERE id=?", (acc_id,))
         # Stare transakcje usuwanego konta przenosimy na Gotówkę
         self.conn.execute("UPDATE transactions SET account_id = 1 WHERE account_id = ?", (acc_id,))
         self.conn.commit()
+        self.aggregates.invalidate()
+        self.query_cache.bump("accounts")
         return True
 
     def get_account_history(self, account_id, date_from, date_to, t_type=None):
-        query = """
-            SELECT date, type, category, subcategory, amount, details
-            FROM transactions
-            WHERE account_id = ? AND date BETWEEN ? AND ?
-        """
         params = [account_id, date_from, date_to]
+        type_filter = ""
         if t_type:
-            query += " AND type = ?"
+            type_filter = " AND type = ?"
             params.append(t_type)
 
-        query += " ORDER BY date DESC"
-        cursor = self.conn.execute(query, params)
-        return cursor.fetchall()
+        query = self.ACCOUNT_HISTORY_SQL.format(type_filter=type_filter)
+        with self.read_connection() as conn:
+            return conn.execute(query, params).fetchall()
 
     def is_module_enabled(self, name):
-        res = self.conn.execute("SELECT is_enabled FROM modules WHERE module_name=?", (name,)).fetchone()
-        return res[0] == 1 if res else False
+        states = self.query_cache.get("modules", ("modules",), lambda: dict(
+            self.conn.execute("SELECT module_name, is_enabled FROM modules").fetchall()
+        ))
+        return states.get(name) == 1
 
+    @serialized_write
     def set_module_state(self, name, state):
         self.conn.execute("INSERT OR REPLACE INTO modules VALUES (?, ?)", (name, 1 if state else 0))
         self.conn.commit()
+        self.query_cache.bump("modules")
+
+    def get_balances(self, as_of=None, conn=None):
+        """
+        Salda wszystkich kont jednym zapytaniem z GROUP BY (znaki z BALANCE_SIGNS).
+        Zwraca listę słowników: id, name, color, initial, balance (stan obecny)
+        i as_of_balance - stan przed dniem as_of (YYYY-MM-DD); bez as_of równy balance.
+        Zamknięte miesiące biorą sumy z monthly_account_totals, a z miesiąca
+        granicznego czytane są tylko transakcje sprzed as_of.
+        """
+        month = str(as_of)[:7] if as_of else None
+        params = (month, month, month, month, str(as_of) if as_of else None)
+        balances = []
+        for acc_id, name, color, initial, current, before in (conn or self.conn).execute(self.BALANCES_SQL, params).fetchall():
+            balances.append({
+                'id': acc_id, 'name': name, 'color': color, 'initial': initial,
+                'balance': initial + current,
+                'as_of_balance': initial + before,
+            })
+        return balances
 
     def get_account_balance(self, account_id, date_limit=None):
         """
         Oblicza saldo konta: saldo_początkowe + przychody - wydatki.
-        Opcjonalnie uwzględnia limit daty dla raportów historycznych.
+        Opcjonalnie uwzględnia limit daty (włącznie) dla raportów historycznych.
         """
         try:
-            # 1. Pobierz saldo początkowe konta
-            res = self.conn.execute("SELECT initial_balance FROM accounts WHERE id = ?", (account_id,)).fetchone()
-            initial_balance = res[0] if res else 0.0
-
-            # 2. Przygotuj zapytanie SQL (z limitem daty lub bez)
+            as_of = None
             if date_limit:
-                # SQL weźmie tylko transakcje do wskazanego dnia włącznie
-                query = "SELECT type, amount FROM transactions WHERE account_id = ? AND date <= ?"
-                params = (account_id, date_limit)
-            else:
-                query = "SELECT type, amount FROM transactions WHERE account_id = ?"
-                params = (account_id,)
-
-            transactions = self.conn.execute(query, params).fetchall()
-
-            current_balance = initial_balance
-            for t_type, amt in transactions:
-                if t_type in ['income', 'debtor_repayment']:
-                    # Przychody i zwroty od dłużników zwiększają stan konta
-                    current_balance += amt
-                elif t_type in ['expense', 'savings', 'liability_repayment', 'goal_deposit']:
-                    # Wydatki, oszczędności i spłaty długów zmniejszają stan konta
-                    current_balance -= amt
-                elif t_type == 'savings_migration':
-                    # Migracja ma już znak w bazie (- dla wyjścia, + dla wejścia)
-                    # Używamy +=, aby matematycznie zachować ten znak.
-                    current_balance += amt
-                elif t_type == 'account_transfer':
-                    current_balance += amt
-
-            return current_balance
+                # get_balances liczy stan przed dniem as_of - bierzemy dzień następny
+                as_of = (datetime.strptime(str(date_limit)[:10], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+            for b in self.get_balances(as_of=as_of):
+                if b['id'] == account_id:
+                    return b['as_of_balance']
+            return 0.0
         except Exception as e:
             print(f"Błąd obliczania salda konta {account_id}: {e}")
             return 0.0
 
+    @serialized_write
     def update_account_color(self, acc_id, new_color):
         try:
             self.conn.execute("UPDATE accounts SET color = ? WHERE id = ?", (new_color, acc_id))
@@ -2283,18 +4503,14 @@ class DatabaseManager:
             return True
         except:
             return False
+        finally:
+            self.query_cache.bump("accounts")
 
     def get_liability_full_info(self, l_id):
-        res = self.conn.execute("SELECT name, total_amount, deadline, attachment FROM liabilities WHERE id = ?", (l_id,)).fetchone()
-        if not res: return None
-        paid = self.conn.execute("SELECT SUM(amount) FROM transactions WHERE ref_id = ? AND type = 'liability_repayment'", (l_id,)).fetchone()[0] or 0.0
-        return {"name": res[0], "total": res[1], "deadline": res[2], "attachment": res[3], "remaining": res[1] - paid}
+        return self._debt_full_info("liabilities", l_id)
 
     def get_debtor_full_info(self, d_id):
-        res = self.conn.execute("SELECT name, total_amount, deadline, attachment FROM debtors WHERE id = ?", (d_id,)).fetchone()
-        if not res: return None
-        paid = self.conn.execute("SELECT SUM(amount) FROM transactions WHERE ref_id = ? AND type = 'debtor_repayment'", (d_id,)).fetchone()[0] or 0.0
-        return {"name": res[0], "total": res[1], "deadline": res[2], "attachment": res[3], "remaining": res[1] - paid}
+        return self._debt_full_info("debtors", d_id)
 
     def get_total_balance_all_accounts(self):
         """
@@ -2302,16 +4518,7 @@ class DatabaseManager:
         Metoda niezbędna dla modułu prognozowania (Forecaster).
         """
         try:
-            # 1. Pobieramy listę wszystkich ID kont
-            cursor = self.conn.execute("SELECT id FROM accounts")
-            account_ids = [row[0] for row in cursor.fetchall()]
-
-            total_sum = 0.0
-            # 2. Dla każdego konta wywołujemy Twoją istniejącą logikę obliczania salda
-            for acc_id in account_ids:
-                total_sum += self.get_account_balance(acc_id)
-
-            return total_sum
+            return sum(b['balance'] for b in self.get_balances())
         except Exception as e:
             print(f"Błąd sumowania salda wszystkich kont: {e}")
             return 0.0
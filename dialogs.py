@@ -9,7 +9,7 @@ from PySide6.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QLabel, QLineE
                                QProgressBar, QTextEdit, QSpinBox, QFrame, QWidget,
                                QCheckBox, QListWidget, QListWidgetItem, QAbstractItemView,
                                QTableWidget, QTableWidgetItem, QHeaderView, QCompleter)
-from PySide6.QtCore import Qt, QDate, QObject, QEvent, QTimer
+from PySide6.QtCore import Qt, QDate, QObject, QEvent, QTimer, Signal
 from PySide6.QtGui import QTextCursor
 from config import _, CASH_SAVINGS_NAME, MONTH_NAME
 try:
@@ -247,6 +247,140 @@ class ProcessingDialog(QDialog):
         layout.addWidget(self.lbl)
         layout.addWidget(self.pbar)
 
+class BackupWorker(QObject):
+    """Wykonuje perform_backup poza wątkiem GUI; postęp i wynik wracają sygnałami."""
+    progress = Signal(int)
+    finished = Signal()
+
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self.result = (False, "")
+
+    def run(self):
+        try:
+            self.result = self.db.perform_backup(progress_callback=self.progress.emit)
+        except Exception as error:
+            self.result = (False, str(error))
+        self.finished.emit()
+
+
+def run_backup_with_progress(parent, db, title, label_text):
+    """
+    Kopia zapasowa w osobnym wątku z paskiem postępu; okno odświeża się
+    w trakcie. Zwraca wynik perform_backup: (sukces, ścieżka albo błąd).
+    """
+    from PySide6.QtCore import QThread, QEventLoop
+    pd = ProcessingDialog(parent, title, label_text)
+    pd.pbar.setRange(0, 100)
+    pd.pbar.setValue(0)
+
+    thread = QThread()
+    worker = BackupWorker(db)
+    worker.moveToThread(thread)
+    loop = QEventLoop()
+    worker.progress.connect(pd.pbar.setValue)
+    worker.finished.connect(loop.quit)
+    thread.started.connect(worker.run)
+
+    pd.show()
+    thread.start()
+    loop.exec()
+    thread.quit()
+    thread.wait()
+    pd.close()
+    return worker.result
+
+class ReportProgressDialog(QDialog):
+    """
+    Kolejka generowanych plików PDF: osobny pasek postępu dla każdego pliku
+    i jeden przycisk anulujący wszystko, co jeszcze trwa. Okno nie jest
+    modalne - w trakcie generowania można dalej pracować w programie.
+    """
+    def __init__(self, parent=None, on_cancel=None):
+        super().__init__(parent)
+        from PySide6.QtWidgets import QScrollArea
+        self.on_cancel = on_cancel
+        self._rows = {}
+        self._pending = set()
+        self.setWindowTitle(_("Generowanie PDF"))
+        self.resize(460, 260)
+        layout = QVBoxLayout(self)
+        self.lbl_summary = QLabel(_("Proszę czekać..."))
+        layout.addWidget(self.lbl_summary)
+
+        scroll = QScrollArea()
+        scroll.setWidgetResizable(True)
+        scroll.setFrameShape(QFrame.NoFrame)
+        container = QWidget()
+        self.jobs_layout = QVBoxLayout(container)
+        self.jobs_layout.setContentsMargins(0, 0, 0, 0)
+        self.jobs_layout.addStretch()
+        scroll.setWidget(container)
+        layout.addWidget(scroll)
+
+        btn_layout = QHBoxLayout()
+        btn_layout.addStretch()
+        self.btn_cancel = QPushButton(_("Anuluj"))
+        self.btn_cancel.clicked.connect(self._cancel)
+        btn_layout.addWidget(self.btn_cancel)
+        layout.addLayout(btn_layout)
+
+    def add_job(self, job_id, title):
+        row = QWidget()
+        row_layout = QVBoxLayout(row)
+        row_layout.setContentsMargins(0, 2, 0, 2)
+        lbl = QLabel(title)
+        pbar = QProgressBar()
+        pbar.setRange(0, 100)
+        pbar.setValue(0)
+        pbar.setFormat(_("W kolejce"))
+        row_layout.addWidget(lbl)
+        row_layout.addWidget(pbar)
+        self.jobs_layout.insertWidget(self.jobs_layout.count() - 1, row)
+        self._rows[job_id] = pbar
+        self._pending.add(job_id)
+        self.btn_cancel.setEnabled(True)
+        self._refresh_summary()
+
+    def update_job(self, job_id, percent, text):
+        pbar = self._rows.get(job_id)
+        if pbar is None or job_id not in self._pending:
+            return
+        pbar.setValue(percent)
+        pbar.setFormat(f"{text} - %p%")
+
+    def finish_job(self, job_id, status):
+        pbar = self._rows.get(job_id)
+        self._pending.discard(job_id)
+        if pbar is not None:
+            if status == "ok":
+                pbar.setValue(100)
+                pbar.setFormat(_("Gotowe"))
+            elif status == "cancelled":
+                pbar.setFormat(_("Anulowano"))
+            else:
+                pbar.setFormat(_("Błąd"))
+        self._refresh_summary()
+
+    def _refresh_summary(self):
+        total = len(self._rows)
+        done = total - len(self._pending)
+        self.lbl_summary.setText(_("Ukończono {} z {}").format(done, total))
+        self.btn_cancel.setEnabled(bool(self._pending))
+
+    def _cancel(self):
+        self.btn_cancel.setEnabled(False)
+        self.lbl_summary.setText(_("Anulowanie..."))
+        if self.on_cancel:
+            self.on_cancel()
+
+    def closeEvent(self, e):
+        # Zamknięcie okna w trakcie pracy = anulowanie kolejki
+        if self._pending:
+            self._cancel()
+        super().closeEvent(e)
+
 class BackupDialog(QDialog):
     def __init__(self, parent=None, db_manager=None):
         super().__init__(parent)
@@ -292,8 +426,23 @@ class BackupDialog(QDialog):
 
         h.addWidget(btn)
 
+        from database import BACKUP_CODECS, BACKUP_DEFAULT_CODEC
+        self.default_codec = BACKUP_DEFAULT_CODEC
+        self.codec_combo = QComboBox()
+        for codec, label in (("zlib", _("Standardowa (zlib)")),
+                             ("zstd", _("Szybka (zstd)")),
+                             ("xz", _("Najmniejsza, wolniejsza (xz)"))):
+            self.codec_combo.addItem(label, codec)
+            if codec not in BACKUP_CODECS:
+                # zstd wymaga Pythona 3.14 albo pakietu zstandard
+                item = self.codec_combo.model().item(self.codec_combo.count() - 1)
+                item.setEnabled(False)
+                item.setText(_("{} - brak modułu").format(label))
+        self.codec_combo.currentIndexChanged.connect(lambda _i: self.save_config())
+
         form.addRow(self.cb_auto)
         form.addRow(_("Lokalizacja:"), h)
+        form.addRow(_("Kompresja:"), self.codec_combo)
         gb.setLayout(form)
         layout.addWidget(gb)
 
@@ -332,11 +481,15 @@ class BackupDialog(QDialog):
         if cfg:
             self.cb_auto.setChecked(cfg.get("auto_backup", False))
             self.path_edit.setText(cfg.get("backup_path", ""))
+            idx = self.codec_combo.findData(cfg.get("codec", self.default_codec))
+            if idx >= 0 and self.codec_combo.model().item(idx).isEnabled():
+                self.codec_combo.setCurrentIndex(idx)
 
     def save_config(self):
         self.db.save_config("backup_config", {
             "auto_backup": self.cb_auto.isChecked(),
-            "backup_path": self.path_edit.text()
+            "backup_path": self.path_edit.text(),
+            "codec": self.codec_combo.currentData() or self.default_codec
         })
 
     def select_path(self):
@@ -345,20 +498,10 @@ class BackupDialog(QDialog):
         if d: self.path_edit.setText(d); self.save_config()
 
     def create_now(self):
-        from PySide6.QtWidgets import QApplication, QMessageBox
+        from PySide6.QtWidgets import QMessageBox
         self.save_config()
 
-        pd = ProcessingDialog(self, _("Kopia zapasowa"), _("Trwa tworzenie kopii..."))
-        pd.pbar.setRange(0, 100)
-        pd.pbar.setValue(0)
-        pd.show()
-
-        def update_pbar(val):
-            pd.pbar.setValue(val)
-            QApplication.processEvents()
-
-        success, msg = self.db.perform_backup(progress_callback=update_pbar)
-        pd.close()
+        success, msg = run_backup_with_progress(self, self.db, _("Kopia zapasowa"), _("Trwa tworzenie kopii..."))
 
         if success:
             QMessageBox.information(self, _("Sukces"), _("Utworzono kopię zapasową w:\n{}").format(msg))
@@ -370,11 +513,15 @@ class BackupDialog(QDialog):
         import os
         from PySide6.QtWidgets import QFileDialog, QMessageBox, QApplication
 
+        from database import BACKUP_REPO_DIR
+
         path = self.path_edit.text()
+        # Kopie to manifesty w repozytorium; starsze pliki ZIP nadal można wskazać
+        manifests_dir = os.path.join(path, BACKUP_REPO_DIR, "manifests")
         dialog = QFileDialog(self)
         dialog.setWindowTitle(_("Wybierz plik"))
-        dialog.setDirectory(path)
-        dialog.setNameFilters(["Backup (*.zip)"])
+        dialog.setDirectory(manifests_dir if os.path.isdir(manifests_dir) else path)
+        dialog.setNameFilters(["Backup (*.json *.zip)"])
         dialog.setFileMode(QFileDialog.ExistingFile)
 
         # Wymuszamy użycie natywnego menedżera plików systemu (brak brzydkiego okna Qt)
@@ -1926,8 +2073,9 @@ class ReportSelectionDialog(QDialog):
         l=QVBoxLayout(self)
         self.rm=QRadioButton(_("Miesiąc"))
         self.ry=QRadioButton(_("Rok"))
+        self.rb=QRadioButton(_("Wszystkie miesiące roku (osobne pliki)"))
         self.rm.setChecked(True)
-        l.addWidget(self.rm); l.addWidget(self.ry)
+        l.addWidget(self.rm); l.addWidget(self.ry); l.addWidget(self.rb)
         h=QHBoxLayout()
         self.cm=QComboBox()
         self.cm.addItems(MONTH_NAME)
@@ -1953,6 +2101,7 @@ class ReportSelectionDialog(QDialog):
             idx=self.cm.currentIndex()+1
             self.selected_month_str=f"{y}-{idx:02d}"
             self.selected_month_name=self.cm.currentText()
+        elif self.rb.isChecked(): self.selected_type="months"
         else: self.selected_type="year"
         super().accept()
 
@@ -2171,7 +2320,18 @@ class BillsManagerDialog(QDialog):
         self.table.setStyleSheet("QTableWidget { border: 1px solid palette(mid); }")
         self.table.doubleClicked.connect(self.edit_bill)
 
-        self.layout.addWidget(QLabel(f"<b>{_('Oczekujące płatności:')}</b>"))
+        # Wyszukiwanie po kategorii i opisie (indeks FTS rachunków)
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText(_("Szukaj w rachunkach..."))
+        self.search_input.setClearButtonEnabled(True)
+        self.search_input.setFixedWidth(220)
+        self.search_input.textChanged.connect(lambda: self.load_data())
+
+        header_layout = QHBoxLayout()
+        header_layout.addWidget(QLabel(f"<b>{_('Oczekujące płatności:')}</b>"))
+        header_layout.addStretch()
+        header_layout.addWidget(self.search_input)
+        self.layout.addLayout(header_layout)
         self.layout.addWidget(self.table)
 
         # --- FORMULARZ DODAWANIA ---
@@ -2267,7 +2427,8 @@ class BillsManagerDialog(QDialog):
 
     def load_data(self):
         self.table.setRowCount(0)
-        bills = self.db.get_pending_bills() # Upewnij się, że get_pending_bills zwraca też ref_id (7 kolumn)
+        # Jak get_pending_bills (7 kolumn z ref_id), zawężone do wyszukiwanego tekstu
+        bills = self.db.search_pending_bills(self.search_input.text())
         for b in bills:
             # Zakładamy: b_id, d_date, amt, cat, desc, is_rec, ref_id
             b_id, d_date, amt, cat, desc, is_rec = b[:6]
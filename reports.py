@@ -5,7 +5,7 @@ from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.units import cm
 from reportlab.lib.styles import ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak, Flowable
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from config import _, APPNAME, WERSJA, PRODUCENT
@@ -24,10 +24,109 @@ def cleanup_generated_files():
 
 atexit.register(cleanup_generated_files)
 
+# Ile wierszy rejestru najwyżej składamy w jedną tabelę (więcej niż mieści strona A4)
+REGISTER_PAGE_ROWS = 60
+# Zapas wierszy ponad liczbę, która zmieściła się na poprzedniej stronie
+REGISTER_BATCH_MARGIN = 6
+# Co ile wierszy przebiegu podsumowania sprawdzamy, czy raport nie został anulowany
+CANCEL_CHECK_ROWS = 200
+
+
+class ReportCancelled(Exception):
+    """Generowanie PDF przerwane przez użytkownika (plik docelowy zostaje nietknięty)."""
+
+
+def _write_atomically(filename, build):
+    """
+    build(path) zapisuje PDF do pliku tymczasowego obok docelowego; dopiero
+    po sukcesie podmieniamy plik. Przerwany albo nieudany raport nie zostawia
+    połówki pliku ani nie niszczy poprzedniej wersji.
+    """
+    tmp_path = f"{filename}.part"
+    try:
+        build(tmp_path)
+        os.replace(tmp_path, filename)
+    except BaseException:
+        try:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class RegisterStream(Flowable):
+    """
+    Rejestr transakcji składany stronami: przy każdym podziale strony pobiera
+    z iteratora tylko tyle wierszy, ile zmieści się w ramce, i oddaje je jako
+    osobną tabelę z nagłówkiem. Nie ma jednej ogromnej tabeli, którą reportlab
+    dzieliłby (i przeliczał) od nowa na każdej stronie - czas rośnie liniowo,
+    a w pamięci jest najwyżej jedna strona wierszy.
+    """
+
+    def __init__(self, rows, make_table):
+        super().__init__()
+        self._rows = rows
+        self._make_table = make_table
+        self._pending = []
+        self._emitted = False
+        self._batch = REGISTER_PAGE_ROWS
+
+    def _fill(self, count):
+        while len(self._pending) < count:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._pending.append(row)
+
+    def wrap(self, availWidth, availHeight):
+        self._fill(1)
+        if not self._pending and self._emitted:
+            return 0, 0
+        # Zawsze "za duży" - frame wywoła split() z wysokością, która została
+        return availWidth, availHeight + 1
+
+    def split(self, availWidth, availHeight):
+        # Próbujemy tyle wierszy, ile weszło na poprzednią stronę (z zapasem)
+        self._fill(self._batch)
+        if not self._pending:
+            # Pusty rejestr - sam nagłówek, jak wcześniej
+            self._emitted = True
+            return [self._make_table([])]
+        while True:
+            batch = self._pending[:self._batch]
+            parts = self._make_table(batch).split(availWidth, availHeight)
+            if not parts:
+                # Nie zmieści się nawet jeden wiersz - reszta na następnej stronie
+                return []
+            table = parts[0]
+            placed = len(table._cellvalues) - 1
+            if placed < len(batch):
+                self._batch = min(REGISTER_PAGE_ROWS, placed + REGISTER_BATCH_MARGIN)
+                break
+            if self._batch >= REGISTER_PAGE_ROWS:
+                break
+            # Cała partia się zmieściła, a w ramce może być jeszcze miejsce
+            self._batch = REGISTER_PAGE_ROWS
+            self._fill(self._batch)
+            if len(self._pending) == len(batch):
+                break
+        del self._pending[:placed]
+        self._emitted = True
+        # Ten sam obiekt wraca na kolejne strony - reportlab nie może go uznać za "odłożony" na stałe
+        self.__dict__.pop('_postponed', None)
+        self._fill(1)
+        return [table, self] if self._pending else [table]
+
+    def draw(self):
+        pass
+
+
 class PDFReportGenerator:
     def __init__(self):
         self.font_name = "Helvetica"
         self.fonts_registered = False
+        self._styles = None
 
     def register_system_font(self):
         if self.fonts_registered: return
@@ -51,27 +150,66 @@ class PDFReportGenerator:
                 except: continue
         self.fonts_registered = True
 
-    def generate(self, filename, title, transactions, prev_balance=0.0, chart_img_buffer=None, liabilities_status=None, accounts_data=None):
+    def _shared_styles(self):
+        """Style akapitów i tabeli rejestru tworzone raz (po rejestracji czcionki)."""
+        if self._styles is None or self._styles['font'] != self.font_name:
+            self._styles = {
+                'font': self.font_name,
+                'title': ParagraphStyle('TitleStyle', fontName=self.font_name, fontSize=20, textColor=colors.HexColor("#2c3e50"), spaceAfter=10),
+                'normal': ParagraphStyle('NormalStyle', fontName=self.font_name, fontSize=10, spaceAfter=5),
+                'desc': ParagraphStyle('DescStyle', fontName=self.font_name, fontSize=8, leading=10),
+                'header_table': ParagraphStyle('HTStyle', fontName=self.font_name, fontSize=11, spaceBefore=10, spaceAfter=8, fontWeight='BOLD'),
+                'sub_desc': ParagraphStyle('SubDescStyle', fontName=self.font_name, fontSize=7, textColor=colors.grey, leading=8),
+                'register': TableStyle([
+                    ('FONTNAME', (0, 0), (-1, -1), self.font_name),
+                    ('FONTSIZE', (0, 0), (-1, 0), 10),
+                    ('FONTSIZE', (0, 1), (-1, -1), 8),
+                    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#2c3e50")),
+                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+                    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+                    ('ALIGN', (0, 0), (0, -1), 'CENTER'),
+                    ('ALIGN', (5, 0), (5, -1), 'RIGHT'),
+                ]),
+            }
+        return self._styles
+
+    def generate(self, filename, title, transactions, prev_balance=0.0, chart_img_buffer=None, liabilities_status=None, accounts_data=None,
+                 progress=None, is_cancelled=None):
+        """
+        transactions: lista wierszy albo funkcja zwracająca nowy iterator wierszy
+        w kolejności dat (np. DatabaseManager.iter_report_transactions) - wtedy
+        podsumowanie i rejestr czytają bazę strumieniowo, każde osobnym przebiegiem.
+        progress(procent, opis) jest wołane po każdej sekcji i stronie,
+        is_cancelled() - sprawdzane w trakcie; anulowanie rzuca ReportCancelled.
+        """
         from config import _
         self.register_system_font()
+        if is_cancelled is None: is_cancelled = lambda: False
+
+        def step(percent, text):
+            if is_cancelled():
+                raise ReportCancelled()
+            if progress:
+                progress(int(percent), text)
         if liabilities_status is None: liabilities_status = []
         if accounts_data is None: accounts_data = []
+        if callable(transactions):
+            open_rows = transactions
+        else:
+            ordered = sorted(transactions, key=lambda x: (x[1], x[0]))
+            open_rows = lambda: iter(ordered)
 
-        doc = SimpleDocTemplate(
-            filename,
-            pagesize=A4,
-            rightMargin=1.5*cm, leftMargin=1.5*cm,
-            topMargin=1.5*cm, bottomMargin=2*cm
-        )
-
+        step(0, _("Podsumowanie"))
         elements = []
 
 
-        title_style = ParagraphStyle('TitleStyle', fontName=self.font_name, fontSize=20, textColor=colors.HexColor("#2c3e50"), spaceAfter=10)
-        normal_style = ParagraphStyle('NormalStyle', fontName=self.font_name, fontSize=10, spaceAfter=5)
-        desc_style = ParagraphStyle('DescStyle', fontName=self.font_name, fontSize=8, leading=10)
-        header_table_style = ParagraphStyle('HTStyle', fontName=self.font_name, fontSize=11, spaceBefore=10, spaceAfter=8, fontWeight='BOLD')
-        sub_desc_style = ParagraphStyle('SubDescStyle', fontName=self.font_name, fontSize=7, textColor=colors.grey, leading=8)
+        styles = self._shared_styles()
+        title_style = styles['title']
+        normal_style = styles['normal']
+        desc_style = styles['desc']
+        header_table_style = styles['header_table']
+        sub_desc_style = styles['sub_desc']
 
 
         elements.append(Paragraph(title.upper(), title_style))
@@ -90,13 +228,14 @@ class PDFReportGenerator:
         savings_withdrawals_sum = 0.0
         goal_deposits_sum = 0.0
         goal_withdrawals_sum = 0.0
+        register_total = 0
 
-        transactions.sort(key=lambda x: x[1])
-
-        for row in transactions:
+        for row in open_rows():
             t_type, t_cat, t_amt = row[2], row[3], row[5]
-
-
+            if abs(t_amt) >= 0.01 and t_type not in ('savings_migration', 'account_transfer'):
+                register_total += 1
+                if register_total % CANCEL_CHECK_ROWS == 0 and is_cancelled():
+                    raise ReportCancelled()
 
             if t_type == "income":
                 incomes[t_cat] = incomes.get(t_cat, 0.0) + t_amt
@@ -125,6 +264,7 @@ class PDFReportGenerator:
 
         final_inc_sum = total_inc + prev_balance
         net_balance = final_inc_sum - total_exp
+        step(10, _("Podsumowanie"))
 
 
         elements.append(Paragraph(_("STAN POSZCZEGÓLNYCH KONT (NA KONIEC OKRESU)"), header_table_style))
@@ -207,60 +347,65 @@ class PDFReportGenerator:
         }
 
 
-        #valid_transactions = [t for t in transactions if abs(t[5]) >= 0.01]
-        valid_transactions = [t for t in transactions if abs(t[5]) >= 0.01 and t[2] not in ('savings_migration', 'account_transfer')]
-
-
-
-        valid_transactions.sort(key=lambda x: (x[1], x[0]))
-
-
-        for i, row in enumerate(valid_transactions):
-            main_type = type_m.get(row[2], row[2])
-            acc_name = acc_names_map.get(row[8], "-") if len(row) > 8 else "-"
-
-
-            type_cell = [
-                Paragraph(main_type, desc_style),
-                Paragraph(f"<font color='grey'>{acc_name}</font>", sub_desc_style)
-            ]
-
-
-            main_desc = row[4] if row[4] else "-"
-            sub_details = str(row[6]).replace('\n', ', ').strip(', ') if len(row) > 6 and row[6] else ""
-
-            desc_cell = [Paragraph(main_desc, desc_style)]
-            if sub_details:
-                desc_cell.append(Paragraph(f"<i>{sub_details}</i>", sub_desc_style))
-
-
-            display_id = str(i + 1)
-
-            data_all.append([
-                display_id,
-                row[1],
-                type_cell,
-                row[3],
-                desc_cell,
-                f"{row[5]:.2f}"
-            ])
-
-
-        t_details = Table(data_all, colWidths=[1.0*cm, 2.2*cm, 2.5*cm, 3.2*cm, 6.6*cm, 2.5*cm], repeatRows=1)
-        t_details.setStyle(TableStyle([
-            ('FONTNAME', (0, 0), (-1, -1), self.font_name),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('FONTSIZE', (0, 1), (-1, -1), 8),
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#2c3e50")),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-            ('ALIGN', (0, 0), (0, -1), 'CENTER'),
-            ('ALIGN', (5, 0), (5, -1), 'RIGHT'),
-        ]))
-        elements.append(t_details)
-
-        doc.build(elements, onFirstPage=self._add_footer, onLaterPages=self._add_footer)
+        register_done = [0]
+
+        def register_rows():
+            display_id = 0
+            for row in open_rows():
+                if abs(row[5]) < 0.01 or row[2] in ('savings_migration', 'account_transfer'):
+                    continue
+                if is_cancelled():
+                    raise ReportCancelled()
+                display_id += 1
+                register_done[0] = display_id
+                main_type = type_m.get(row[2], row[2])
+                acc_name = acc_names_map.get(row[8], "-") if len(row) > 8 else "-"
+
+                type_cell = [
+                    Paragraph(main_type, desc_style),
+                    Paragraph(f"<font color='grey'>{acc_name}</font>", sub_desc_style)
+                ]
+
+                main_desc = row[4] if row[4] else "-"
+                sub_details = str(row[6]).replace('\n', ', ').strip(', ') if len(row) > 6 and row[6] else ""
+
+                desc_cell = [Paragraph(main_desc, desc_style)]
+                if sub_details:
+                    desc_cell.append(Paragraph(f"<i>{sub_details}</i>", sub_desc_style))
+
+                yield [
+                    str(display_id),
+                    row[1],
+                    type_cell,
+                    row[3],
+                    desc_cell,
+                    f"{row[5]:.2f}"
+                ]
+
+        def make_register_table(rows):
+            t_details = Table(data_all + rows, colWidths=[1.0*cm, 2.2*cm, 2.5*cm, 3.2*cm, 6.6*cm, 2.5*cm], repeatRows=1)
+            t_details.setStyle(styles['register'])
+            return t_details
+
+        elements.append(RegisterStream(register_rows(), make_register_table))
+
+        def on_page(canvas, doc):
+            self._add_footer(canvas, doc)
+            done = register_done[0] / register_total if register_total else 0.0
+            step(10 + 85 * min(done, 1.0), _("Strona {}").format(doc.page))
+
+        def build(path):
+            doc = SimpleDocTemplate(
+                path,
+                pagesize=A4,
+                rightMargin=1.5*cm, leftMargin=1.5*cm,
+                topMargin=1.5*cm, bottomMargin=2*cm
+            )
+            doc.build(elements, onFirstPage=on_page, onLaterPages=on_page)
+
+        _write_atomically(filename, build)
+        if progress:
+            progress(100, _("Gotowe"))
         return True
 
     def _get_table_style(self, header_color):
@@ -286,6 +431,204 @@ class PDFReportGenerator:
         canvas.drawRightString(A4[0]-1.5*cm, 0.8*cm, page_num)
         canvas.restoreState()
 
+class SelectionPDFGenerator:
+    """
+    Zestawienie zaznaczonych transakcji z doklejonymi załącznikami (PDF/obrazy)
+    opatrzonymi nagłówkiem. Wiersze przygotowuje okno (wątek GUI), a tutaj,
+    w wątku roboczym, powstaje tylko PDF - bez dostępu do widżetów.
+    """
+
+    MONTHS_GENITIVE = {
+        '01': 'stycznia', '02': 'lutego', '03': 'marca', '04': 'kwietnia',
+        '05': 'maja', '06': 'czerwca', '07': 'lipca', '08': 'sierpnia',
+        '09': 'września', '10': 'października', '11': 'listopada', '12': 'grudnia'
+    }
+
+    def __init__(self):
+        self.font_name = 'Helvetica'
+        self.bold_font_name = 'Helvetica-Bold'
+        self._register_fonts()
+
+    def _register_fonts(self):
+        paths = ["/usr/share/fonts/TTF/DejaVuSans.ttf", "/usr/share/fonts/dejavu/DejaVuSans.ttf", "DejaVuSans.ttf"]
+        b_paths = ["/usr/share/fonts/TTF/DejaVuSans-Bold.ttf", "/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf", "DejaVuSans-Bold.ttf"]
+
+        for p in paths:
+            if os.path.exists(p):
+                pdfmetrics.registerFont(TTFont('DejaVuSans', p))
+                self.font_name = 'DejaVuSans'
+                break
+        for p in b_paths:
+            if os.path.exists(p):
+                pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', p))
+                self.bold_font_name = 'DejaVuSans-Bold'
+                break
+            else:
+                self.bold_font_name = self.font_name
+
+    def generate(self, filename, rows, get_attachment, progress=None, is_cancelled=None):
+        """
+        rows: słowniki num, id, date, type, cat, details, value (wartość bezwzględna),
+        is_income, has_attachment. get_attachment(id) zwraca bajty załącznika.
+        progress/is_cancelled jak w PDFReportGenerator.generate.
+        """
+        import io
+        from reportlab.pdfgen import canvas
+        try:
+            from pypdf import PdfWriter as PdfMerger, PdfReader
+        except ImportError:
+            try:
+                from pypdf import PdfMerger, PdfReader
+            except ImportError:
+                from PyPDF2 import PdfMerger, PdfReader
+        from PIL import Image
+
+        if is_cancelled is None: is_cancelled = lambda: False
+
+        def step(percent, text):
+            if is_cancelled():
+                raise ReportCancelled()
+            if progress:
+                progress(int(percent), text)
+
+        step(0, _("Zestawienie"))
+        font_name = self.font_name
+        bold_font_name = self.bold_font_name
+
+        main_pdf_buffer = io.BytesIO()
+        doc = SimpleDocTemplate(main_pdf_buffer, pagesize=A4)
+
+        elements = []
+        polish_style = ParagraphStyle('PolishStyle', fontName=font_name, fontSize=10, leading=12)
+        title_style = ParagraphStyle('TitleStyle', fontName=font_name, fontSize=16, alignment=1)
+
+        elements.append(Paragraph(_("Zestawienie wybranych transakcji"), title_style))
+        elements.append(Spacer(1, 20))
+
+        data = [[_("Nr"), _("Data"), _("Typ"), _("Kategoria / Cel"), _("Szczegóły"), _("Kwota")]]
+
+        total_inc = 0.0
+        total_exp = 0.0
+        files_to_attach = []
+
+        for row in rows:
+            if row['has_attachment']:
+                files_to_attach.append(row)
+            val = row['value']
+            if row['is_income']:
+                total_inc += val
+                display_val = f"{val:.2f}"
+            else:
+                total_exp += val
+                display_val = f"-{val:.2f}"
+
+            data.append([str(row['num']), row['date'], row['type'], row['cat'], Paragraph(row['details'], polish_style), display_val])
+
+        data.append(["", "", "", "", ""])
+
+        if total_inc > 0:
+            data.append(["", "", "", _("SUMA WPŁYWÓW:"), f"{total_inc:.2f} zł"])
+        if total_exp > 0:
+            data.append(["", "", "", _("SUMA WYDATKÓW:"), f"-{total_exp:.2f} zł"])
+        if total_inc > 0 and total_exp > 0:
+            balance = total_inc - total_exp
+            data.append(["", "", "", _("BILANS:"), f"{balance:.2f} zł"])
+
+        t = Table(data, colWidths=[30, 65, 75, 90, 180, 80])
+
+        footer_rows = 0
+        if total_inc > 0: footer_rows += 1
+        if total_exp > 0: footer_rows += 1
+        if total_inc > 0 and total_exp > 0: footer_rows += 1
+
+        ts = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, -1), font_name),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('GRID', (0, 0), (-1, -(footer_rows + 1)), 0.5, colors.grey),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('ALIGN', (4, 1), (4, -1), 'LEFT'),
+            ('ALIGN', (5, 1), (5, -1), 'RIGHT'),
+        ])
+
+        if footer_rows > 0:
+            ts.add('FONTNAME', (4, -footer_rows), (-1, -1), bold_font_name)
+
+        t.setStyle(ts)
+        elements.append(t)
+        doc.build(elements)
+
+        merger = PdfMerger()
+        main_pdf_buffer.seek(0)
+        merger.append(main_pdf_buffer)
+
+        for i, f_info in enumerate(files_to_attach):
+            step(10 + 85 * i / len(files_to_attach), _("Załącznik {} z {}").format(i + 1, len(files_to_attach)))
+            raw_bytes = get_attachment(f_info['id'])
+            if not raw_bytes: continue
+
+            try:
+                d = f_info['date'][8:10].lstrip('0')
+                m_idx = f_info['date'][5:7]
+                y = f_info['date'][:4]
+                data_str = f"{d} {self.MONTHS_GENITIVE.get(m_idx, '')} {y}"
+                tekst_naglowka = f"ZAŁĄCZNIK DO TRANSAKCJI nr {f_info['num']} | z dnia {data_str}"
+
+                if raw_bytes.startswith(b"%PDF"):
+                    input_pdf = PdfReader(io.BytesIO(raw_bytes))
+                    page = input_pdf.pages[0]
+                else:
+                    img = Image.open(io.BytesIO(raw_bytes))
+                    if img.mode != 'RGB': img = img.convert('RGB')
+                    img_pdf_buf = io.BytesIO()
+                    img.save(img_pdf_buf, format="PDF")
+                    img_pdf_buf.seek(0)
+                    img_reader = PdfReader(img_pdf_buf)
+                    page = img_reader.pages[0]
+
+                p_width = float(page.mediabox.width)
+                p_height = float(page.mediabox.height)
+
+                dynamic_font_size = p_width * 0.018
+
+                margin_x = p_width * 0.03
+                margin_y = p_height * 0.03
+
+                overlay_buffer = io.BytesIO()
+                c = canvas.Canvas(overlay_buffer, pagesize=(p_width, p_height))
+
+                c.setFont(bold_font_name, dynamic_font_size)
+                c.setFillColorRGB(0.3, 0.3, 0.3)
+
+                c.drawRightString(p_width - margin_x, p_height - (margin_y + dynamic_font_size), tekst_naglowka)
+                c.save()
+
+                overlay_buffer.seek(0)
+                overlay_reader = PdfReader(overlay_buffer)
+
+                page.merge_page(overlay_reader.pages[0])
+
+                merger.add_page(page)
+
+            except Exception as e:
+                print(f"Błąd stemplowania ID {f_info['id']}: {e}")
+
+        step(95, _("Zapisywanie"))
+
+        def build(path):
+            with open(path, "wb") as f_final:
+                merger.write(f_final)
+
+        try:
+            _write_atomically(filename, build)
+        finally:
+            merger.close()
+        if progress:
+            progress(100, _("Gotowe"))
+        return True
+
 class ShoppingPDFGenerator:
     def __init__(self):
         self.font_name = "Helvetica"
@@ -41,6 +41,13 @@ class ShoppingHistoryDialog(QDialog):
         left_layout.setContentsMargins(0, 0, 0, 0)
         left_layout.addWidget(QLabel(f"<b>{_('Dostępne listy:')}</b>"))
 
+        # Szuka w nazwach list oraz produktach i sklepach na listach (indeks FTS)
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText(_("Szukaj listy lub produktu..."))
+        self.search_input.setClearButtonEnabled(True)
+        self.search_input.textChanged.connect(lambda: self.load_lists())
+        left_layout.addWidget(self.search_input)
+
         self.table_lists = QTableWidget()
         self.table_lists.setColumnCount(4)
         self.table_lists.setHorizontalHeaderLabels([_("ID"), _("Nazwa"), _("Data"), _("Status")])
@@ -95,7 +102,7 @@ class ShoppingHistoryDialog(QDialog):
 
     def load_lists(self):
         self.table_lists.setRowCount(0)
-        lists = self.db.get_shopping_lists()
+        lists = self.db.search_shopping_lists(self.search_input.text())
         for r in lists:
             row_idx = self.table_lists.rowCount()
             self.table_lists.insertRow(row_idx)
@@ -334,9 +341,7 @@ class ShoppingListDialog(QDialog):
     def _force_status_update(self, status):
         if self.list_id is not None:
             try:
-                self.db.conn.execute("UPDATE shopping_lists SET status=?, updated_at=? WHERE id=?",
-                                     (status, self.db.sync_timestamp(), self.list_id))
-                self.db.conn.commit()
+                self.db.set_shopping_list_status(self.list_id, status)
             except: pass
 
     def print_list(self):